@@ -25,6 +25,10 @@ import types
 import copy
 import codecs
 import json
+import bisect
+import threading
+import queue
+import concurrent.futures
 import pytz
 import tempfile
 import stat
@@ -38,6 +42,15 @@ logger = None
 
 ignored_transaction_types = [ "archive", "compress", "defcomp", "dispatch", "unarchive" ]
 
+# The transaction types which can change the stream definitions (name, basis, type, timelock, startTime) in a depot. A stream rename is recorded
+# as a chstream transaction and the removal and reactivation of a stream as a defunct and undefunct transaction. The defunct and undefunct
+# transactions of elements are matched too, which only adds checkpoints to the stream timeline (see AccuRev2Git.GetStreamTimeline()).
+stream_definition_transaction_types = [ "mkstream", "chstream", "defunct", "undefunct" ]
+
+# The element types whose populated contents depend only on the element version. The contents of "ptext" elements have their keywords expanded
+# and links are left to accurev. See AccuRev2Git.GetElementVersionMap().
+cacheable_element_types = [ "text", "binary" ]
+
 # Taken from this StackOverflow answer: http://stackoverflow.com/a/19238551
 # Compulsary quote: https://twitter.com/codinghorror/status/712467615780708352
 def utc2local(utc):
@@ -64,29 +77,22 @@ class Config(object):
                 startTransaction = xmlElement.attrib.get('start-transaction')
                 endTransaction   = xmlElement.attrib.get('end-transaction')
                 commandCacheFilename = xmlElement.attrib.get('command-cache-filename')
+                retrieveWorkers = xmlElement.attrib.get('retrieve-workers')
+                prefetchWindow = xmlElement.attrib.get('prefetch-window')
+                checkpointTransactions = xmlElement.attrib.get('checkpoint-transactions')
+                checkpointMinutes = xmlElement.attrib.get('checkpoint-minutes')
+                pipelineDepth = xmlElement.attrib.get('pipeline-depth')
+                populateWorkers = xmlElement.attrib.get('populate-workers')
+                probeWindow = xmlElement.attrib.get('probe-window')
+                histWorkers = xmlElement.attrib.get('hist-workers')
                 
-                excludeStreamTypes = None
-                streamMap = None
-                streamListElement = xmlElement.find('stream-list')
-                if streamListElement is not None:
-                    excludeStreamTypes = streamListElement.attrib.get("exclude-types")
-                    if excludeStreamTypes is not None:
-                        excludeStreamTypes = [x.strip() for x in excludeStreamTypes.split(',') if len(x.strip()) > 0]
-                    streamMap = OrderedDict()
-                    streamElementList = streamListElement.findall('stream')
-                    for streamElement in streamElementList:
-                        streamName = streamElement.text
-                        branchName = streamElement.attrib.get("branch-name")
-                        if branchName is None:
-                            branchName = streamName
-
-                        streamMap[streamName] = branchName
+                streamMap, excludeStreamTypes = Config.GetStreamMapFromXmlElement(xmlElement.find('stream-list'))
                 
-                return cls(depot, username, password, startTransaction, endTransaction, streamMap, commandCacheFilename, excludeStreamTypes)
+                return cls(depot, username, password, startTransaction, endTransaction, streamMap, commandCacheFilename, excludeStreamTypes, retrieveWorkers, prefetchWindow, checkpointTransactions, checkpointMinutes, pipelineDepth, populateWorkers, probeWindow, histWorkers)
             else:
                 return None
             
-        def __init__(self, depot = None, username = None, password = None, startTransaction = None, endTransaction = None, streamMap = None, commandCacheFilename = None, excludeStreamTypes = None):
+        def __init__(self, depot = None, username = None, password = None, startTransaction = None, endTransaction = None, streamMap = None, commandCacheFilename = None, excludeStreamTypes = None, retrieveWorkers = None, prefetchWindow = None, checkpointTransactions = None, checkpointMinutes = None, pipelineDepth = None, populateWorkers = None, probeWindow = None, histWorkers = None):
             self.depot    = depot
             self.username = username
             self.password = password
@@ -95,6 +101,14 @@ class Config(object):
             self.streamMap = streamMap
             self.commandCacheFilename = commandCacheFilename
             self.excludeStreamTypes = excludeStreamTypes
+            self.retrieveWorkers = int(retrieveWorkers) if retrieveWorkers is not None else 1
+            self.prefetchWindow = int(prefetchWindow) if prefetchWindow is not None else 0
+            self.checkpointTransactions = int(checkpointTransactions) if checkpointTransactions is not None else 0
+            self.checkpointMinutes = float(checkpointMinutes) if checkpointMinutes is not None else 0
+            self.pipelineDepth = int(pipelineDepth) if pipelineDepth is not None else 0
+            self.populateWorkers = int(populateWorkers) if populateWorkers is not None else 1
+            self.probeWindow = int(probeWindow) if probeWindow is not None else 1
+            self.histWorkers = int(histWorkers) if histWorkers is not None else 1
     
         def __repr__(self):
             str = "Config.AccuRev(depot=" + repr(self.depot)
@@ -108,6 +122,14 @@ class Config(object):
                 str += ", commandCacheFilename=" + repr(self.commandCacheFilename)
             if self.excludeStreamTypes is not None:
                 str += ", excludeStreamTypes=" + repr(self.excludeStreamTypes)
+            str += ", retrieveWorkers="   + repr(self.retrieveWorkers)
+            str += ", prefetchWindow="    + repr(self.prefetchWindow)
+            str += ", checkpointTransactions=" + repr(self.checkpointTransactions)
+            str += ", checkpointMinutes=" + repr(self.checkpointMinutes)
+            str += ", pipelineDepth="     + repr(self.pipelineDepth)
+            str += ", populateWorkers="   + repr(self.populateWorkers)
+            str += ", probeWindow="       + repr(self.probeWindow)
+            str += ", histWorkers="       + repr(self.histWorkers)
             str += ")"
             
             return str
@@ -127,21 +149,15 @@ class Config(object):
                 sourceStreamFastForward = xmlElement.attrib.get('source-stream-fast-forward')
                 sourceStreamInferrence = xmlElement.attrib.get('source-stream-inferrence')
                 newBasisIsFirstParent = xmlElement.attrib.get('new-basis-is-first-parent')
+                fastImport = xmlElement.attrib.get('fast-import')
 
-                remoteMap = OrderedDict()
-                remoteElementList = xmlElement.findall('remote')
-                for remoteElement in remoteElementList:
-                    remoteName     = remoteElement.attrib.get("name")
-                    remoteUrl      = remoteElement.attrib.get("url")
-                    remotePushUrl  = remoteElement.attrib.get("push-url")
-                    
-                    remoteMap[remoteName] = git.GitRemoteListItem(name=remoteName, url=remoteUrl, pushUrl=remotePushUrl)
+                remoteMap = Config.GetRemoteMapFromXmlElement(xmlElement)
 
-                return cls(repoPath=repoPath, messageStyle=messageStyle, messageKey=messageKey, authorIsCommitter=authorIsCommitter, remoteMap=remoteMap, emptyChildStreamAction=emptyChildStreamAction, sourceStreamFastForward=sourceStreamFastForward, sourceStreamInferrence=sourceStreamInferrence, newBasisIsFirstParent=newBasisIsFirstParent)
+                return cls(repoPath=repoPath, messageStyle=messageStyle, messageKey=messageKey, authorIsCommitter=authorIsCommitter, remoteMap=remoteMap, emptyChildStreamAction=emptyChildStreamAction, sourceStreamFastForward=sourceStreamFastForward, sourceStreamInferrence=sourceStreamInferrence, newBasisIsFirstParent=newBasisIsFirstParent, fastImport=fastImport)
             else:
                 return None
             
-        def __init__(self, repoPath, messageStyle=None, messageKey=None, authorIsCommitter=None, remoteMap=None, emptyChildStreamAction=None, sourceStreamFastForward=None, sourceStreamInferrence=None, newBasisIsFirstParent=None):
+        def __init__(self, repoPath, messageStyle=None, messageKey=None, authorIsCommitter=None, remoteMap=None, emptyChildStreamAction=None, sourceStreamFastForward=None, sourceStreamInferrence=None, newBasisIsFirstParent=None, fastImport=None):
             self.repoPath               = repoPath
             self.messageStyle           = messageStyle
             self.messageKey             = messageKey
@@ -188,6 +204,14 @@ class Config(object):
             else:
                 self.newBasisIsFirstParent = True
 
+            if fastImport is not None:
+                fastImport = fastImport.lower()
+                if fastImport not in [ "true", "false" ]:
+                    raise Exception("Error, the fast-import attribute only accepts true or false options but got: {0}".format(fastImport))
+                self.fastImport = (fastImport == "true")
+            else:
+                self.fastImport = False
+
         def __repr__(self):
             str = "Config.Git(repoPath=" + repr(self.repoPath)
             if self.messageStyle is not None:
@@ -200,10 +224,56 @@ class Config(object):
                 str += ", authorIsCommitter="    + repr(self.authorIsCommitter)
             if self.newBasisIsFirstParent is not None:
                 str += ", newBasisIsFirstParent=" + repr(self.newBasisIsFirstParent)
+            if self.fastImport is not None:
+                str += ", fastImport=" + repr(self.fastImport)
             str += ")"
             
             return str
             
+    # A depot which is converted, alongside other depots, by a single invocation of the script. See Config.GetDepotConfigList().
+    class Depot(object):
+        @classmethod
+        def fromxmlelement(cls, xmlElement):
+            if xmlElement is not None and xmlElement.tag == 'depot':
+                name     = xmlElement.attrib.get('name')
+                repoPath = xmlElement.attrib.get('repo-path')
+                startTransaction = xmlElement.attrib.get('start-transaction')
+                endTransaction   = xmlElement.attrib.get('end-transaction')
+                streamMap, excludeStreamTypes = Config.GetStreamMapFromXmlElement(xmlElement.find('stream-list'))
+                remoteMap = Config.GetRemoteMapFromXmlElement(xmlElement)
+                if len(remoteMap) == 0:
+                    remoteMap = None
+
+                return cls(name=name, repoPath=repoPath, startTransaction=startTransaction, endTransaction=endTransaction, streamMap=streamMap, excludeStreamTypes=excludeStreamTypes, remoteMap=remoteMap)
+            else:
+                return None
+
+        def __init__(self, name, repoPath, startTransaction=None, endTransaction=None, streamMap=None, excludeStreamTypes=None, remoteMap=None):
+            self.name               = name
+            self.repoPath           = repoPath
+            self.startTransaction   = startTransaction
+            self.endTransaction     = endTransaction
+            self.streamMap          = streamMap
+            self.excludeStreamTypes = excludeStreamTypes
+            self.remoteMap          = remoteMap
+
+        def __repr__(self):
+            str = "Config.Depot(name=" + repr(self.name)
+            str += ", repoPath="       + repr(self.repoPath)
+            if self.startTransaction is not None:
+                str += ", startTransaction=" + repr(self.startTransaction)
+            if self.endTransaction is not None:
+                str += ", endTransaction=" + repr(self.endTransaction)
+            if self.streamMap is not None:
+                str += ", streamMap=" + repr(self.streamMap)
+            if self.excludeStreamTypes is not None:
+                str += ", excludeStreamTypes=" + repr(self.excludeStreamTypes)
+            if self.remoteMap is not None:
+                str += ", remoteMap=" + repr(self.remoteMap)
+            str += ")"
+
+            return str
+
     class UserMap(object):
         @classmethod
         def fromxmlelement(cls, xmlElement):
@@ -246,6 +316,41 @@ class Config(object):
         (root, ext) = os.path.splitext(scriptName)
         return root + '.config.xml'
 
+    # Parses the stream-list element and returns a tuple of the stream name to branch name map and the list of excluded stream types.
+    @staticmethod
+    def GetStreamMapFromXmlElement(streamListElement):
+        excludeStreamTypes = None
+        streamMap = None
+        if streamListElement is not None:
+            excludeStreamTypes = streamListElement.attrib.get("exclude-types")
+            if excludeStreamTypes is not None:
+                excludeStreamTypes = [x.strip() for x in excludeStreamTypes.split(',') if len(x.strip()) > 0]
+            streamMap = OrderedDict()
+            streamElementList = streamListElement.findall('stream')
+            for streamElement in streamElementList:
+                streamName = streamElement.text
+                branchName = streamElement.attrib.get("branch-name")
+                if branchName is None:
+                    branchName = streamName
+
+                streamMap[streamName] = branchName
+
+        return streamMap, excludeStreamTypes
+
+    # Parses the remote elements which are the children of the given element.
+    @staticmethod
+    def GetRemoteMapFromXmlElement(xmlElement):
+        remoteMap = OrderedDict()
+        remoteElementList = xmlElement.findall('remote')
+        for remoteElement in remoteElementList:
+            remoteName     = remoteElement.attrib.get("name")
+            remoteUrl      = remoteElement.attrib.get("url")
+            remotePushUrl  = remoteElement.attrib.get("push-url")
+            
+            remoteMap[remoteName] = git.GitRemoteListItem(name=remoteName, url=remoteUrl, pushUrl=remotePushUrl)
+
+        return remoteMap
+
     @ staticmethod
     def GetBooleanAttribute(xmlElement, attribute):
         if xmlElement is None or attribute is None:
@@ -379,8 +484,17 @@ class Config(object):
                         else:
                             #print("Known user:", user.accurevUsername)
                             pass
+
+            depots = None
+            depotWorkers = None
+            maxAccurevCommands = None
+            depotsElem = xmlRoot.find('depots')
+            if depotsElem is not None:
+                depots = [ Config.Depot.fromxmlelement(x) for x in depotsElem.findall('depot') ]
+                depotWorkers = depotsElem.attrib.get('workers')
+                maxAccurevCommands = depotsElem.attrib.get('max-accurev-commands')
             
-            return cls(accurev=accurev, git=git, usermaps=usermaps, method=method, mergeStrategy=mergeStrategy, logFilename=logFilename)
+            return cls(accurev=accurev, git=git, usermaps=usermaps, method=method, mergeStrategy=mergeStrategy, logFilename=logFilename, depots=depots, depotWorkers=depotWorkers, maxAccurevCommands=maxAccurevCommands)
         else:
             # Invalid XML for an accurev2git configuration file.
             return None
@@ -394,13 +508,16 @@ class Config(object):
                 config = Config.fromxmlstring(configXml, filename=filename)
         return config
 
-    def __init__(self, accurev=None, git=None, usermaps=None, method=None, mergeStrategy=None, logFilename=None):
+    def __init__(self, accurev=None, git=None, usermaps=None, method=None, mergeStrategy=None, logFilename=None, depots=None, depotWorkers=None, maxAccurevCommands=None):
         self.accurev       = accurev
         self.git           = git
         self.usermaps      = usermaps
         self.method        = method
         self.mergeStrategy = mergeStrategy
         self.logFilename   = logFilename
+        self.depots        = depots
+        self.depotWorkers  = int(depotWorkers) if depotWorkers is not None else 1
+        self.maxAccurevCommands = int(maxAccurevCommands) if maxAccurevCommands is not None else 0
         
     def __repr__(self):
         str = "Config(accurev="   + repr(self.accurev)
@@ -409,10 +526,96 @@ class Config(object):
         str += ", method="        + repr(self.method)
         str += ", mergeStrategy=" + repr(self.mergeStrategy)
         str += ", logFilename="   + repr(self.logFilename)
+        if self.depots is not None:
+            str += ", depots="    + repr(self.depots)
+            str += ", depotWorkers=" + repr(self.depotWorkers)
+            str += ", maxAccurevCommands=" + repr(self.maxAccurevCommands)
         str += ")"
         
         return str
 
+    # Returns a config for each of the depots listed in the depots element. Each one is a copy of this config with the depot, git repo path,
+    # transaction range, stream list and remotes replaced by the ones given for the depot, so that each depot is converted into its own repo.
+    def GetDepotConfigList(self):
+        configList = []
+        if self.depots is not None:
+            for depot in self.depots:
+                config = copy.deepcopy(self)
+                config.depots = None
+                config.accurev.depot = depot.name
+                config.git.repoPath = depot.repoPath
+                if depot.startTransaction is not None:
+                    config.accurev.startTransaction = depot.startTransaction
+                if depot.endTransaction is not None:
+                    config.accurev.endTransaction = depot.endTransaction
+                if depot.streamMap is not None:
+                    config.accurev.streamMap = depot.streamMap
+                    config.accurev.excludeStreamTypes = depot.excludeStreamTypes
+                if depot.remoteMap is not None:
+                    config.git.remoteMap = depot.remoteMap
+                configList.append(config)
+        return configList
+
+# Chooses, per transaction, the cheaper way of bringing the worktree up to date: deleting and populating only the elements in the transaction's
+# diff (the diff method) or clearing the worktree and populating the whole stream (the pop method). The cost of each is estimated from the
+# number of elements it has to process and the time per element that it has taken so far, including the commit. Until one of them has been
+# timed the diff method is assumed to take diffToPopCostRatio times as long per element as the pop method.
+class PopulateCostModel(object):
+    diffToPopCostRatio = 4.0
+    smoothing = 0.3 # The weight of the latest timing in the running average.
+
+    def __init__(self, treeEntryCount):
+        self.treeEntryCount = treeEntryCount
+        self.diffSecondsPerElement = None
+        self.popSecondsPerEntry = None
+        self.diffCount = 0
+        self.popCount = 0
+        self.popChosenCount = 0
+        self.secondsSaved = 0.0
+
+    def __repr__(self):
+        str = "PopulateCostModel(treeEntryCount=" + repr(self.treeEntryCount)
+        str += ", diffSecondsPerElement=" + repr(self.diffSecondsPerElement)
+        str += ", popSecondsPerEntry="    + repr(self.popSecondsPerEntry)
+        str += ")"
+
+        return str
+
+    def Average(self, average, value):
+        return value if average is None else (1.0 - PopulateCostModel.smoothing) * average + PopulateCostModel.smoothing * value
+
+    # Returns the (diffCost, popCost) tuple of estimates, in seconds if any timings were recorded, for a transaction whose diff has elementCount elements.
+    def Estimate(self, elementCount):
+        diffRate, popRate = self.diffSecondsPerElement, self.popSecondsPerEntry
+        if diffRate is None and popRate is None:
+            diffRate, popRate = PopulateCostModel.diffToPopCostRatio, 1.0
+        elif diffRate is None:
+            diffRate = popRate * PopulateCostModel.diffToPopCostRatio
+        elif popRate is None:
+            popRate = diffRate / PopulateCostModel.diffToPopCostRatio
+        return (elementCount * diffRate, max(self.treeEntryCount, 1) * popRate)
+
+    # Returns True if the pop method is estimated to be cheaper than the diff method for a transaction whose diff has elementCount elements.
+    def IsPopCheaper(self, elementCount):
+        diffCost, popCost = self.Estimate(elementCount)
+        if popCost < diffCost:
+            self.popChosenCount += 1
+            if self.diffSecondsPerElement is not None or self.popSecondsPerEntry is not None:
+                self.secondsSaved += diffCost - popCost
+            return True
+        return False
+
+    def RecordDiff(self, elementCount, seconds):
+        self.diffCount += 1
+        if elementCount > 0:
+            self.diffSecondsPerElement = self.Average(self.diffSecondsPerElement, seconds / elementCount)
+
+    def RecordPop(self, seconds, treeEntryCount=None):
+        self.popCount += 1
+        if treeEntryCount is not None:
+            self.treeEntryCount = treeEntryCount
+        self.popSecondsPerEntry = self.Average(self.popSecondsPerEntry, seconds / max(self.treeEntryCount, 1))
+
 # Prescribed recepie:
 # - Get the list of tracked streams from the config file.
 # - For each stream in the list
@@ -438,12 +641,46 @@ class AccuRev2Git(object):
     commandFailureRetryCount = 3
     commandFailureSleepSeconds = 3
 
-    cachedDepots = None
+    # The locks that serialize the updates of refs that are shared between the retrieval workers (see RetrieveStreamsConcurrently()), one per git
+    # repository so that the instances that convert into different repositories don't wait for each other (see GetRefUpdateLock()).
+    refUpdateLocks = {}
+    refUpdateLocksLock = threading.Lock()
+
+    # The number of commits after which the git fast-import refs are checkpointed (see FastImportCommit()).
+    fastImportCheckpointInterval = 1000
+
+    # Returns the lock for the git repository at repoPath, which is shared by the instances that convert into the same repository and by their
+    # copy.copy() workers.
+    @staticmethod
+    def GetRefUpdateLock(repoPath):
+        if repoPath is None:
+            return threading.RLock()
+        key = os.path.normcase(os.path.abspath(repoPath))
+        with AccuRev2Git.refUpdateLocksLock:
+            lock = AccuRev2Git.refUpdateLocks.get(key)
+            if lock is None:
+                lock = threading.RLock()
+                AccuRev2Git.refUpdateLocks[key] = lock
+        return lock
 
     def __init__(self, config):
         self.config = config
+        self.refUpdateLock = AccuRev2Git.GetRefUpdateLock(config.git.repoPath if config is not None and config.git is not None else None)
         self.cwd = None
         self.gitRepo = None
+        self.streamTimelines = {}
+        self.lastStreamsCheckpoint = None
+        self.mkstreamsMaps = {}
+        self.resolvedMkstreamsRefs = {}
+        self.fastImport = None
+        self.transactionIndexes = {}
+        self.infoDeadlineReached = False
+        self.cachedDepots = None
+        self.elementVersionMaps = {}
+        self.depotTransactionStores = {}
+        # Set when this instance is one of several that convert their depots concurrently (see ConvertDepots()). The accurev login, the command
+        # cache and the working directory are then managed by the caller and must not be changed by this instance since they are process wide.
+        self.isSharedSession = False
 
     # Returns True if the path was deleted, otherwise false
     def DeletePath(self, path):
@@ -464,53 +701,154 @@ class AccuRev2Git(object):
     def ClearGitRepo(self):
         # Delete everything except the .git folder from the destination (git repo)
         logger.debug( "Clear git repo." )
-        for root, dirs, files in os.walk(self.gitRepo.path, topdown=False):
-            for name in files:
-                path = os.path.join(root, name)
-                if git.GetGitDirPrefix(path) is None:
-                    self.DeletePath(path)
-            for name in dirs:
-                path = os.path.join(root, name)
-                if git.GetGitDirPrefix(path) is None:
-                    self.DeletePath(path)
-
-    def PreserveEmptyDirs(self):
+        with os.scandir(self.gitRepo.path) as it:
+            for entry in it:
+                if entry.name != '.git':
+                    self.DeletePath(entry.path)
+
+    # Walks the worktree, top-down, in a single pass and yields a (dirPath, dirEntries, fileEntries) tuple for each directory, where the entries are
+    # the os.DirEntry objects for its contents. Symbolic links are listed in the fileEntries, since that's how git records them, and the .git
+    # directories are never listed. As with os.walk() the caller can remove items from the dirEntries to stop them from being walked.
+    # If the pathList is given only the directories in the pathList (and, when recursive is set, the directories under them) are walked instead of
+    # the whole worktree.
+    def WalkWorktree(self, pathList=None, recursive=True):
+        if pathList is None:
+            pathList = [ self.gitRepo.path ]
+        for path in pathList:
+            if os.path.islink(path) or not os.path.isdir(path) or git.GetGitDirPrefix(path) is not None:
+                continue
+            dirStack = [ path ]
+            while len(dirStack) > 0:
+                dirPath = dirStack.pop()
+                dirEntries, fileEntries = [], []
+                try:
+                    with os.scandir(dirPath) as it:
+                        for entry in it:
+                            if entry.name == '.git':
+                                continue
+                            elif entry.is_dir(follow_symlinks=False):
+                                dirEntries.append(entry)
+                            else:
+                                fileEntries.append(entry)
+                except OSError:
+                    continue # Deleted by the caller or a broken path, os.walk() ignores these too.
+                yield (dirPath, dirEntries, fileEntries)
+                if recursive:
+                    dirStack.extend(reversed([ entry.path for entry in dirEntries ]))
+
+    # Iterates over the directories in the worktree, see WalkWorktree(). The worktree root itself is never returned.
+    def IterWorktreeDirs(self, pathList=None, recursive=True):
+        repoPath = os.path.abspath(self.gitRepo.path)
+        for dirPath, dirEntries, fileEntries in self.WalkWorktree(pathList=pathList, recursive=recursive):
+            if os.path.abspath(dirPath) != repoPath:
+                yield ToUnixPath(dirPath)
+
+    # Returns the path of the .gitignore file that preserves the empty directory, or None if it couldn't be created.
+    def PreserveEmptyDir(self, dirPath):
+        filename = os.path.join(dirPath, '.gitignore')
+        with codecs.open(filename, 'w', 'utf-8') as file:
+            #file.write('# accurev2git.py preserve empty dirs\n')
+            pass
+        if not os.path.exists(filename):
+            logger.error("Failed to preserve directory. Couldn't create '{0}'.".format(filename))
+            return None
+        return filename
+
+    def PreserveEmptyDirs(self, pathList=None, recursive=True):
         preservedDirs = []
-        for root, dirs, files in os.walk(self.gitRepo.path, topdown=True):
-            for name in dirs:
-                path = ToUnixPath(os.path.join(root, name))
-                # Preserve empty directories that are not under the .git/ directory.
-                if git.GetGitDirPrefix(path) is None and len(os.listdir(path)) == 0:
-                    filename = os.path.join(path, '.gitignore')
-                    with codecs.open(filename, 'w', 'utf-8') as file:
-                        #file.write('# accurev2git.py preserve empty dirs\n')
-                        preservedDirs.append(filename)
-                    if not os.path.exists(filename):
-                        logger.error("Failed to preserve directory. Couldn't create '{0}'.".format(filename))
+        repoPath = os.path.abspath(self.gitRepo.path)
+        for dirPath, dirEntries, fileEntries in self.WalkWorktree(pathList=pathList, recursive=recursive):
+            # Preserve empty directories that are not under the .git/ directory.
+            if len(dirEntries) == 0 and len(fileEntries) == 0 and os.path.abspath(dirPath) != repoPath:
+                filename = self.PreserveEmptyDir(dirPath)
+                if filename is not None:
+                    preservedDirs.append(filename)
         return preservedDirs
 
-    def DeleteEmptyDirs(self):
+    def DeleteEmptyDirs(self, pathList=None, recursive=True):
         deletedDirs = []
-        for root, dirs, files in os.walk(self.gitRepo.path, topdown=True):
-            for name in dirs:
-                path = ToUnixPath(os.path.join(root, name))
-                # Delete empty directories that are not under the .git/ directory.
-                if git.GetGitDirPrefix(path) is None:
-                    dirlist = os.listdir(path)
-                    count = len(dirlist)
-                    delete = (len(dirlist) == 0)
-                    if len(dirlist) == 1 and '.gitignore' in dirlist:
-                        with codecs.open(os.path.join(path, '.gitignore')) as gi:
-                            contents = gi.read().strip()
-                            delete = (len(contents) == 0)
-                    if delete:
-                        if not self.DeletePath(path):
-                            logger.error("Failed to delete empty directory '{0}'.".format(path))
-                            raise Exception("Failed to delete '{0}'".format(path))
-                        else:
-                            deletedDirs.append(path)
+        repoPath = os.path.abspath(self.gitRepo.path)
+        for dirPath, dirEntries, fileEntries in self.WalkWorktree(pathList=pathList, recursive=recursive):
+            # Delete empty directories that are not under the .git/ directory.
+            if os.path.abspath(dirPath) == repoPath or len(dirEntries) + len(fileEntries) > 1:
+                continue
+            delete = (len(dirEntries) + len(fileEntries) == 0)
+            if len(fileEntries) == 1 and fileEntries[0].name == '.gitignore':
+                # Only read the .gitignore file if it isn't trivially empty.
+                delete = (fileEntries[0].stat(follow_symlinks=False).st_size == 0)
+                if not delete:
+                    with codecs.open(fileEntries[0].path) as gi:
+                        contents = gi.read().strip()
+                        delete = (len(contents) == 0)
+            if delete:
+                if not self.DeletePath(dirPath):
+                    logger.error("Failed to delete empty directory '{0}'.".format(dirPath))
+                    raise Exception("Failed to delete '{0}'".format(dirPath))
+                else:
+                    deletedDirs.append(ToUnixPath(dirPath))
+                    dirEntries[:] = []
         return deletedDirs
 
+    # Returns the number of entries in the index, or None if they couldn't be listed.
+    def CountIndexEntries(self):
+        output = self.gitRepo.raw_cmd([ u'git', u'ls-files', u'-z' ])
+        if output is None:
+            return None
+        return output.count('\0')
+
+    # Converts the worktree paths into unique repo relative paths, dropping the paths that are outside the worktree or under the .git/ directory.
+    def GetRepoRelPathList(self, pathList):
+        repoPath = os.path.abspath(self.gitRepo.path)
+        relPathList, relPathSet = [], set()
+        for path in pathList:
+            relPath = ToUnixPath(os.path.relpath(os.path.abspath(path), repoPath))
+            if relPath != '.' and not relPath.startswith('..') and git.GetGitDirPrefix(relPath) is None and relPath not in relPathSet:
+                relPathSet.add(relPath)
+                relPathList.append(relPath)
+        return relPathList
+
+    # Returns the repo relative paths of the files in the worktree under the given repo relative paths, or in the whole worktree if relPathList is None.
+    # Symbolic links to directories are listed as files since that's how `git add` records them. If preserveEmptyDirs is set the empty directories
+    # are preserved, as by PreserveEmptyDirs(), in the same pass and their .gitignore files are listed too.
+    def ListWorktreeFiles(self, relPathList=None, preserveEmptyDirs=False):
+        repoPath = os.path.abspath(self.gitRepo.path)
+        fileList = []
+        for relPath in (relPathList if relPathList is not None else [ '.' ]):
+            path = os.path.normpath(os.path.join(repoPath, relPath))
+            if os.path.islink(path) or os.path.isfile(path):
+                fileList.append(relPath)
+            else:
+                for dirPath, dirEntries, fileEntries in self.WalkWorktree(pathList=[ path ]):
+                    relDirPath = ToUnixPath(os.path.relpath(dirPath, repoPath))
+                    relDirPrefix = '' if relDirPath == '.' else relDirPath + '/'
+                    if preserveEmptyDirs and len(dirEntries) == 0 and len(fileEntries) == 0 and len(relDirPrefix) > 0:
+                        if self.PreserveEmptyDir(dirPath) is not None:
+                            fileList.append(relDirPrefix + '.gitignore')
+                    for entry in fileEntries:
+                        fileList.append(relDirPrefix + entry.name)
+        return fileList
+
+    # Updates the index entries for the given worktree paths, and everything under them, to match the worktree. Index entries which are no longer
+    # in the worktree are removed. The rest of the index is left untouched so that only the changed subtrees need to be rehashed by write-tree.
+    def UpdateIndexForPaths(self, pathList):
+        relPathList = self.GetRepoRelPathList(pathList)
+
+        # Drop the existing index entries under the changed paths. The literal pathspec magic stops git from interpreting wildcards in the file names.
+        chunkSize = 256
+        for i in range(0, len(relPathList), chunkSize):
+            chunk = [ u':(literal){0}'.format(p) for p in relPathList[i:i + chunkSize] ]
+            if not self.gitRepo.rm(fileList=chunk, recursive=True, force=True, cached=True, ignoreUnmatch=True, quiet=True):
+                logger.error("Failed to remove the changed paths from the index. Error:\n{0}".format(self.gitRepo.lastStderr))
+                return False
+
+        # Add back whatever is in the worktree under the changed paths.
+        fileList = self.ListWorktreeFiles(relPathList=relPathList)
+        if len(fileList) > 0 and not self.gitRepo.update_index(fileList=fileList, add=True, remove=True, replace=True, git_opts=[u'-c', u'core.autocrlf=false']):
+            logger.error("Failed to add the changed paths to the index. Error:\n{0}".format(self.gitRepo.lastStderr))
+            return False
+
+        return True
+
     def GetGitUserFromAccuRevUser(self, accurevUsername):
         if accurevUsername is not None:
             for usermap in self.config.usermaps:
@@ -570,10 +908,71 @@ class AccuRev2Git(object):
 
         return usertime, tz
 
-    def GetFirstTransaction(self, depot, streamName, startTransaction=None, endTransaction=None, useCache=False):
+    # Returns the git ref in which the mkstream transactions of all of the streams in the given depot are cached.
+    def GetMkstreamsRef(self, depot):
+        d = self.GetDepot(depot)
+        if d is None:
+            return None
+        return u'{refsNS}cache/depots/{depotNumber}/mkstreams'.format(refsNS=AccuRev2Git.gitRefsNamespace, depotNumber=d.number)
+
+    # Gets the mkstream transaction number for the given stream or None if it couldn't be found. The mkstream transactions for all of the streams
+    # in the depot are resolved at once, by accurev.ext.get_mkstream_transactions(), and stored in a hidden ref so that they only need to be resolved
+    # again when a stream we don't know about is requested (and then at most once per run). The accurev queries are run without holding the
+    # refUpdateLock, the other retrieval workers that need the map wait for the resolution to finish instead.
+    def GetMkstreamTransactionNumber(self, depot, streamNumber, useCache=False):
+        mkstreamsRef = self.GetMkstreamsRef(depot)
+        if mkstreamsRef is None or streamNumber is None:
+            return None
+
+        key = str(streamNumber) # JSON object keys are always strings.
+        resolvedEvent, isResolver = None, False
+        with self.refUpdateLock:
+            mkstreams = self.mkstreamsMaps.get(mkstreamsRef)
+            if mkstreams is None:
+                mkstreams = {}
+                mkstreamsText = self.ReadFileRef(ref=mkstreamsRef)
+                if mkstreamsText is not None and len(mkstreamsText) > 0:
+                    mkstreams = json.loads(mkstreamsText)
+                self.mkstreamsMaps[mkstreamsRef] = mkstreams
+
+            if key not in mkstreams:
+                resolvedEvent = self.resolvedMkstreamsRefs.get(mkstreamsRef)
+                if resolvedEvent is None:
+                    resolvedEvent = threading.Event()
+                    self.resolvedMkstreamsRefs[mkstreamsRef] = resolvedEvent
+                    isResolver = True
+
+        if isResolver:
+            try:
+                logger.info("Resolving the mkstream transactions for all streams in depot {d}.".format(d=depot))
+                trMap = accurev.ext.get_mkstream_transactions(depot=depot, useCache=useCache, maxWorkers=self.config.accurev.histWorkers)
+                if trMap is None:
+                    logger.warning("Failed to resolve the mkstream transactions for depot {d}.".format(d=depot))
+                else:
+                    with self.refUpdateLock:
+                        for number, tr in trMap.items():
+                            mkstreams[str(number)] = tr.id
+                        self.WriteFileRef(ref=mkstreamsRef, text=json.dumps(mkstreams))
+                    logger.info("Resolved {n} mkstream transactions for depot {d}, stored in {r}.".format(n=len(trMap), d=depot, r=mkstreamsRef))
+            finally:
+                resolvedEvent.set()
+        elif resolvedEvent is not None:
+            resolvedEvent.wait()
+
+        with self.refUpdateLock:
+            return mkstreams.get(key)
+
+    def GetFirstTransaction(self, depot, streamName, startTransaction=None, endTransaction=None, useCache=False, streamNumber=None):
         invalidRetVal = (None, None)
         # Get the stream creation transaction (mkstream). Note: The first stream in the depot doesn't have an mkstream transaction.
-        tr = accurev.ext.get_mkstream_transaction(stream=streamName, depot=depot, useCache=useCache)
+        tr = None
+        mkstreamTrId = self.GetMkstreamTransactionNumber(depot=depot, streamNumber=streamNumber, useCache=useCache)
+        if mkstreamTrId is not None:
+            mkstreamHist, mkstreamHistXml = self.TryHist(depot=depot, timeSpec=mkstreamTrId)
+            if mkstreamHist is not None and len(mkstreamHist.transactions) > 0:
+                tr = mkstreamHist.transactions[0]
+        if tr is None:
+            tr = accurev.ext.get_mkstream_transaction(stream=streamName, depot=depot, useCache=useCache)
         if tr is None:
             logger.warning("Failed to find the mkstream transaction for stream {s}. Trying to get first transaction.".format(s=streamName))
             hist, histXml = self.TryHist(depot=depot, timeSpec="highest-1", streamName=streamName)
@@ -622,32 +1021,32 @@ class AccuRev2Git(object):
             time.sleep(AccuRev2Git.commandFailureSleepSeconds)
         return rv
 
-    def GetLastCommitHash(self, branchName=None, ref=None, retry=True):
-        cmd = []
-        commitHash = None
-        if ref is not None:
-            cmd = [ u'git', u'show-ref', u'--hash', ref ]
-        else:
-            cmd = [u'git', u'log', u'-1', u'--format=format:%H']
-            if branchName is not None:
-                cmd.append(branchName)
+    # Returns the hash of the commit that the ref points to or, if no ref is given, of the last commit on the branch (HEAD by default). An annotated
+    # tag is peeled to its commit. The lookup goes through the persistent `git cat-file --batch-check` process.
+    def GetLastCommitHash(self, branchName=None, ref=None):
+        objName = ref if ref is not None else branchName if branchName is not None else 'HEAD'
+        objName = '{0}^{{commit}}'.format(objName)
 
-        commitHash = self.TryGitCommand(cmd=cmd, retry=retry)
+        commitHash = None
+        objInfo = self.gitRepo.catFile.info(objName)
+        if objInfo is not None:
+            commitHash = objInfo[0]
 
         if commitHash is None:
-            logger.error("Failed to retrieve last git commit hash. Command `{0}` failed.".format(' '.join(cmd)))
+            logger.error("Failed to retrieve last git commit hash. `git cat-file --batch-check` couldn't resolve `{0}`.".format(objName))
 
         return commitHash
 
     def GetTreeFromRef(self, ref):
+        objName = '{0}^{{tree}}'.format(ref if ref is not None else 'HEAD')
+
         treeHash = None
-        cmd = [u'git', u'log', u'-1', u'--format=format:%T']
-        if ref is not None:
-            cmd.append(ref)
-        treeHash = self.TryGitCommand(cmd=cmd)
+        objInfo = self.gitRepo.catFile.info(objName)
+        if objInfo is not None:
+            treeHash = objInfo[0]
 
         if treeHash is None:
-            logger.error("Failed to retrieve tree hash. Command `{0}` failed.".format(' '.join(cmd)))
+            logger.error("Failed to retrieve tree hash. `git cat-file --batch-check` couldn't resolve `{0}`.".format(objName))
 
         return treeHash
 
@@ -657,7 +1056,9 @@ class AccuRev2Git(object):
             # so at least raise a warning for the user.
 
             # If we were asked to update a ref, not updating it is considered a failure to commit.
-            if self.gitRepo.raw_cmd([ u'git', u'update-ref', ref, commitHash ]) is None:
+            with self.refUpdateLock:
+                updateRefResult = self.gitRepo.raw_cmd([ u'git', u'update-ref', ref, commitHash ])
+            if updateRefResult is None:
                 logger.error( "Failed to update ref {ref} to commit {hash}".format(ref=ref, hash=commitHash) )
                 return False
             if checkout and ref != 'HEAD' and self.gitRepo.checkout(branchName=ref) is None: # no point in checking out HEAD if that's what we've updated!
@@ -704,7 +1105,22 @@ class AccuRev2Git(object):
             if len(status.staged) != 0 or len(status.changed) != 0 or len(status.untracked) != 0:
                 raise Exception("Invalid initial state! There are changes in the tracking repository. Staged {staged}, changed {changed}, untracked {untracked}.".format(staged=status.staged, changed=status.changed, untracked=status.untracked))
 
-    def Commit(self, transaction=None, allowEmptyCommit=False, messageOverride=None, parents=None, treeHash=None, ref=None, checkout=True, authorIsCommitter=None):
+    # Returns the (name, email, date, timezone) tuples of the author and the committer for the commit of the given transaction.
+    def GetCommitIdentities(self, transaction, authorIsCommitter):
+        authorName, authorEmail, authorDate, authorTimezone = None, None, None, None
+        if transaction is not None:
+            authorName, authorEmail = self.GetGitUserFromAccuRevUser(transaction.user)
+            authorDate, authorTimezone = self.GetGitDatetime(accurevUsername=transaction.user, accurevDatetime=transaction.time)
+
+        # If the author-is-committer flag is set to true make the committer the same as the author.
+        committerName, committerEmail, committerDate, committerTimezone = None, None, None, None
+        if authorIsCommitter:
+            committerName, committerEmail, committerDate, committerTimezone = authorName, authorEmail, authorDate, authorTimezone
+
+        return (authorName, authorEmail, authorDate, authorTimezone), (committerName, committerEmail, committerDate, committerTimezone)
+
+    # If the indexPathList is given only the index entries for those paths are updated from the worktree, see UpdateIndexForPaths(), otherwise the whole worktree is added.
+    def Commit(self, transaction=None, allowEmptyCommit=False, messageOverride=None, parents=None, treeHash=None, ref=None, checkout=True, authorIsCommitter=None, indexPathList=None):
         usePlumbing = (parents is not None or treeHash is not None)
 
         if authorIsCommitter is None:
@@ -717,7 +1133,10 @@ class AccuRev2Git(object):
             forTrMessage = ' for{0}'.format(trMessage)
 
         # Begin the commit processing.
-        if treeHash is None:
+        if treeHash is None and indexPathList is not None and not self.UpdateIndexForPaths(indexPathList):
+            logger.warning("Failed to update the index incrementally{0}. Falling back to adding the whole worktree.".format(forTrMessage))
+            indexPathList = None
+        if treeHash is None and indexPathList is None:
             self.PreserveEmptyDirs()
 
             # Add all of the files to the index
@@ -752,15 +1171,7 @@ class AccuRev2Git(object):
             return None
 
         # Get the author's and committer's name, email and timezone information.
-        authorName, authorEmail, authorDate, authorTimezone = None, None, None, None
-        if transaction is not None:
-            authorName, authorEmail = self.GetGitUserFromAccuRevUser(transaction.user)
-            authorDate, authorTimezone = self.GetGitDatetime(accurevUsername=transaction.user, accurevDatetime=transaction.time)
-
-        # If the author-is-committer flag is set to true make the committer the same as the author.
-        committerName, committerEmail, committerDate, committerTimezone = None, None, None, None
-        if authorIsCommitter:
-            committerName, committerEmail, committerDate, committerTimezone = authorName, authorEmail, authorDate, authorTimezone
+        (authorName, authorEmail, authorDate, authorTimezone), (committerName, committerEmail, committerDate, committerTimezone) = self.GetCommitIdentities(transaction=transaction, authorIsCommitter=authorIsCommitter)
 
         lastCommitHash = None
         if parents is None:
@@ -818,6 +1229,73 @@ class AccuRev2Git(object):
 
         return commitHash
 
+    # Returns the git fast-import process used to write the hidden refs, or None if the fast-import option isn't enabled.
+    def GetFastImport(self):
+        if not self.config.git.fastImport:
+            return None
+        if self.fastImport is None:
+            self.fastImport = git.repo.fast_import(self.gitRepo)
+        return self.fastImport
+
+    # Updates the refs written by git fast-import so far. Does nothing when the fast-import option isn't enabled.
+    def FastImportCheckpoint(self):
+        if self.fastImport is not None:
+            self.fastImport.checkpoint()
+
+    def CloseFastImport(self):
+        if self.fastImport is not None:
+            fastImport, self.fastImport = self.fastImport, None
+            if not fastImport.close():
+                raise Exception("git fast-import failed! The refs it was writing were left at their last checkpoint.")
+
+    # The git fast-import equivalent of Commit() with plumbing. The commit's tree is the first parent's tree, modified by the deleteAll, deleteList
+    # and fileList arguments (see git.repo.fast_import.commit()). Returns the commit hash.
+    def FastImportCommit(self, transaction, ref, parents, messageOverride=None, fileList=[], deleteList=[], deleteAll=False, authorIsCommitter=None):
+        fastImport = self.GetFastImport()
+
+        if authorIsCommitter is None:
+            authorIsCommitter = self.config.git.authorIsCommitter
+        (authorName, authorEmail, authorDate, authorTimezone), (committerName, committerEmail, committerDate, committerTimezone) = self.GetCommitIdentities(transaction=transaction, authorIsCommitter=authorIsCommitter)
+
+        message = messageOverride
+        if message is None and transaction is not None:
+            message = transaction.comment
+        if message is None or len(message) == 0:
+            message = ' ' # See Commit() for why the message is never left empty.
+
+        mark = fastImport.commit(ref=ref, message=message, parents=parents, fileList=fileList, deleteList=deleteList, deleteAll=deleteAll, author_name=authorName, author_email=authorEmail, author_date=authorDate, author_tz=authorTimezone, committer_name=committerName, committer_email=committerEmail, committer_date=committerDate, committer_tz=committerTimezone)
+        commitHash = fastImport.get_mark(mark)
+
+        # Checkpoint periodically so that an interruption doesn't lose too much of the work.
+        if fastImport.lastMark % AccuRev2Git.fastImportCheckpointInterval == 0:
+            fastImport.checkpoint()
+
+        return commitHash
+
+    # Returns the (mode, data, path) list of the files in the worktree, under the given repo relative paths or everywhere if relPathList is None,
+    # with the modes that `git add` would have recorded for them. See ListWorktreeFiles() for preserveEmptyDirs. The file contents aren't read here,
+    # the data is a git.repo.fast_import.file_data which git fast-import is fed from, a file at a time, so a whole stream is never held in memory.
+    def GetFastImportFileList(self, relPathList=None, preserveEmptyDirs=False):
+        fileList = []
+        for relPath in self.ListWorktreeFiles(relPathList=relPathList, preserveEmptyDirs=preserveEmptyDirs):
+            path = os.path.join(self.gitRepo.path, relPath)
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                fileList.append( ('120000', os.readlink(path), relPath) )
+            else:
+                isExecutable = (os.name != 'nt' and (st.st_mode & stat.S_IXUSR) != 0)
+                fileList.append( ('100755' if isExecutable else '100644', git.repo.fast_import.file_data(path), relPath) )
+        return fileList
+
+    # Points a detached HEAD, and the index, at a commit written by git fast-import from the current worktree so that the repository looks like
+    # the commit was made by Commit().
+    def SyncHeadWithFastImport(self, commitHash):
+        self.FastImportCheckpoint()
+        if self.gitRepo.raw_cmd([ u'git', u'update-ref', u'--no-deref', u'HEAD', commitHash ]) is None or self.gitRepo.raw_cmd([ u'git', u'read-tree', commitHash ]) is None:
+            logger.error("Failed to point HEAD at the fast-import commit {h}. Error:\n{err}".format(h=commitHash, err=self.gitRepo.lastStderr))
+            return False
+        return True
+
     def GetStreamMap(self, printInfo=False):
         streamMap = self.config.accurev.streamMap
 
@@ -846,52 +1324,98 @@ class AccuRev2Git(object):
 
         return streamMap
 
+    # Yields the (trNumber, diff, diffXml) tuple for each of the transactions in trNumberList, in order, where the diff is from the trNumber back to
+    # the startTrNumber (i.e. `-t <trNumber>-<startTrNumber>`), the direction in which the info commits have always recorded their diff.xml. The
+    # diffs are run ahead of the caller in windows of concurrent `accurev diff` commands, which start with a single diff and double in size, up to
+    # probeWindow, with every window so that a stream that changes often doesn't waste many diffs. When the caller stops early
+    # the diffs already running are waited for so that their results end up in the command cache, if it is enabled, for the next run.
+    def IterProbeDiffs(self, streamName, startTrNumber, trNumberList):
+        probeWindow = max(1, self.config.accurev.probeWindow)
+        if probeWindow == 1:
+            for trNumber in trNumberList:
+                diff, diffXml = self.TryDiff(streamName=streamName, firstTrNumber=trNumber, secondTrNumber=startTrNumber)
+                yield (trNumber, diff, diffXml)
+            return
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=probeWindow, thread_name_prefix=threading.current_thread().name)
+        try:
+            index, windowSize = 0, 1
+            while index < len(trNumberList):
+                window = trNumberList[index:index + windowSize]
+                futureList = [ executor.submit(self.TryDiff, streamName=streamName, firstTrNumber=trNumber, secondTrNumber=startTrNumber) for trNumber in window ]
+                for trNumber, future in zip(window, futureList):
+                    diff, diffXml = future.result()
+                    yield (trNumber, diff, diffXml)
+                index += len(window)
+                windowSize = min(windowSize * 2, probeWindow)
+        finally:
+            executor.shutdown(wait=True)
+
+    # Returns the (nextTr, diff, diffXml) tuple where the diff is from the nextTr, the next transaction that changed the stream, back to the
+    # startTrNumber, or (None, None, None) on failure. Since the stream is unchanged until the transaction before the nextTr this diff is also the
+    # `-t <nextTr>-<nextTr - 1>` diff of the nextTr transaction alone, which is what is recorded in the info commit's diff.xml.
     def FindNextChangeTransaction(self, streamName, startTrNumber, endTrNumber, deepHist=None):
-        # Iterate over transactions in order using accurev diff -a -i -v streamName -V streamName -t <lastProcessed>-<current iterator>
+        # Iterate over transactions in order using accurev diff -a -i -v streamName -V streamName -t <current iterator>-<lastProcessed>
         if self.config.method == "diff":
-            nextTr = startTrNumber + 1
-            diff, diffXml = self.TryDiff(streamName=streamName, firstTrNumber=startTrNumber, secondTrNumber=nextTr)
-            if diff is None:
-                return (None, None)
-    
             # Note: This is likely to be a hot path. However, it cannot be optimized since a revert of a transaction would not show up in the diff even though the
             #       state of the stream was changed during that period in time. Hence to be correct we must iterate over the transactions one by one unless we have
             #       explicit knowlege of all the transactions which could affect us via some sort of deep history option...
-            while nextTr <= endTrNumber and len(diff.elements) == 0:
-                nextTr += 1
-                diff, diffXml = self.TryDiff(streamName=streamName, firstTrNumber=startTrNumber, secondTrNumber=nextTr)
-                if diff is None:
-                    return (None, None)
+            #       The diffs of the following transactions can still be run concurrently (see IterProbeDiffs()) as long as the first non-empty one, in
+            #       order, is the one that is used. The last transaction probed is the one after the endTrNumber, as it always was.
+            probeIter = self.IterProbeDiffs(streamName=streamName, startTrNumber=startTrNumber, trNumberList=range(startTrNumber + 1, max(startTrNumber + 2, endTrNumber + 2)))
+            try:
+                for nextTr, diff, diffXml in probeIter:
+                    if diff is None:
+                        return (None, None, None)
+                    elif len(diff.elements) > 0:
+                        break
+            finally:
+                probeIter.close()
         
             logger.debug("FindNextChangeTransaction diff: {0}".format(nextTr))
-            return (nextTr, diff)
+            return (nextTr, diff, diffXml)
         elif self.config.method == "deep-hist":
             if deepHist is None:
                 raise Exception("Script error! deepHist argument cannot be none when running a deep-hist method.")
             # Find the next transaction
-            for tr in deepHist:
-                if tr.id > startTrNumber:
-                    if tr.Type in ignored_transaction_types:
-                        logger.debug("Ignoring transaction #{id} - {Type} (transaction type is in ignored_transaction_types list)".format(id=tr.id, Type=tr.Type))
-                    else:
-                        diff, diffXml = self.TryDiff(streamName=streamName, firstTrNumber=startTrNumber, secondTrNumber=tr.id)
-                        if diff is None:
-                            return (None, None)
-                        elif len(diff.elements) > 0:
-                            logger.debug("FindNextChangeTransaction deep-hist: {0}".format(tr.id))
-                            return (tr.id, diff)
+            candidateList = [ tr.id for tr in deepHist if tr.id > startTrNumber and tr.Type not in ignored_transaction_types ]
+            probeIter = self.IterProbeDiffs(streamName=streamName, startTrNumber=startTrNumber, trNumberList=candidateList)
+            try:
+                for tr in deepHist:
+                    if tr.id > startTrNumber:
+                        if tr.Type in ignored_transaction_types:
+                            logger.debug("Ignoring transaction #{id} - {Type} (transaction type is in ignored_transaction_types list)".format(id=tr.id, Type=tr.Type))
                         else:
-                            logger.debug("FindNextChangeTransaction deep-hist skipping: {0}, diff was empty...".format(tr.id))
+                            trNumber, diff, diffXml = next(probeIter)
+                            if diff is None:
+                                return (None, None, None)
+                            elif len(diff.elements) > 0:
+                                logger.debug("FindNextChangeTransaction deep-hist: {0}".format(tr.id))
+                                return (tr.id, diff, diffXml)
+                            else:
+                                logger.debug("FindNextChangeTransaction deep-hist skipping: {0}, diff was empty...".format(tr.id))
+            finally:
+                probeIter.close()
 
-            diff, diffXml = self.TryDiff(streamName=streamName, firstTrNumber=startTrNumber, secondTrNumber=endTrNumber)
-            return (endTrNumber + 1, diff) # The end transaction number is inclusive. We need to return the one after it.
+            diff, diffXml = self.TryDiff(streamName=streamName, firstTrNumber=endTrNumber, secondTrNumber=startTrNumber)
+            return (endTrNumber + 1, diff, diffXml) # The end transaction number is inclusive. We need to return the one after it.
         elif self.config.method == "pop":
             logger.debug("FindNextChangeTransaction pop: {0}".format(startTrNumber + 1))
-            return (startTrNumber + 1, None)
+            return (startTrNumber + 1, None, None)
         else:
             logger.error("Method is unrecognized, allowed values are 'pop', 'diff' and 'deep-hist'")
             raise Exception("Invalid configuration, method unrecognized!")
 
+    # Converts a depot relative element path (e.g. /./dir/file) into an absolute path in the git repo.
+    def DepotPathToRepoPath(self, name):
+        if name.startswith('\\.\\') or name.startswith('/./'):
+            # Replace the accurev depot relative path start with a normal relative path.
+            name = name[3:]
+        if os.path.isabs(name):
+            # For os.path.join() to work we need a non absolute path so turn the absolute path (minus any drive letter or UNC path part) into a relative path w.r.t. the git repo.
+            name = os.path.splitdrive(name)[1][1:]
+        return os.path.abspath(os.path.join(self.gitRepo.path, name))
+
     def DeleteDiffItemsFromRepo(self, diff):
         # Delete all of the files which are even mentioned in the diff so that we can do a quick populate (wouth the overwrite option)
         deletedPathList = []
@@ -899,14 +1423,7 @@ class AccuRev2Git(object):
             for change in element.changes:
                 for stream in [ change.stream1, change.stream2 ]:
                     if stream is not None and stream.name is not None:
-                        name = stream.name
-                        if name.startswith('\\.\\') or name.startswith('/./'):
-                            # Replace the accurev depot relative path start with a normal relative path.
-                            name = name[3:]
-                        if os.path.isabs(name):
-                            # For os.path.join() to work we need a non absolute path so turn the absolute path (minus any drive letter or UNC path part) into a relative path w.r.t. the git repo.
-                            name = os.path.splitdrive(name)[1][1:]
-                        path = os.path.abspath(os.path.join(self.gitRepo.path, name))
+                        path = self.DepotPathToRepoPath(stream.name)
 
                         # Ensure we restrict the deletion to the git repository and that we don't delete the git repository itself.
                         doClearAll = False
@@ -934,15 +1451,16 @@ class AccuRev2Git(object):
 
         return deletedPathList
 
-    def TryDiff(self, streamName, firstTrNumber, secondTrNumber):
+    # Diffs the stream at firstTrNumber against the otherStreamName stream (the same stream by default) at secondTrNumber.
+    def TryDiff(self, streamName, firstTrNumber, secondTrNumber, otherStreamName=None):
         for i in range(0, AccuRev2Git.commandFailureRetryCount):
-            diffXml = accurev.raw.diff(all=True, informationOnly=True, verSpec1=streamName, verSpec2=streamName, transactionRange="{0}-{1}".format(firstTrNumber, secondTrNumber), isXmlOutput=True, useCache=self.config.accurev.UseCommandCache())
+            diffXml = accurev.raw.diff(all=True, informationOnly=True, verSpec1=streamName, verSpec2=(streamName if otherStreamName is None else otherStreamName), transactionRange="{0}-{1}".format(firstTrNumber, secondTrNumber), isXmlOutput=True, useCache=self.config.accurev.UseCommandCache())
             if diffXml is not None:
                 diff = accurev.obj.Diff.fromxmlstring(diffXml)
                 if diff is not None:
                     break
         if diff is None:
-            logger.error( "accurev diff failed! stream: {0} time-spec: {1}-{2}".format(streamName, firstTrNumber, secondTrNumber) )
+            logger.error( "accurev diff failed! stream: {0} time-spec: {1}-{2}{3}".format(streamName, firstTrNumber, secondTrNumber, "" if otherStreamName is None else " other stream: {0}".format(otherStreamName)) )
         return diff, diffXml
 
     def TryHist(self, depot, timeSpec, streamName=None, transactionKind=None):
@@ -955,11 +1473,70 @@ class AccuRev2Git(object):
                     break
         return trHist, trHistXml
 
+    # Returns the list of transactions for the depot wide time-spec, fetched in chunks by accurev.ext.chunked_hist() with up to histWorkers concurrent
+    # `accurev hist` commands, or None on failure.
+    def TryChunkedHist(self, depot, timeSpec, transactionKind=None):
+        for i in range(0, AccuRev2Git.commandFailureRetryCount):
+            try:
+                return list(accurev.ext.chunked_hist(depot=depot, timeSpec=timeSpec, transactionKind=transactionKind, maxWorkers=self.config.accurev.histWorkers, useCache=self.config.accurev.UseCommandCache()))
+            except Exception as e:
+                logger.warning("accurev hist -p {0} -t {1} failed. Err: {2}".format(depot, timeSpec, e))
+        return None
+
     def TryPop(self, streamName, transaction, overwrite=False):
+        return self.TryPopWithRecovery(streamName=streamName, transaction=transaction, location=self.gitRepo.path, pathList=[ '.' ], overwrite=overwrite, isRecursive=True)
+
+    # Converts a path from the pathList of a populate into the given location, or from the locations in its output, into an absolute local path.
+    def GetPopLocalPath(self, location, path):
+        if path == '.':
+            path = location
+        elif path.startswith('\\.\\') or path.startswith('/./'):
+            path = os.path.join(location, path[3:])
+        elif not os.path.isabs(path):
+            path = os.path.join(location, path)
+        return os.path.normcase(os.path.abspath(path))
+
+    # Deletes the files and symbolic links under the pathList of a failed recursive populate into the location that its output doesn't list as
+    # written, since they are either stale or were only partially written. Returns the number of deleted files.
+    def DeleteUnpopulatedFiles(self, location, pathList, populatedPathSet):
+        deletedCount = 0
+        localPathList = [ self.GetPopLocalPath(location, path) for path in pathList ]
+        filePathList = [ path for path in localPathList if os.path.lexists(path) and (os.path.islink(path) or not os.path.isdir(path)) ]
+        for dirPath, dirEntries, fileEntries in self.WalkWorktree(pathList=localPathList):
+            filePathList.extend([ entry.path for entry in fileEntries ])
+        for path in filePathList:
+            if os.path.normcase(os.path.abspath(path)) not in populatedPathSet and git.GetGitDirPrefix(path) is None:
+                if not self.DeletePath(path):
+                    raise Exception("Failed to delete '{0}'".format(path))
+                deletedCount += 1
+        return deletedCount
+
+    # Populates the elements in the pathList (depot relative paths, or '.' for the whole stream) at the given transaction into the location, retrying
+    # up to commandFailureRetryCount times. A failed `accurev pop` has usually written most of the elements, which its XML output lists, so they
+    # aren't requested again: a non-recursive retry only lists the elements that are still missing, and a recursive retry without the overwrite
+    # option already skips the files that exist. When the populate started with the overwrite option every failed recursive attempt is followed by
+    # the deletion of the files under the pathList that none of the attempts have written and the retries drop the overwrite option so that they
+    # too only fetch what is missing.
+    def TryPopWithRecovery(self, streamName, transaction, location, pathList, overwrite=False, isRecursive=True):
+        popResult = None
+        startedWithOverwrite = overwrite
+        populatedPathSet = set()
         for i in range(0, AccuRev2Git.commandFailureRetryCount):
-            popResult = accurev.pop(verSpec=streamName, location=self.gitRepo.path, isRecursive=True, isOverride=overwrite, timeSpec=transaction.id, elementList='.')
+            if pathList == [ '.' ]:
+                popResult = accurev.pop(verSpec=streamName, location=location, isRecursive=isRecursive, isOverride=overwrite, timeSpec=transaction.id, elementList='.')
+            else:
+                with tempfile.NamedTemporaryFile(mode='w+', prefix='ac2git_pop_list_', encoding='utf-8', delete=False) as listFile:
+                    listFilePath = listFile.name
+                    for path in pathList:
+                        listFile.write('{0}\n'.format(path))
+                try:
+                    popResult = accurev.pop(verSpec=streamName, location=location, isRecursive=isRecursive, isOverride=overwrite, timeSpec=transaction.id, listFile=listFilePath)
+                finally:
+                    os.remove(listFilePath)
             if popResult:
                 break
+            elif popResult is None:
+                logger.error("accurev pop failed, its output couldn't be parsed.")
             else:
                 logger.error("accurev pop failed:")
                 for message in popResult.messages:
@@ -967,9 +1544,213 @@ class AccuRev2Git(object):
                         logger.error("  {0}".format(message.text))
                     else:
                         logger.info("  {0}".format(message.text))
+                populatedPathSet.update([ self.GetPopLocalPath(location, element.location) for element in popResult.elements if element.location is not None ])
+
+            if isRecursive:
+                if startedWithOverwrite:
+                    deletedCount = self.DeleteUnpopulatedFiles(location=location, pathList=pathList, populatedPathSet=populatedPathSet)
+                    overwrite = False
+                    logger.info("Retrying the pop without overwriting the {0} elements that were written. Deleted {1} files that weren't.".format(len(populatedPathSet), deletedCount))
+            else:
+                missingPathList = [ path for path in pathList if self.GetPopLocalPath(location, path) not in populatedPathSet ]
+                if len(missingPathList) > 0:
+                    logger.info("Retrying the pop of the {0} of {1} elements that weren't written.".format(len(missingPathList), len(pathList)))
+                    pathList = missingPathList
         
         return popResult
 
+    # Returns 1 or 2 for the side of the diff's changes (change.stream1 or change.stream2) that describes the stream after the hist's transaction,
+    # or None if it can't be told. Which side accurev reports as Stream1 or Stream2 isn't documented so, rather than relying on the order of the
+    # transactions in the diff's time-spec, the side is the one whose element versions are the versions that the transaction made, as listed in
+    # its hist.xml. None is returned if neither side, or both, match (e.g. a chstream transaction, which lists no versions).
+    def GetDiffPostTransactionSide(self, diff, hist):
+        if diff is None or hist is None or len(hist.transactions) == 0 or hist.transactions[0].versions is None:
+            return None
+        trVersionSet = set()
+        for version in hist.transactions[0].versions:
+            for v in [ version.real, version.virtual, version.realNamedVersion, version.virtualNamedVersion ]:
+                if version.eid is not None and v is not None:
+                    trVersionSet.add((version.eid, repr(v)))
+        sideSet = set()
+        for element in diff.elements:
+            for change in element.changes:
+                for side, stream in [ (1, change.stream1), (2, change.stream2) ]:
+                    if stream is not None and stream.eid is not None and stream.version is not None and (stream.eid, repr(stream.version)) in trVersionSet:
+                        sideSet.add(side)
+        if len(sideSet) == 1:
+            return sideSet.pop()
+        return None
+
+    # Returns the list of depot relative element paths (e.g. /./dir/file) mentioned by either side of the diff. If the hist is given only the names
+    # that the elements have after its transaction are listed, or None is returned if that side can't be told (see GetDiffPostTransactionSide()).
+    def GetDiffElementPathList(self, diff, hist=None):
+        sideList = [ 1, 2 ]
+        if hist is not None:
+            side = self.GetDiffPostTransactionSide(diff=diff, hist=hist)
+            if side is None:
+                return None
+            sideList = [ side ]
+        pathList, pathSet = [], set()
+        for element in diff.elements:
+            for change in element.changes:
+                for side in sideList:
+                    stream = change.stream1 if side == 1 else change.stream2
+                    if stream is not None and stream.name is not None and stream.name not in pathSet:
+                        pathSet.add(stream.name)
+                        pathList.append(stream.name)
+        return pathList
+
+    # Populates only the elements in the pathList, recursively by default, at the given transaction into the location using `accurev pop -l <list-file>`.
+    def TryPopList(self, streamName, transaction, location, pathList, overwrite=False, isRecursive=True):
+        return self.TryPopWithRecovery(streamName=streamName, transaction=transaction, location=location, pathList=pathList, overwrite=overwrite, isRecursive=isRecursive)
+
+    # Returns the map from the names of the top level directories in the given commit's tree to the number of files under each, or None if the tree
+    # couldn't be listed.
+    def GetTopLevelDirSizes(self, ref):
+        output = self.gitRepo.raw_cmd([ u'git', u'ls-tree', u'-r', u'-z', u'--name-only', ref ])
+        if output is None:
+            return None
+        dirSizes = OrderedDict()
+        for path in output.split('\0'):
+            if '/' in path:
+                name = path.split('/', 1)[0]
+                dirSizes[name] = dirSizes.get(name, 0) + 1
+        return dirSizes
+
+    # Populates the whole stream, like TryPop() with the overwrite option, but split into populateWorkers concurrent `accurev pop -l` commands. Each
+    # one populates a group of the top level directories in the layoutRef commit (an earlier state of the stream), the groups being balanced by the
+    # number of files in them. A final `accurev pop` without the overwrite option then populates whatever the groups have missed, such as the top
+    # level files and any directories that weren't in the layoutRef, and doubles as the completeness check since it fails if any element couldn't
+    # be populated. Falls back to TryPop() if the layout isn't known.
+    def TryPopSharded(self, streamName, transaction, layoutRef=None):
+        workerCount = self.config.accurev.populateWorkers
+        dirSizes = self.GetTopLevelDirSizes(ref=layoutRef) if workerCount > 1 and layoutRef is not None else None
+        if dirSizes is None or len(dirSizes) < 2:
+            return self.TryPop(streamName=streamName, transaction=transaction, overwrite=True)
+
+        shardList = [ [] for i in range(0, min(workerCount, len(dirSizes))) ]
+        shardSizes = [ 0 ] * len(shardList)
+        for name, size in sorted(dirSizes.items(), key=lambda item: item[1], reverse=True):
+            i = shardSizes.index(min(shardSizes))
+            shardList[i].append('/./{0}'.format(name))
+            shardSizes[i] += size
+
+        logger.debug( "{0} populating tr. {1} in {2} shards of {3} files.".format(streamName, transaction.id, len(shardList), shardSizes) )
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(shardList), thread_name_prefix=threading.current_thread().name) as executor:
+            futureList = [ executor.submit(self.TryPopList, streamName=streamName, transaction=transaction, location=self.gitRepo.path, pathList=shard, overwrite=True) for shard in shardList ]
+            failedCount = len([ future for future in futureList if not future.result() ])
+        if failedCount > 0:
+            logger.warning( "{0} failed to populate {1} of the {2} shards of tr. {3}. They will be completed by populating the whole stream.".format(streamName, failedCount, len(shardList), transaction.id) )
+
+        popResult = self.TryPop(streamName=streamName, transaction=transaction, overwrite=False)
+        if popResult:
+            logger.info( "{0} populated tr. {1} in {2} shards.".format(streamName, transaction.id, len(shardList)) )
+        return popResult
+
+    # Returns the (fileList, dirList) tuple of the depot relative paths that need to be populated, non-recursively and recursively respectively, to
+    # bring the worktree up to date once DeleteDiffItemsFromRepo() and DeleteEmptyDirs() have removed what the diff mentions. The parentDirList
+    # directories are listed too since they were deleted if they were left empty. The paths in the excludePathList are already up to date.
+    # Returns None if the diff can't be relied upon, including when the side of the diff that describes the stream after the hist's transaction can't
+    # be told (see GetDiffPostTransactionSide()), in which case the whole stream should be populated.
+    def GetDiffPopList(self, diff, hist, parentDirList, excludePathList=None):
+        side = self.GetDiffPostTransactionSide(diff=diff, hist=hist)
+        if side is None:
+            return None
+        excludePathSet = set([ os.path.normcase(os.path.abspath(path)) for path in excludePathList ]) if excludePathList is not None else set()
+        fileMap, dirMap = OrderedDict(), OrderedDict()
+        for element in diff.elements:
+            for change in element.changes:
+                postStream = change.stream1 if side == 1 else change.stream2
+                if postStream is None or postStream.name is None or (change.what is not None and 'defunct' in change.what):
+                    continue
+                path = self.DepotPathToRepoPath(postStream.name)
+                relPath = os.path.relpath(path, self.gitRepo.path)
+                if relPath.startswith('..') or relPath == '.':
+                    return None
+                elif relPath.split(os.sep)[0] == '.git' or os.path.normcase(path) in excludePathSet:
+                    continue
+                # Directories have to be populated recursively since DeleteDiffItemsFromRepo() deleted their contents.
+                if postStream.isDir is None or postStream.isDir:
+                    dirMap[postStream.name] = True
+                else:
+                    fileMap[postStream.name] = True
+        for relPath in self.GetRepoRelPathList(parentDirList):
+            depotPath = '/./{0}'.format(relPath)
+            if depotPath not in dirMap:
+                fileMap[depotPath] = True
+        return (list(fileMap.keys()), list(dirMap.keys()))
+
+    # Populates only the elements changed by the diff, see GetDiffPopList(), instead of the whole stream so that neither accurev nor the server
+    # have to walk the entire tree. Falls back to TryPop() if the diff can't be relied upon or the targeted populate fails.
+    def TryPopDiff(self, streamName, transaction, diff, hist, parentDirList, excludePathList=None):
+        popList = self.GetDiffPopList(diff=diff, hist=hist, parentDirList=parentDirList, excludePathList=excludePathList)
+        if popList is not None:
+            fileList, dirList = popList
+            popResult = True
+            if len(fileList) > 0:
+                popResult = self.TryPopList(streamName=streamName, transaction=transaction, location=self.gitRepo.path, pathList=fileList, isRecursive=False)
+            if popResult and len(dirList) > 0:
+                popResult = self.TryPopList(streamName=streamName, transaction=transaction, location=self.gitRepo.path, pathList=dirList, isRecursive=True)
+            if popResult:
+                logger.debug( "{0} populated {1} files and {2} directories for tr. {3}".format(streamName, len(fileList), len(dirList), transaction.id) )
+                return popResult
+            logger.warning( "Populating the changed elements of tr. {0} failed. Populating the whole stream instead...".format(transaction.id) )
+        return self.TryPop(streamName=streamName, transaction=transaction, overwrite=False)
+
+    # Starts populating the elements changed by the transaction recorded in the stateHash into a new staging directory under the stagingRootPath.
+    # Returns a (future, stagingPath) tuple, where the future's result is True if the populate succeeded, or None if the transaction can't be prefetched.
+    def StartPrefetchPop(self, executor, stream, stateHash, stagingRootPath):
+        diffXml, diff = self.GetDiffInfo(ref=stateHash)
+        if diff is None:
+            return None
+        histXml, hist = self.GetHistInfo(ref=stateHash)
+        streamsXml, streams = self.GetStreamsInfo(ref=stateHash)
+        tr = hist.transactions[0]
+        streamAtTr = streams.getStream(stream.streamNumber)
+        if streamAtTr is None:
+            return None
+
+        pathList = self.GetDiffElementPathList(diff=diff, hist=hist)
+        if pathList is None:
+            return None
+        stagingPath = os.path.join(stagingRootPath, str(tr.id))
+        os.makedirs(stagingPath)
+
+        def prefetchPop():
+            if len(pathList) == 0:
+                return True
+            return bool(self.TryPopList(streamName=streamAtTr.name, transaction=tr, location=stagingPath, pathList=pathList, overwrite=True))
+
+        return (executor.submit(prefetchPop), stagingPath)
+
+    # Waits for the prefetched populate, started by StartPrefetchPop(), to finish and moves the populated files into the git repo.
+    # Returns True on success, otherwise False, in which case the caller should populate the transaction normally.
+    def ApplyPrefetchedPop(self, prefetch):
+        future, stagingPath = prefetch
+        try:
+            if not future.result():
+                return False
+            for root, dirs, files in os.walk(stagingPath, topdown=True):
+                destRoot = os.path.normpath(os.path.join(self.gitRepo.path, os.path.relpath(root, stagingPath)))
+                if os.path.lexists(destRoot) and (os.path.islink(destRoot) or not os.path.isdir(destRoot)):
+                    self.DeletePath(destRoot)
+                if not os.path.exists(destRoot):
+                    os.makedirs(destRoot)
+                # Symbolic links to directories are listed in dirs by os.walk() but should be moved like files.
+                linkedDirs = [ d for d in dirs if os.path.islink(os.path.join(root, d)) ]
+                dirs[:] = [ d for d in dirs if d not in linkedDirs ]
+                for name in files + linkedDirs:
+                    destPath = os.path.join(destRoot, name)
+                    if os.path.lexists(destPath):
+                        self.DeletePath(destPath)
+                    os.replace(os.path.join(root, name), destPath)
+            return True
+        except Exception as e:
+            logger.warning("Failed to apply the prefetched pop from {p}. Err: {e}".format(p=stagingPath, e=e))
+            return False
+        finally:
+            shutil.rmtree(stagingPath, ignore_errors=True)
+
     def TryStreams(self, depot, timeSpec, stream=None):
         streams = None
         for i in range(0, AccuRev2Git.commandFailureRetryCount):
@@ -995,50 +1776,67 @@ class AccuRev2Git(object):
         xmlDecoded = git.decode_proc_output(xmlNormalized)
         return xmlDecoded
 
-    def WriteInfoFiles(self, path, depot, transaction, streamsXml=None, histXml=None, streamName=None, diffXml=None, useCommandCache=False):
-        streams = None
-        hist = None
-        diff = None
+    # Returns the (filename, contents) list of the hist.xml, streams.xml and diff.xml (if any) documents for the transaction or None on failure.
+    # The documents, and their parsed objects, that the caller already has are used as they are and only the rest are retrieved from accurev.
+    def GetInfoFileList(self, depot, transaction, streamsXml=None, histXml=None, streamName=None, diffXml=None, useCommandCache=False, streams=None, hist=None, diff=None):
+        infoFileList = []
 
-        if streamsXml is not None:
+        if streamsXml is not None and streams is None:
             streams = accurev.obj.Show.Streams.fromxmlstring(streamsXml)
         
         if streams is None or streamsXml is None:
-            streams, streamsXml = self.TryStreams(depot=depot, timeSpec=transaction)
+            streams, streamsXml = self.GetStreamsAtTransaction(depot=depot, transaction=transaction)
             if streams is None or streamsXml is None:
-                return (None, None, None)
+                return None
 
-        if histXml is not None:
+        if histXml is not None and hist is None:
             hist = accurev.obj.History.fromxmlstring(histXml)
         if hist is None or histXml is None:
             hist, histXml = self.TryHist(depot=depot, timeSpec=transaction)
             if hist is None or histXml is None:
-                return (None, None)
+                return None
 
         tr = hist.transactions[0]
         if tr.id > 1 and tr.Type != "mkstream":
-            if diffXml is not None:
-                diff = accurev.obj.Diff.fromxmlstring(streamsXml)
+            if diffXml is not None and diff is None:
+                diff = accurev.obj.Diff.fromxmlstring(diffXml)
             
             if diff is None or diffXml is None:
                 if streamName is not None:
                     diff, diffXml = self.TryDiff(streamName=streamName, firstTrNumber=tr.id, secondTrNumber=(tr.id - 1))
                     if diff is None or diffXml is None:
-                        return (None, None)
+                        return None
                 else:
-                    return (None, None)
+                    return None
 
-            diffFilePath = os.path.join(self.gitRepo.path, 'diff.xml')
-            with codecs.open(diffFilePath, mode='w', encoding='utf-8') as f:
-                f.write(self.NormalizeAccurevXml(diffXml))
+            infoFileList.append( ('diff.xml', diffXml) )
 
-        streamsFilePath = os.path.join(path, 'streams.xml')
-        with codecs.open(streamsFilePath, mode='w', encoding='utf-8') as f:
-            f.write(self.NormalizeAccurevXml(streamsXml))
-        
-        histFilePath = os.path.join(path, 'hist.xml')
-        with codecs.open(histFilePath, mode='w', encoding='utf-8') as f:
-            f.write(self.NormalizeAccurevXml(histXml))
+        infoFileList.append( ('streams.xml', streamsXml) )
+        infoFileList.append( ('hist.xml', histXml) )
+
+        return [ (name, self.NormalizeAccurevXml(xml)) for name, xml in infoFileList ]
+
+    # Writes the hist.xml, streams.xml and diff.xml (if any) for the transaction straight into the git object database, without touching the worktree
+    # or the index, and returns the hash of the tree that contains them.
+    def WriteInfoTree(self, depot, transaction, streamsXml=None, histXml=None, streamName=None, diffXml=None, useCommandCache=False, streams=None, hist=None, diff=None):
+        infoFileList = self.GetInfoFileList(depot=depot, transaction=transaction, streamsXml=streamsXml, histXml=histXml, streamName=streamName, diffXml=diffXml, useCommandCache=useCommandCache, streams=streams, hist=hist, diff=diff)
+        if infoFileList is None:
+            return None
+
+        entryList = []
+        for name, text in infoFileList:
+            blobHash = self.gitRepo.hash_object(text=text, write=True)
+            if blobHash is None or len(blobHash) == 0:
+                logger.error("Failed to write {name} for transaction {tr}. Error:\n{err}".format(name=name, tr=transaction, err=self.gitRepo.lastStderr))
+                return None
+            entryList.append( ('100644', 'blob', blobHash, name) )
+
+        treeHash = self.gitRepo.mktree(entryList=entryList)
+        if treeHash is None or len(treeHash) == 0:
+            logger.error("Failed to write the info tree for transaction {tr}. Error:\n{err}".format(tr=transaction, err=self.gitRepo.lastStderr))
+            return None
+
+        return treeHash
 
     # GetDepotRefsNamespace
     # When depot is None it returns the git ref namespace where all depots are under.
@@ -1066,8 +1864,8 @@ class AccuRev2Git(object):
         return depotNumber, remainder
 
     def GetDepot(self, depot):
-        if AccuRev2Git.cachedDepots is not None:
-            d = AccuRev2Git.cachedDepots.getDepot(depot)
+        if self.cachedDepots is not None:
+            d = self.cachedDepots.getDepot(depot)
             if d is not None:
                 return d
 
@@ -1105,7 +1903,7 @@ class AccuRev2Git(object):
         # Try and find the depot in the list of existing depots.
         d = depots.getDepot(depot)
         if d is not None:
-            AccuRev2Git.cachedDepots = depots
+            self.cachedDepots = depots
             return d
 
         if haveCommitted:
@@ -1138,7 +1936,7 @@ class AccuRev2Git(object):
             # Try and find the depot in the list of existing depots.
             d = depots.getDepot(depot)
             if d is not None:
-                AccuRev2Git.cachedDepots = depots
+                self.cachedDepots = depots
                 return d
 
         return None
@@ -1182,7 +1980,7 @@ class AccuRev2Git(object):
     def GetDiffInfo(self, ref):
         # Get the diff information. (if any)
         diff = None
-        diffXml = self.gitRepo.raw_cmd(['git', 'show', '{hash}:diff.xml'.format(hash=ref)]) # Doesn't exist for the mkstream transaction (first commit)
+        diffXml = self.gitRepo.catFile.text('{hash}:diff.xml'.format(hash=ref), objType='blob') # Doesn't exist for the mkstream transaction (first commit)
         if diffXml is not None and len(diffXml) != 0:
             diff = accurev.obj.Diff.fromxmlstring(diffXml)
         else:
@@ -1193,7 +1991,7 @@ class AccuRev2Git(object):
     def GetHistInfo(self, ref):
         # Get the hist information.
         hist = None
-        histXml = self.gitRepo.raw_cmd(['git', 'show', '{hash}:hist.xml'.format(hash=ref)])
+        histXml = self.gitRepo.catFile.text('{hash}:hist.xml'.format(hash=ref), objType='blob')
         if histXml is not None and len(histXml) != 0:
             hist = accurev.obj.History.fromxmlstring(histXml)
         else:
@@ -1204,44 +2002,348 @@ class AccuRev2Git(object):
     def GetStreamsInfo(self, ref):
         # Get the stream information.
         streams = None
-        streamsXml = self.gitRepo.raw_cmd(['git', 'show', '{hash}:streams.xml'.format(hash=ref)])
+        streamsXml = self.gitRepo.catFile.text('{hash}:streams.xml'.format(hash=ref), objType='blob')
         if streamsXml is not None and len(streamsXml) != 0:
             streams = accurev.obj.Show.Streams.fromxmlstring(streamsXml)
         else:
             raise Exception("Command failed! git show {hash}:streams.xml".format(hash=ref))
         return (streamsXml, streams)
 
+    # Returns the ref under which the hist.xml and streams.xml of the transactions retrieved for any of the depot's streams are stored, once for all
+    # of the streams that the transaction affects. The ref points directly at a tree with a <tr. number // 1000>/<tr. number>/ directory for each
+    # transaction. The streams' info commits have the same hist.xml and streams.xml blobs so storing them here doesn't take up any extra space.
+    def GetDepotTransactionsRef(self, depot):
+        depotNS = self.GetDepotRefsNamespace(depot=depot)
+        if depotNS is None:
+            return None
+        return u'{depotNS}transactions'.format(depotNS=depotNS)
+
+    # Returns the in memory copy of the tree that the depot's transactions ref points to. It is a dict with the "transactions" (tr. number to tree
+    # hash) and "shards" (tr. number // 1000 to tree hash) maps and the set of "dirty" shards to which transactions were added since the ref was last
+    # updated (see FlushDepotTransactions()). It is shared between the retrieval workers so it must only be used while holding the refUpdateLock.
+    def GetDepotTransactionStore(self, ref):
+        store = self.depotTransactionStores.get(ref)
+        if store is None:
+            store = { "transactions": {}, "shards": {}, "dirty": set() }
+            lsTreeOutput = self.gitRepo.raw_cmd([ u'git', u'ls-tree', u'-r', u'-d', ref ]) if self.gitRepo.catFile.info(ref) is not None else None
+            if lsTreeOutput is not None:
+                for line in lsTreeOutput.splitlines():
+                    info, path = line.split('\t', 1)
+                    mode, objType, objHash = info.split()
+                    if '/' in path:
+                        store["transactions"][int(path.split('/')[1])] = objHash
+                    else:
+                        store["shards"][path] = objHash
+            self.depotTransactionStores[ref] = store
+        return store
+
+    # Returns the (histXml, hist, streamsXml, streams) tuple for the transaction from the depot's transactions ref, or None if it isn't there.
+    def GetDepotTransactionInfo(self, depot, trId):
+        ref = self.GetDepotTransactionsRef(depot=depot)
+        if ref is None:
+            return None
+        with self.refUpdateLock:
+            trTreeHash = self.GetDepotTransactionStore(ref)["transactions"].get(int(trId))
+        if trTreeHash is None:
+            return None
+
+        objList = self.gitRepo.catFile.contents_list([ '{0}:hist.xml'.format(trTreeHash), '{0}:streams.xml'.format(trTreeHash) ])
+        if objList is None or None in objList:
+            return None
+        histXml, streamsXml = [ git.decode_proc_output(obj[2]) for obj in objList ]
+        hist = accurev.obj.History.fromxmlstring(histXml)
+        streams = accurev.obj.Show.Streams.fromxmlstring(streamsXml)
+        if hist is None or streams is None:
+            return None
+        return (histXml, hist, streamsXml, streams)
+
+    # Adds the transaction's hist.xml and streams.xml to the depot's transactions ref, unless it already has them. When overwrite is set they are
+    # replaced instead. The ref itself is only updated by FlushDepotTransactions(). Returns True on success.
+    def AddDepotTransactionInfo(self, depot, trId, histXml, streamsXml, overwrite=False):
+        ref = self.GetDepotTransactionsRef(depot=depot)
+        if ref is None:
+            return False
+        entryList = []
+        for name, xml in [ ('hist.xml', histXml), ('streams.xml', streamsXml) ]:
+            blobHash = self.gitRepo.hash_object(text=self.NormalizeAccurevXml(xml), write=True)
+            if blobHash is None or len(blobHash) == 0:
+                logger.warning("Failed to write {name} of tr. {trId} for {ref}. Error:\n{err}".format(name=name, trId=trId, ref=ref, err=self.gitRepo.lastStderr))
+                return False
+            entryList.append( ('100644', 'blob', blobHash, name) )
+        trTreeHash = self.gitRepo.mktree(entryList=entryList)
+        if trTreeHash is None or len(trTreeHash) == 0:
+            logger.warning("Failed to write the tree of tr. {trId} for {ref}. Error:\n{err}".format(trId=trId, ref=ref, err=self.gitRepo.lastStderr))
+            return False
+
+        with self.refUpdateLock:
+            store = self.GetDepotTransactionStore(ref)
+            if overwrite or int(trId) not in store["transactions"]:
+                store["transactions"][int(trId)] = trTreeHash
+                store["dirty"].add(str(int(trId) // 1000))
+        return True
+
+    # Writes the transactions added by AddDepotTransactionInfo() to the depot's transactions ref. Only the shards that have changed are rewritten.
+    # Returns True on success.
+    def FlushDepotTransactions(self, depot):
+        ref = self.GetDepotTransactionsRef(depot=depot)
+        if ref is None:
+            return False
+        with self.refUpdateLock:
+            store = self.depotTransactionStores.get(ref)
+            if store is None or len(store["dirty"]) == 0:
+                return True
+
+            shardEntries = dict( (shard, []) for shard in store["dirty"] )
+            for trId, trTreeHash in store["transactions"].items():
+                entryList = shardEntries.get(str(trId // 1000))
+                if entryList is not None:
+                    entryList.append( ('040000', 'tree', trTreeHash, str(trId)) )
+            for shard, entryList in shardEntries.items():
+                shardHash = self.gitRepo.mktree(entryList=entryList)
+                if shardHash is None or len(shardHash) == 0:
+                    logger.error("Failed to write the tree of shard {shard} for {ref}. Error:\n{err}".format(shard=shard, ref=ref, err=self.gitRepo.lastStderr))
+                    return False
+                store["shards"][shard] = shardHash
+
+            rootHash = self.gitRepo.mktree(entryList=[ ('040000', 'tree', shardHash, shard) for shard, shardHash in store["shards"].items() ])
+            if rootHash is None or len(rootHash) == 0 or self.gitRepo.raw_cmd([ u'git', u'update-ref', ref, rootHash ]) is None:
+                logger.error("Failed to update {ref}. Error:\n{err}".format(ref=ref, err=self.gitRepo.lastStderr))
+                return False
+            logger.debug("Updated {ref} with {n} shards of transactions.".format(ref=ref, n=len(shardEntries)))
+            store["dirty"].clear()
+        return True
+
+    # Returns the (histXml, hist, streamsXml, streams) tuple for the transaction from the depot's transactions ref or, if it isn't there (e.g. it was
+    # retrieved before the ref was introduced), from the given info commit.
+    def GetTransactionInfo(self, depot, trId, stateHash):
+        trInfo = self.GetDepotTransactionInfo(depot=depot, trId=trId) if trId is not None else None
+        if trInfo is None:
+            histXml, hist = self.GetHistInfo(ref=stateHash)
+            streamsXml, streams = self.GetStreamsInfo(ref=stateHash)
+            trInfo = (histXml, hist, streamsXml, streams)
+        return trInfo
+
     # Gets the depots.xml contents and parsed accurev.obj.Show.Streams object from the given \a ref (git ref or hash).
     def GetDepotsInfo(self, ref):
         # Get the stream information.
         depots = None
-        depotsXml = self.gitRepo.raw_cmd(['git', 'show', '{hash}:depots.xml'.format(hash=ref)])
+        depotsXml = self.gitRepo.catFile.text('{hash}:depots.xml'.format(hash=ref), objType='blob')
         if depotsXml is not None and len(depotsXml) != 0:
             depots = accurev.obj.Show.Depots.fromxmlstring(depotsXml)
         else:
             raise Exception("Command failed! git show {hash}:depots.xml".format(hash=ref))
         return (depotsXml, depots)
 
-    def RetrieveStreamInfo(self, depot, stream, stateRef, startTransaction, endTransaction):
+    # Returns the git ref in which the stream definition timeline for the given depot is cached.
+    def GetStreamTimelineRef(self, depot):
+        d = self.GetDepot(depot)
+        if d is None:
+            return None
+        return u'{refsNS}cache/depots/{depotNumber}/stream_timeline'.format(refsNS=AccuRev2Git.gitRefsNamespace, depotNumber=d.number)
+
+    # Returns the sorted list of transaction numbers, up to and including endTrNumber, at which the stream definitions in the depot have changed.
+    # Since stream definitions only change on stream_definition_transaction_types transactions, the streams valid at transaction T are the streams
+    # at the last transaction in this list that is <= T (i.e. consecutive entries delimit the validity intervals of every stream definition).
+    # The list is stored in a hidden ref and only extended over the new transaction range on subsequent calls. A stored list that was built from
+    # other transaction types is discarded and built again. Returns None on failure.
+    def GetStreamTimeline(self, depot, endTrNumber):
+        timelineRef = self.GetStreamTimelineRef(depot)
+        if timelineRef is None:
+            return None
+
+        with self.refUpdateLock:
+            timeline = self.streamTimelines.get(timelineRef)
+            if timeline is None:
+                timeline = { "transaction-types": stream_definition_transaction_types, "high-water-mark": 0, "transactions": [] }
+                timelineText = self.ReadFileRef(ref=timelineRef)
+                if timelineText is not None and len(timelineText) > 0:
+                    storedTimeline = json.loads(timelineText)
+                    if storedTimeline.get("transaction-types") == stream_definition_transaction_types:
+                        timeline = storedTimeline
+                    else:
+                        logger.info("Discarding the stream timeline in {r}, it was built from the {t} transactions.".format(r=timelineRef, t=storedTimeline.get("transaction-types", [ "mkstream", "chstream" ])))
+                self.streamTimelines[timelineRef] = timeline
+            hwm = timeline["high-water-mark"]
+        if hwm < endTrNumber:
+            # The accurev queries are run without holding the refUpdateLock so that the other retrieval workers aren't blocked by them. Another
+            # worker may extend the timeline in the meantime, which is fine since the ranges are merged and the high-water-mark only moves forward.
+            trSet = set()
+            for trType in stream_definition_transaction_types:
+                trList = self.TryChunkedHist(depot=depot, timeSpec="{0}-{1}".format(hwm + 1, endTrNumber), transactionKind=trType)
+                if trList is None:
+                    logger.warning("Failed to extend the stream timeline for depot {d} with {t} transactions in range {s} - {e}.".format(d=depot, t=trType, s=hwm + 1, e=endTrNumber))
+                    return None
+                for tr in trList:
+                    trSet.add(tr.id)
+            with self.refUpdateLock:
+                if timeline["high-water-mark"] < endTrNumber or not trSet.issubset(timeline["transactions"]):
+                    timeline["transactions"] = sorted(trSet.union(timeline["transactions"]))
+                    timeline["high-water-mark"] = max(timeline["high-water-mark"], endTrNumber)
+                    self.WriteFileRef(ref=timelineRef, text=json.dumps(timeline))
+                    logger.debug("Stream timeline for depot {d} extended to tr. {tr} ({n} stream definition changes).".format(d=depot, tr=endTrNumber, n=len(timeline["transactions"])))
+
+        with self.refUpdateLock:
+            return timeline["transactions"]
+
+    # Returns the (streams, streamsXml) tuple describing all of the streams in the depot at the given transaction. The `accurev show streams` command
+    # is only executed at the stream definition changes found by GetStreamTimeline() and its result is reused for all of the transactions in between.
+    # Whether a stream has a default group can change on any transaction, so the reused document has its hasDefaultGroup attributes removed.
+    def GetStreamsAtTransaction(self, depot, transaction):
+        trNumber = int(transaction)
+        checkpointTr = trNumber
+        timeline = self.GetStreamTimeline(depot=depot, endTrNumber=trNumber)
+        if timeline is not None:
+            i = bisect.bisect_right(timeline, trNumber)
+            if i > 0:
+                checkpointTr = timeline[i - 1]
+
+        if self.lastStreamsCheckpoint is None or self.lastStreamsCheckpoint[0] != depot or self.lastStreamsCheckpoint[1] != checkpointTr:
+            streams, streamsXml = self.TryStreams(depot=depot, timeSpec=checkpointTr)
+            if streams is None or streamsXml is None:
+                return (None, None)
+            reusedStreamsXml = re.sub(' hasDefaultGroup="[^"]*"', '', streamsXml)
+            reusedStreams = accurev.obj.Show.Streams.fromxmlstring(reusedStreamsXml)
+            self.lastStreamsCheckpoint = (depot, checkpointTr, streams, streamsXml, reusedStreams, reusedStreamsXml)
+
+        lastDepot, lastCheckpointTr, streams, streamsXml, reusedStreams, reusedStreamsXml = self.lastStreamsCheckpoint
+        if trNumber == checkpointTr:
+            return (streams, streamsXml)
+        return (reusedStreams, reusedStreamsXml)
+
+    # Returns the git ref in which the deep-hist results for the given stream are cached.
+    def GetDeepHistRef(self, depot, streamNumber):
+        d = self.GetDepot(depot)
+        if d is None:
+            return None
+        return u'{refsNS}cache/depots/{depotNumber}/streams/{streamNumber}/deep_hist'.format(refsNS=AccuRev2Git.gitRefsNamespace, depotNumber=d.number, streamNumber=streamNumber)
+
+    # Returns the sorted list of the chstream transactions, which change a stream's basis or timelock, in the transaction range startTrNumber -
+    # endTrNumber that were made on the stream or on any of the streams in its basis chain during that range, or None on failure. The basis chain is
+    # taken from the streams at both ends of the range and from the bases that its chstream transactions name, which covers the streams that were
+    # only in the chain in between.
+    def GetBasisChainChstreams(self, depot, stream, startTrNumber, endTrNumber):
+        chstreamList = self.TryChunkedHist(depot=depot, timeSpec="{0}-{1}".format(startTrNumber, endTrNumber), transactionKind="chstream")
+        if chstreamList is None:
+            return None
+
+        chainSet = set()
+        for trNumber in [ startTrNumber, endTrNumber ]:
+            streams, streamsXml = self.GetStreamsAtTransaction(depot=depot, transaction=trNumber)
+            if streams is None:
+                return None
+            pendingList = [ stream.streamNumber ]
+            while len(pendingList) > 0:
+                streamNumber = pendingList.pop()
+                while streamNumber is not None and streamNumber not in chainSet:
+                    chainSet.add(streamNumber)
+                    s = streams.getStream(streamNumber)
+                    streamNumber = s.basisStreamNumber if s is not None else None
+                if len(pendingList) == 0:
+                    # The bases named by the chstream transactions of the chain may themselves have been reparented in between, so we repeat
+                    # until no new streams are found.
+                    for tr in chstreamList:
+                        if tr.stream is not None and tr.stream.streamNumber in chainSet:
+                            pendingList.extend([ sn for sn in [ tr.stream.basisStreamNumber, tr.stream.prevBasisStreamNumber ] if sn is not None and sn not in chainSet ])
+
+        return sorted([ tr.id for tr in chstreamList if tr.affectedStream()[1] in chainSet ])
+
+    # Returns the accurev.ext.deep_hist() result, in ascending order, for the stream in the transaction range startTrNumber - endTrNumber.
+    # The result is additive over adjacent transaction ranges (the stream's basis and timelock can only change on a chstream transaction, which the
+    # deep-hist algorithm already splits on) and accurev history doesn't change once recorded. So we store the covered range and the transactions
+    # in a hidden ref and only run deep-hist for the parts of the range that haven't been covered before. The cache is discarded if it was computed
+    # with a different ignoreTimelocks setting or if the chstream transactions of the stream's basis chain in the covered range (see
+    # GetBasisChainChstreams()) are no longer the ones that it was computed with.
+    # Only the id and the type of each transaction are stored, so the returned transactions have no time, user, comment, versions or stream.
+    # The callers only use them to find the transactions to diff or populate and get the rest from the transaction's own hist.
+    def GetDeepHist(self, depot, stream, startTrNumber, endTrNumber, ignoreTimelocks=False):
+        deepHistRef = self.GetDeepHistRef(depot=depot, streamNumber=stream.streamNumber)
+
+        cache = None
+        if deepHistRef is not None:
+            cacheText = self.ReadFileRef(ref=deepHistRef)
+            if cacheText is not None and len(cacheText) > 0:
+                cache = json.loads(cacheText)
+                if cache.get("ignore-timelocks") != ignoreTimelocks:
+                    logger.info("Discarding cached deep-hist for {s}, it was computed with ignoreTimelocks={t}.".format(s=stream.name, t=cache.get("ignore-timelocks")))
+                    cache = None
+                elif startTrNumber > cache["end"] + 1 or endTrNumber < cache["start"] - 1:
+                    cache = None # Disjoint ranges, start over.
+                else:
+                    basisChstreamList = self.GetBasisChainChstreams(depot=depot, stream=stream, startTrNumber=cache["start"], endTrNumber=cache["end"])
+                    if basisChstreamList is None:
+                        return None
+                    elif basisChstreamList != cache.get("basis-chstreams"):
+                        logger.info("Discarding cached deep-hist for {s}, the chstream transactions of its basis chain in {start} - {end} have changed.".format(s=stream.name, start=cache["start"], end=cache["end"]))
+                        cache = None
+
+        rangeList = []
+        if cache is None:
+            cache = { "ignore-timelocks": ignoreTimelocks, "start": startTrNumber, "end": endTrNumber, "transactions": [] }
+            rangeList.append( (startTrNumber, endTrNumber) )
+        else:
+            if startTrNumber < cache["start"]:
+                rangeList.append( (startTrNumber, cache["start"] - 1) )
+            if endTrNumber > cache["end"]:
+                rangeList.append( (cache["end"] + 1, endTrNumber) )
+
+        if len(rangeList) > 0:
+            trMap = dict( (trId, trType) for trId, trType in cache["transactions"] )
+            for rangeStart, rangeEnd in rangeList:
+                logger.debug("accurev.ext.deep_hist(depot={0}, stream={1}, timeSpec='{2}-{3}', ignoreTimelocks={4})".format(depot, stream.name, rangeStart, rangeEnd, ignoreTimelocks))
+                trList = accurev.ext.deep_hist(depot=depot, stream=stream.name, timeSpec="{0}-{1}".format(rangeStart, rangeEnd), ignoreTimelocks=ignoreTimelocks, useCache=self.config.accurev.UseCommandCache(), maxWorkers=self.config.accurev.histWorkers)
+                if trList is None:
+                    return None
+                for tr in trList:
+                    trMap[tr.id] = tr.Type
+            cache["start"] = min(cache["start"], startTrNumber)
+            cache["end"] = max(cache["end"], endTrNumber)
+            cache["transactions"] = sorted(trMap.items())
+            cache["basis-chstreams"] = self.GetBasisChainChstreams(depot=depot, stream=stream, startTrNumber=cache["start"], endTrNumber=cache["end"])
+            if cache["basis-chstreams"] is None:
+                return None
+            if deepHistRef is not None:
+                self.WriteFileRef(ref=deepHistRef, text=json.dumps(cache))
+        else:
+            logger.debug("Deep-hist for {s} in range {start} - {end} loaded from {r}.".format(s=stream.name, start=startTrNumber, end=endTrNumber, r=deepHistRef))
+
+        return [ accurev.obj.Transaction(id=trId, Type=trType, time=None, user=None, comment=None) for trId, trType in cache["transactions"] if startTrNumber <= trId <= endTrNumber ]
+
+    # Writes the info commit for the transaction onto the stateRef. Returns the commit hash or None on failure. See GetInfoFileList() for the
+    # documents that the caller can pass in.
+    def CommitInfo(self, depot, transaction, stateRef, parents, streamName=None, streamsXml=None, histXml=None, diffXml=None, streams=None, hist=None, diff=None):
+        if self.GetFastImport() is not None:
+            infoFileList = self.GetInfoFileList(depot=depot, streamName=streamName, transaction=transaction.id, streamsXml=streamsXml, histXml=histXml, diffXml=diffXml, useCommandCache=self.config.accurev.UseCommandCache(), streams=streams, hist=hist, diff=diff)
+            if infoFileList is None:
+                return None
+            return self.FastImportCommit(transaction=transaction, ref=stateRef, parents=parents, messageOverride="transaction {trId}".format(trId=transaction.id), fileList=[ ('100644', text, name) for name, text in infoFileList ], deleteAll=True, authorIsCommitter=True)
+
+        treeHash = self.WriteInfoTree(depot=depot, streamName=streamName, transaction=transaction.id, streamsXml=streamsXml, histXml=histXml, diffXml=diffXml, useCommandCache=self.config.accurev.UseCommandCache(), streams=streams, hist=hist, diff=diff)
+        if treeHash is None:
+            return None
+        return self.Commit(transaction=transaction, messageOverride="transaction {trId}".format(trId=transaction.id), parents=parents, treeHash=treeHash, ref=stateRef, checkout=False, authorIsCommitter=True)
+
+    # If a deadline (see time.time()) is given the retrieval stops at the first transaction committed after it, in which case the infoDeadlineReached
+    # member is set to True. If onCommit is given it is called with the hash of each info commit as soon as it is made and the retrieval stops if
+    # it returns False (see RetrieveStreamPipelined()).
+    def RetrieveStreamInfo(self, depot, stream, stateRef, startTransaction, endTransaction, deadline=None, onCommit=None):
+        self.infoDeadlineReached = False
         logger.info( "Processing Accurev state for {0} : {1} - {2}".format(stream.name, startTransaction, endTransaction) )
 
         # Check if the ref exists!
-        stateRefObj = self.gitRepo.raw_cmd(['git', 'show-ref', stateRef])
-        assert stateRefObj is None or len(stateRefObj) != 0, "Invariant error! Expected non-empty string returned by git show-ref, but got '{s}'".format(s=stateRefObj)
+        stateRefObj = self.gitRepo.catFile.info(stateRef)
 
-        # Either checkout last state or make the initial commit for a new stateRef.
+        # Either load the last state or make the initial commit for a new stateRef.
+        # Note: The info commits are written directly into the object database so the worktree (which usually has a data ref checked out) is never touched.
         tr = None
         commitHash = None
-        doInitialCheckout = False
         if stateRefObj is not None:
-            # This means that the ref already exists so we should switch to it.
-            doInitialCheckout = True
             histXml, hist = self.GetHistInfo(ref=stateRef)
             tr = hist.transactions[0]
+            commitHash = self.GetLastCommitHash(ref=stateRef)
         else:
             logger.debug( "Ref '{br}' doesn't exist.".format(br=stateRef) )
             # We are tracking a new stream
-            firstHist, firstHistXml = self.GetFirstTransaction(depot=depot, streamName=stream.name, startTransaction=startTransaction, endTransaction=endTransaction)
+            firstHist, firstHistXml = self.GetFirstTransaction(depot=depot, streamName=stream.name, streamNumber=stream.streamNumber, startTransaction=startTransaction, endTransaction=endTransaction, useCache=self.config.accurev.UseCommandCache())
             if firstHist is not None and len(firstHist.transactions) > 0:
                 tr = firstHist.transactions[0]
                 try:
@@ -1249,18 +2351,14 @@ class AccuRev2Git(object):
                 except:
                     destStream = None
 
-                # Delete everything in the index and working directory.
-                self.gitRepo.rm(fileList=['.'], force=True, recursive=True)
-                self.ClearGitRepo()
-
-                self.WriteInfoFiles(path=self.gitRepo.path, depot=depot, streamName=stream.name, transaction=tr.id, useCommandCache=self.config.accurev.UseCommandCache())
-
-                commitHash = self.Commit(transaction=tr, messageOverride="transaction {trId}".format(trId=tr.id), parents=[], ref=stateRef, authorIsCommitter=True)
+                commitHash = self.CommitInfo(depot=depot, transaction=tr, stateRef=stateRef, parents=[], streamName=stream.name, histXml=firstHistXml, hist=firstHist)
                 if commitHash is None:
                     logger.debug( "{0} first commit has failed. Is it an empty commit? Aborting!".format(stream.name) )
                     return (None, None)
                 else:
                     logger.info( "stream {streamName}: tr. #{trId} {trType} -> commit {hash} on {ref}".format(streamName=stream.name, trId=tr.id, trType=tr.Type, hash=self.ShortHash(commitHash), ref=stateRef) )
+                    if onCommit is not None and not onCommit(commitHash):
+                        return (tr, commitHash)
             else:
                 logger.warning( "Failed to get the first transaction for {0} from accurev. Continuing...".format(stream.name) )
                 return (None, None)
@@ -1275,96 +2373,159 @@ class AccuRev2Git(object):
 
         if tr.id > endTr.id:
             logger.info("{0}: nothing to do, last processed transaction {1} is greater than the end transaction {2}.".format(stream.name, tr.id, endTr.id))
-            return (tr, self.GetLastCommitHash(ref=stateRef))
+            return (tr, commitHash)
 
         # Iterate over all of the transactions that affect the stream we are interested in and maybe the "chstream" transactions (which affect the streams.xml).
         deepHist = None
         if self.config.method == "deep-hist":
             ignoreTimelocks=False # The code for the timelocks is not tested fully yet. Once tested setting this to false should make the resulting set of transactions smaller
                                  # at the cost of slightly larger number of upfront accurev commands called.
-            logger.debug("accurev.ext.deep_hist(depot={0}, stream={1}, timeSpec='{2}-{3}', ignoreTimelocks={4})".format(depot, stream.name, tr.id, endTr.id, ignoreTimelocks))
-            deepHist = accurev.ext.deep_hist(depot=depot, stream=stream.name, timeSpec="{0}-{1}".format(tr.id, endTr.id), ignoreTimelocks=ignoreTimelocks, useCache=self.config.accurev.UseCommandCache())
-            logger.info("Deep-hist returned {count} transactions to process.".format(count=len(deepHist)))
+            deepHist = self.GetDeepHist(depot=depot, stream=stream, startTrNumber=tr.id, endTrNumber=endTr.id, ignoreTimelocks=ignoreTimelocks)
             if deepHist is None:
                 raise Exception("accurev.ext.deep_hist() failed to return a result!")
             elif len(deepHist) == 0:
                 return (None, None)
+            logger.info("Deep-hist returned {count} transactions to process.".format(count=len(deepHist)))
         while True:
-            nextTr, diff = self.FindNextChangeTransaction(streamName=stream.name, startTrNumber=tr.id, endTrNumber=endTr.id, deepHist=deepHist)
+            nextTr, diff, diffXml = self.FindNextChangeTransaction(streamName=stream.name, startTrNumber=tr.id, endTrNumber=endTr.id, deepHist=deepHist)
             if nextTr is None:
                 logger.debug( "FindNextChangeTransaction(streamName='{0}', startTrNumber={1}, endTrNumber={2}, deepHist={3}) failed!".format(stream.name, tr.id, endTr.id, deepHist) )
                 return (None, None)
 
             logger.debug( "{0}: next transaction {1} (end tr. {2})".format(stream.name, nextTr, endTr.id) )
             if nextTr <= endTr.id:
-                if doInitialCheckout:
-                    # A postponed initialization of state. If there's nothing to do we should skip this checkout because
-                    # it can be expensive. So only do it once and only when we will need to use it.
-                    self.SafeCheckout(ref=stateRef, doReset=True, doClean=True)
-                    doInitialCheckout = False
-
                 # Right now nextTr is an integer representation of our next transaction.
-                # Delete all of the files which are even mentioned in the diff so that we can do a quick populate (wouth the overwrite option)
-                if self.config.method == "pop":
-                    self.ClearGitRepo()
+                if self.config.method != "pop" and diff is None:
+                    return (None, None)
+
+                # The hist and streams of a transaction are the same for all of the streams that it affects so only the first stream to get to it
+                # retrieves them from accurev and the rest read them from the depot's transactions ref.
+                trInfo = self.GetDepotTransactionInfo(depot=depot, trId=nextTr)
+                if trInfo is not None:
+                    histXml, hist, streamsXml, streams = trInfo
                 else:
-                    if diff is None:
+                    # The accurev hist command here must be used with the depot option since the transaction that has affected us may not
+                    # be a promotion into the stream we are looking at but into one of its parent streams. Hence we must query the history
+                    # of the depot and not the stream itself.
+                    hist, histXml = self.TryHist(depot=depot, timeSpec=nextTr)
+                    if hist is None:
+                        logger.debug("accurev hist -p {0} -t {1}.1 failed.".format(depot, endTransaction))
                         return (None, None)
-
-                # The accurev hist command here must be used with the depot option since the transaction that has affected us may not
-                # be a promotion into the stream we are looking at but into one of its parent streams. Hence we must query the history
-                # of the depot and not the stream itself.
-                hist, histXml = self.TryHist(depot=depot, timeSpec=nextTr)
-                if hist is None:
-                    logger.debug("accurev hist -p {0} -t {1}.1 failed.".format(depot, endTransaction))
-                    return (None, None)
+                    streams, streamsXml = self.GetStreamsAtTransaction(depot=depot, transaction=hist.transactions[0].id)
                 tr = hist.transactions[0]
-                stream = accurev.show.streams(depot=depot, stream=stream.streamNumber, timeSpec=tr.id, useCache=self.config.accurev.UseCommandCache()).streams[0]
+                trStream = None if streams is None else streams.getStream(stream.streamNumber)
+                isExactStreams = False
+                if trStream is None:
+                    # Old depots can be missing some mkstream transactions from their history so fall back to querying accurev directly.
+                    streams, streamsXml = self.TryStreams(depot=depot, timeSpec=tr.id)
+                    if streams is None:
+                        logger.debug("accurev show streams -p {0} -t {1} failed.".format(depot, tr.id))
+                        return (None, None)
+                    trStream = streams.getStream(stream.streamNumber)
+                    isExactStreams = True
+                stream = trStream
+                if trInfo is None or isExactStreams:
+                    self.AddDepotTransactionInfo(depot=depot, trId=tr.id, histXml=histXml, streamsXml=streamsXml, overwrite=isExactStreams)
 
-                self.WriteInfoFiles(path=self.gitRepo.path, depot=depot, streamName=stream.name, transaction=tr.id, useCommandCache=self.config.accurev.UseCommandCache())
-                    
                 # Commit
-                commitHash = self.Commit(transaction=tr, messageOverride="transaction {trId}".format(trId=tr.id), ref=stateRef, authorIsCommitter=True)
+                # The hist, streams and diff that we already have are recorded as they are so that the info commit doesn't need any more accurev commands.
+                commitHash = self.CommitInfo(depot=depot, transaction=tr, stateRef=stateRef, parents=[ commitHash ], streamName=stream.name, streamsXml=streamsXml, histXml=histXml, diffXml=diffXml, streams=streams, hist=hist, diff=diff)
                 if commitHash is None:
-                    if "nothing to commit" in self.gitRepo.lastStdout:
-                        logger.info("stream {streamName}: tr. #{trId} is a no-op. Potential but unlikely error. Continuing.".format(streamName=stream.name, trId=tr.id))
-                    else:
-                        break # Early return from processing this stream. Restarting should clean everything up.
+                    break # Early return from processing this stream. Restarting should clean everything up.
                 else:
-                    if self.UpdateAndCheckoutRef(ref=stateRef, commitHash=commitHash) != True:
-                        return (None, None)
                     logger.info( "stream {streamName}: tr. #{trId} {trType} -> commit {hash} on {ref}".format(streamName=stream.name, trId=tr.id, trType=tr.Type, hash=self.ShortHash(commitHash), ref=stateRef) )
+                    if onCommit is not None and not onCommit(commitHash):
+                        break
+                    if deadline is not None and time.time() >= deadline:
+                        logger.info( "Checkpoint time reached at transaction #{trId} for {streamName} -> {ref}".format(trId=tr.id, streamName=stream.name, ref=stateRef) )
+                        self.infoDeadlineReached = True
+                        break
             else:
                 logger.info( "Reached end transaction #{trId} for {streamName} -> {ref}".format(trId=endTr.id, streamName=stream.name, ref=stateRef) )
                 break
 
+        self.FlushDepotTransactions(depot=depot)
+
         return (tr, commitHash)
 
+    # Returns the git ref in which the transaction index of the given ref is stored, or None if the ref isn't one of our hidden refs.
+    def GetTransactionIndexRef(self, ref):
+        if not ref.startswith(AccuRev2Git.gitRefsNamespace):
+            return None
+        return u'{refsNS}cache/{refPath}_transactions'.format(refsNS=AccuRev2Git.gitRefsNamespace, refPath=ref[len(AccuRev2Git.gitRefsNamespace):])
+
+    # Returns the transaction number to commit hash map for the commits on the ref. The map is built by a single `git log` pass over the commits
+    # that weren't indexed yet, kept in memory and stored in a hidden ref (see GetTransactionIndexRef()) so that it only ever needs to be extended.
+    # Returns None if the ref doesn't exist.
+    def GetTransactionIndex(self, ref):
+        tipHash = self.GetLastCommitHash(ref=ref)
+        if tipHash is None:
+            return None
+
+        indexedHash, transactions = self.transactionIndexes.get(ref, (None, None))
+        indexRef = self.GetTransactionIndexRef(ref)
+        if transactions is None and indexRef is not None:
+            indexJson = self.ReadFileRef(ref=indexRef)
+            if indexJson is not None:
+                try:
+                    index = json.loads(indexJson)
+                    indexedHash, transactions = index["commit"], { int(k): v for k, v in index["transactions"].items() }
+                except:
+                    logger.warning("Failed to load the transaction index for {ref} from {indexRef}. Rebuilding it...".format(ref=ref, indexRef=indexRef))
+                    indexedHash, transactions = None, None
+
+        if transactions is not None and indexedHash == tipHash:
+            return transactions
+
+        # Only the commits made since the last indexed commit need to be read, unless the ref was rewritten in the meantime.
+        cmd = [ u'git', u'log', u'--format=%H %s', tipHash ]
+        if transactions is not None and indexedHash is not None and self.gitRepo.merge_base(commits=[ indexedHash, tipHash ], is_ancestor=True):
+            cmd.append(u'^{0}'.format(indexedHash))
+        else:
+            transactions = {}
+
+        # The log is newest first and the newest commit wins if a transaction appears more than once.
+        newTransactions = {}
+        for line in self.gitRepo.iter_cmd(cmd):
+            commitHash, subject = line.split(' ', 1) if ' ' in line else (line, '')
+            match = re.match(r'^transaction (\d+)$', subject)
+            if match is not None:
+                newTransactions.setdefault(int(match.group(1)), commitHash)
+        if self.gitRepo.lastReturnCode != 0:
+            raise Exception("Couldn't index the transactions on {ref}. {cmd}\n{err}".format(ref=ref, cmd=' '.join(cmd), err=self.gitRepo.lastStderr))
+        transactions.update(newTransactions)
+
+        self.transactionIndexes[ref] = (tipHash, transactions)
+        if indexRef is not None:
+            self.WriteFileRef(ref=indexRef, text=json.dumps({ "commit": tipHash, "transactions": transactions }))
+
+        return transactions
+
     def GetHashForTransaction(self, ref, trNum):
         # Find the commit hash on our ref that corresponds to the provided transaction number.
-        cmd = ['git', 'log', '--format=%H', '--grep', '^transaction {trId}$'.format(trId=trNum), ref]
-        lastCommitHash = self.gitRepo.raw_cmd(cmd)
-        if lastCommitHash is None:
-            raise Exception("Couldn't query {ref} for Accurev state information at transaction {trId}. {cmd}".format(ref=ref, trId=trNum, cmd=' '.join(cmd)))
-        lastCommitHash = lastCommitHash.strip()
-
-        if len(lastCommitHash) == 0:
-            logger.error( "Failed to load transaction ({trId}) from ref {ref}. '{cmd}' returned empty.".format(trId=trNum, ref=ref, cmd=' '.join(cmd)) )
+        transactions = self.GetTransactionIndex(ref=ref)
+        if transactions is None:
+            raise Exception("Couldn't query {ref} for Accurev state information at transaction {trId}.".format(ref=ref, trId=trNum))
+
+        commitHash = transactions.get(int(trNum))
+        if commitHash is None:
+            logger.error( "Failed to load transaction ({trId}) from ref {ref}. It isn't in the ref's transaction index.".format(trId=trNum, ref=ref) )
             return None
-        return lastCommitHash
+        return commitHash
 
     def GetTransactionForRef(self, ref):
         # Find the last transaction number that we processed.
-        lastCommitInfo = self.gitRepo.raw_cmd(['git', 'log', '--pretty=oneline', ref, '-1'])
-        if lastCommitInfo is None:
+        lastCommit = self.gitRepo.catFile.text('{ref}^{{commit}}'.format(ref=ref), objType='commit')
+        if lastCommit is None:
             raise Exception("Couldn't load last transaction for ref: {ref}".format(ref=ref))
-        lastCommitInfo = lastCommitInfo.strip()
+        # The commit message follows the headers after the first empty line and we only need its subject line.
+        lastCommitInfo = lastCommit.split('\n\n', 1)[1].strip() if '\n\n' in lastCommit else ''
         if len(lastCommitInfo) == 0:
             raise Exception("Couldn't load last transaction for ref: {ref} (empty result)".format(ref=ref))
-        lastCommitInfo = lastCommitInfo.split(' ')
-        if len(lastCommitInfo) != 3:
-            raise Exception("Unexpected format for last commit message! Expected 3 space separated fields but read: {info}".format(info=' '.join(lastCommitInfo)))
-        return int(lastCommitInfo[2])
+        lastCommitInfo = lastCommitInfo.split('\n', 1)[0].split(' ')
+        if len(lastCommitInfo) != 2:
+            raise Exception("Unexpected format for last commit message! Expected 2 space separated fields but read: {info}".format(info=' '.join(lastCommitInfo)))
+        return int(lastCommitInfo[1])
 
     def GetGitLogList(self, ref, afterCommitHash=None, gitLogFormat=None):
         # Get the list of new hashes that have been committed to the stateRef but we haven't processed on the ref just yet.
@@ -1386,15 +2547,173 @@ class AccuRev2Git(object):
 
         return hashList.split('\n')
 
+    # When a stream is created (or a snapshot is made) its contents are those of its basis stream at that transaction (or at its timelock). Returns the
+    # commit on the basis stream's data ref that has the stream's contents at the transaction whose info is in the stateHash commit, or None if the
+    # basis stream's data wasn't retrieved up to this transaction or if `accurev diff` between the stream and its basis stream isn't empty.
+    # If isExactMatchRequired is not set these checks are skipped and the commit is only an approximation of the stream's contents.
+    def GetBasisDataCommit(self, stream, dataRef, stateHash, transaction, isExactMatchRequired=True):
+        streamsXml, streams = self.GetStreamsInfo(ref=stateHash)
+        streamAtTr = streams.getStream(stream.streamNumber) if streams is not None else None
+        if streamAtTr is None or streamAtTr.basisStreamNumber is None:
+            return None
+        basisStream = streams.getStream(streamAtTr.basisStreamNumber)
+        if basisStream is None:
+            return None
+
+        depotNumber, streamNumber, remainder = self.ParseStreamRef(ref=dataRef)
+        basisStateRef, basisDataRef, basisHwmRef = self.GetStreamRefs(depot=depotNumber, streamNumber=basisStream.streamNumber)
+        if basisDataRef is None or self.gitRepo.catFile.info(basisDataRef) is None:
+            return None
+
+        # The data ref only has commits for the transactions that have changed the basis stream so its last commit before our transaction only
+        # has the basis stream's contents at our transaction if the basis stream was retrieved up to, or past, our transaction.
+        retrievedTrId = self.GetTransactionForRef(ref=basisDataRef)
+        hwmRefText = self.ReadFileRef(ref=basisHwmRef)
+        if hwmRefText is not None and len(hwmRefText) > 0:
+            retrievedTrId = CallOnNonNoneArgs(max, retrievedTrId, json.loads(hwmRefText).get("high-water-mark"))
+        if isExactMatchRequired and retrievedTrId < transaction.id:
+            logger.debug( "Basis stream {basis} of {stream} was only retrieved up to tr. {trId}, can't reuse its data for tr. {basisTrId}.".format(basis=basisStream.name, stream=streamAtTr.name, trId=retrievedTrId, basisTrId=transaction.id) )
+            return None
+
+        transactions = self.GetTransactionIndex(ref=basisDataRef)
+        basisTrIdList = [ trId for trId in transactions if trId <= transaction.id ] if transactions is not None else []
+        if len(basisTrIdList) == 0:
+            return None
+        basisCommitHash = transactions[max(basisTrIdList)]
+        if not isExactMatchRequired:
+            return basisCommitHash
+
+        diff, diffXml = self.TryDiff(streamName=streamAtTr.name, firstTrNumber=transaction.id, secondTrNumber=transaction.id, otherStreamName=basisStream.name)
+        if diff is None or len(diff.elements) != 0:
+            logger.debug( "Stream {stream} differs from its basis stream {basis} at tr. {trId}, can't reuse its data.".format(basis=basisStream.name, stream=streamAtTr.name, trId=transaction.id) )
+            return None
+
+        return basisCommitHash
+
+    # Returns the git ref in which the element version map of the given depot is stored (see GetElementVersionMap()).
+    def GetElementVersionsRef(self, depotNumber):
+        return u'{refsNS}cache/depots/{depotNumber}/element_versions'.format(refsNS=AccuRev2Git.gitRefsNamespace, depotNumber=depotNumber)
+
+    # Returns the map from an element version ("<eid>@<real version>") to the mode and hash ("<mode> <blob hash>") of the git blob that holds its
+    # contents. The element versions that a transaction brings into a stream are listed in its diff.xml and, since the same versions are promoted
+    # through many streams, their contents can be taken from the object database instead of being populated again (see MaterializeElementVersions()).
+    # The map is shared by all of the streams of the depot and stored in a hidden ref by RecordElementVersions().
+    def GetElementVersionMap(self, ref):
+        with self.refUpdateLock:
+            elementVersions = self.elementVersionMaps.get(ref)
+            if elementVersions is None:
+                elementVersions = {}
+                elementVersionsText = self.ReadFileRef(ref=ref)
+                if elementVersionsText is not None and len(elementVersionsText) > 0:
+                    elementVersions = json.loads(elementVersionsText)
+                self.elementVersionMaps[ref] = elementVersions
+        return elementVersions
+
+    # Returns the list of (element version key, repo relative path) tuples for the cacheable file versions that the diff's changes have after the hist's
+    # transaction (see GetDiffPostTransactionSide()). The list is empty if that side of the diff can't be told.
+    def GetDiffElementVersionList(self, diff, hist):
+        versionList = []
+        side = self.GetDiffPostTransactionSide(diff=diff, hist=hist)
+        if side is None:
+            return versionList
+        for element in diff.elements:
+            for change in element.changes:
+                postStream = change.stream1 if side == 1 else change.stream2
+                if postStream is None or postStream.name is None or postStream.eid is None or postStream.version is None or postStream.isDir:
+                    continue
+                if postStream.elemType not in cacheable_element_types or (change.what is not None and 'defunct' in change.what):
+                    continue
+                relPath = os.path.relpath(self.DepotPathToRepoPath(postStream.name), self.gitRepo.path)
+                if relPath.startswith('..') or relPath == '.' or relPath.split(os.sep)[0] == '.git':
+                    continue
+                versionList.append(('{eid}@{version}'.format(eid=postStream.eid, version=postStream.version), relPath))
+        return versionList
+
+    # Writes the file versions of the diff, whose contents are already in git, into the worktree so that the `accurev pop` that follows, which doesn't
+    # overwrite existing files, only downloads the versions we don't have. Returns the list of the files written.
+    def MaterializeElementVersions(self, diff, hist, elementVersions):
+        knownList = []
+        for key, relPath in self.GetDiffElementVersionList(diff=diff, hist=hist):
+            entry = elementVersions.get(key)
+            if entry is not None:
+                mode, blobHash = entry.split(' ', 1)
+                knownList.append((relPath, mode, blobHash))
+        if len(knownList) == 0:
+            return []
+
+        writtenPathList = []
+        objList = self.gitRepo.catFile.contents_list([ blobHash for relPath, mode, blobHash in knownList ])
+        for (relPath, mode, blobHash), obj in zip(knownList, objList):
+            path = os.path.join(self.gitRepo.path, relPath)
+            if obj is None or obj[1] != 'blob' or os.path.lexists(path):
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(obj[2])
+            if mode == '100755':
+                os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+            writtenPathList.append(path)
+
+        logger.debug( "Materialized {n} of {m} changed files from the element version cache.".format(n=len(writtenPathList), m=len(knownList)) )
+        return writtenPathList
+
+    # Adds the git blobs of the element versions that the transactions have brought into the data ref commits to the element version map and stores
+    # it. The commitVersionList is a list of (commit hash, GetDiffElementVersionList() result) tuples.
+    def RecordElementVersions(self, ref, elementVersions, commitVersionList):
+        newEntries = {}
+        for commitHash, versionList in commitVersionList:
+            pathMap = OrderedDict((relPath.replace(os.sep, '/'), key) for key, relPath in versionList if key not in elementVersions and key not in newEntries)
+            pathList = list(pathMap.keys())
+            for i in range(0, len(pathList), 1000):
+                lsTreeOutput = self.gitRepo.raw_cmd([ u'git', u'ls-tree', u'-z', commitHash, u'--' ] + pathList[i:i + 1000])
+                if lsTreeOutput is None:
+                    logger.debug("Failed to list the element versions of commit {h}. Error:\n{err}".format(h=commitHash, err=self.gitRepo.lastStderr))
+                    break
+                for line in lsTreeOutput.split('\0'):
+                    if '\t' not in line:
+                        continue
+                    info, path = line.split('\t', 1)
+                    mode, objType, objHash = info.split()
+                    if objType == 'blob' and mode in [ '100644', '100755' ] and path in pathMap:
+                        newEntries[pathMap[path]] = '{mode} {hash}'.format(mode=mode, hash=objHash)
+
+        if len(newEntries) > 0:
+            with self.refUpdateLock:
+                elementVersions.update(newEntries)
+                self.WriteFileRef(ref=ref, text=json.dumps(elementVersions))
+            logger.debug("Recorded {n} new element versions in {r}.".format(n=len(newEntries), r=ref))
+
     # Uses the stateRef information to fetch the contents of the stream for each transaction that whose information was committed to the stateRef and commits it to the dataRef.
-    def RetrieveStreamData(self, stream, dataRef, stateRef):
+    # When a stateHashQueue is given the info commits on the stateRef, up to the stateTipHash commit (None if there weren't any), are processed first
+    # and then the info commits whose hashes are taken from the queue, as they are made, until None is taken from it (see RetrieveStreamPipelined()).
+    def RetrieveStreamData(self, stream, dataRef, stateRef, stateHashQueue=None, stateTipHash=None):
         # Check if the ref exists!
-        dataRefObj = self.gitRepo.raw_cmd(['git', 'show-ref', dataRef])
-        assert dataRefObj is None or len(dataRefObj) != 0, "Invariant error! Expected non-empty string returned by git show-ref, but got '{str}'".format(s=dataRefObj)
+        dataRefObj = self.gitRepo.catFile.info(dataRef)
+
+        isPipelined = (stateHashQueue is not None)
+        stateLogRef = stateTipHash if isPipelined else stateRef
+
+        # The info commits that are yet to be processed, oldest first.
+        pendingHashList = []
+        isQueueDone = not isPipelined
+        # Moves the info commits from the stateHashQueue to the pendingHashList until it has maxCount of them, only waiting for the info retrieval
+        # if there is nothing to process.
+        def fillPendingHashList(maxCount):
+            nonlocal isQueueDone
+            while not isQueueDone and len(pendingHashList) < maxCount:
+                try:
+                    stateHash = stateHashQueue.get(block=(len(pendingHashList) == 0))
+                except queue.Empty:
+                    return
+                if stateHash is None:
+                    isQueueDone = True
+                else:
+                    pendingHashList.append(stateHash)
 
         # Either checkout last state or make the initial commit for a new dataRef.
         lastTrId = None
         stateHashList = None
+        firstPopStartTime, firstPopSeconds = None, None
         if dataRefObj is not None:
             # Find the last transaction number that we processed on the dataRef.
             lastTrId = self.GetTransactionForRef(ref=dataRef)
@@ -1406,11 +2725,13 @@ class AccuRev2Git(object):
                 return (None, None)
 
             # Get the list of new hashes that have been committed to the stateRef but we haven't processed on the dataRef just yet.
-            stateHashList = self.GetGitLogList(ref=stateRef, afterCommitHash=lastStateCommitHash, gitLogFormat='%H')
+            stateHashList = self.GetGitLogList(ref=stateLogRef, afterCommitHash=lastStateCommitHash, gitLogFormat='%H') if stateLogRef is not None else []
             if stateHashList is None:
                 logger.error("Couldn't get the commit hash list to process from the Accurev state ref {stateRef}.".format(stateRef=stateRef))
                 return (None, None)
-            elif len(stateHashList) == 0:
+            pendingHashList.extend(reversed(stateHashList))
+            fillPendingHashList(1)
+            if len(pendingHashList) == 0:
                 logger.error( "{dataRef} is upto date. Couldn't load any more transactions after tr. ({trId}) from Accurev state ref {stateRef}.".format(trId=lastTrId, dataRef=dataRef, stateRef=stateRef, lastHash=lastStateCommitHash) )
 
                 # Get the first transaction that we are about to process.
@@ -1425,19 +2746,26 @@ class AccuRev2Git(object):
             # We shouldn't do this earlier since if there's nothing to do we can skip this expensive operation.
             self.SafeCheckout(ref=dataRef, doReset=True, doClean=True)
 
+            # The git fast-import commits are made on top of the last commit, which we need to know explicitly.
+            commitHash = None
+            if self.GetFastImport() is not None:
+                commitHash = self.GetLastCommitHash(ref=dataRef)
+
         else:
             # Get all the hashes from the stateRef since we need to process them all.
-            stateHashList = self.GetGitLogList(ref=stateRef, gitLogFormat='%H')
+            stateHashList = self.GetGitLogList(ref=stateLogRef, gitLogFormat='%H') if stateLogRef is not None else []
             if stateHashList is None:
                 logger.warning("Couldn't get the commit hash list to process from the Accurev state ref {stateRef}.".format(stateRef=stateRef))
                 return (None, None)
+            pendingHashList.extend(reversed(stateHashList))
+            fillPendingHashList(1)
 
-            if len(stateHashList) == 0:
+            if len(pendingHashList) == 0:
                 logger.error( "{dataRef} is upto date. No transactions available in Accurev state ref {stateRef}. git log {stateRef} returned empty.".format(dataRef=dataRef, stateRef=stateRef) )
                 return (None, None)
 
-            # Remove the first hash (last item) from the processing list and process it immediately.
-            stateHash = stateHashList.pop()
+            # Remove the first hash from the processing list and process it immediately.
+            stateHash = pendingHashList.pop(0)
             assert stateHash is not None and len(stateHash) != 0, "Invariant error! We shouldn't have empty strings in the stateHashList"
 
             logger.info( "No {dr} found. Processing {h} on {sr} first.".format(dr=dataRef, h=self.ShortHash(stateHash), sr=stateRef) )
@@ -1452,111 +2780,292 @@ class AccuRev2Git(object):
             self.gitRepo.rm(fileList=['.'], force=True, recursive=True)
             self.ClearGitRepo()
 
-            # Populate the stream contents from accurev
-            popResult = self.TryPop(streamName=stream.name, transaction=tr, overwrite=True)
-            if not popResult:
-                logger.error( "accurev pop failed for {trId} on {dataRef}".format(trId=tr.id, dataRef=dataRef) )
-                return (None, None)
+            # Reuse the basis stream's data, if we have it, instead of populating the whole stream.
+            basisTreeHash = None
+            basisCommitHash = self.GetBasisDataCommit(stream=stream, dataRef=dataRef, stateHash=stateHash, transaction=tr)
+            if basisCommitHash is not None:
+                basisTreeHash = self.GetTreeFromRef(ref=basisCommitHash)
+                if basisTreeHash is None or self.gitRepo.raw_cmd([ u'git', u'-c', u'core.autocrlf=false', u'read-tree', u'--reset', u'-u', basisTreeHash ]) is None:
+                    logger.warning( "Failed to check out the basis stream's data {h} for tr. {trId}. Populating instead...".format(h=self.ShortHash(basisCommitHash), trId=tr.id) )
+                    self.gitRepo.rm(fileList=['.'], force=True, recursive=True)
+                    self.ClearGitRepo()
+                    basisTreeHash = None
+
+            if basisTreeHash is None:
+                # Populate the stream contents from accurev. Its basis stream's data, while it differs, gives us the layout for a sharded populate.
+                firstPopStartTime = time.monotonic()
+                layoutRef = None
+                if self.config.accurev.populateWorkers > 1:
+                    layoutRef = self.GetBasisDataCommit(stream=stream, dataRef=dataRef, stateHash=stateHash, transaction=tr, isExactMatchRequired=False)
+                popResult = self.TryPopSharded(streamName=stream.name, transaction=tr, layoutRef=layoutRef)
+                if not popResult:
+                    logger.error( "accurev pop failed for {trId} on {dataRef}".format(trId=tr.id, dataRef=dataRef) )
+                    return (None, None)
 
             # Make first commit.
-            commitHash = self.Commit(transaction=tr, allowEmptyCommit=True, messageOverride="transaction {trId}".format(trId=tr.id), parents=[], ref=dataRef, authorIsCommitter=True)
+            if basisTreeHash is not None:
+                logger.info( "{0} reusing the data of its basis stream, commit {1}, for tr. {2}".format(stream.name, self.ShortHash(basisCommitHash), tr.id) )
+                commitHash = self.Commit(transaction=tr, allowEmptyCommit=True, messageOverride="transaction {trId}".format(trId=tr.id), parents=[], treeHash=basisTreeHash, ref=dataRef, checkout=False, authorIsCommitter=True)
+            elif self.GetFastImport() is not None:
+                commitHash = self.FastImportCommit(transaction=tr, ref=dataRef, parents=[], messageOverride="transaction {trId}".format(trId=tr.id), fileList=self.GetFastImportFileList(preserveEmptyDirs=True), authorIsCommitter=True)
+            else:
+                commitHash = self.Commit(transaction=tr, allowEmptyCommit=True, messageOverride="transaction {trId}".format(trId=tr.id), parents=[], ref=dataRef, authorIsCommitter=True)
             if commitHash is None:
                 # The first streams mkstream transaction will be empty so we may end up with an empty commit.
                 logger.error( "{0} first commit has failed.".format(stream.name) )
                 return (None, None)
             else:
-                if self.gitRepo.checkout(branchName=dataRef) is None:
+                if self.fastImport is not None:
+                    if not self.SyncHeadWithFastImport(commitHash):
+                        logger.error( "{0} failed to checkout data ref {1}. Aborting!".format(stream.name, dataRef) )
+                        return (None, None)
+                elif self.gitRepo.checkout(branchName=dataRef) is None:
                     logger.error( "{0} failed to checkout data ref {1}. Aborting!".format(stream.name, dataRef) )
                     return (None, None)
 
                 logger.info( "stream {streamName}: tr. #{trId} {trType} -> commit {hash} on {ref}".format(streamName=stream.name, trId=tr.id, trType=tr.Type, hash=self.ShortHash(commitHash), ref=dataRef) )
+                if firstPopStartTime is not None:
+                    firstPopSeconds = time.monotonic() - firstPopStartTime
 
         # Find the last transaction number that we processed on the dataRef.
-        lastStateTrId = self.GetTransactionForRef(ref=stateRef)
+        # Note: When pipelined the stateRef is still being extended so we can only tell how far it has got so far.
+        lastStateTrId = self.GetTransactionForRef(ref=stateRef) if not isPipelined or self.gitRepo.catFile.info(stateRef) is not None else lastTrId
         if lastStateTrId is None:
             logger.error( "Failed to get last transaction processed on the {ref}.".format(ref=stateRef) )
             return (None, None)
         # Notify the user what we are processing.
-        logger.info( "Processing stream data for {0} : {1} - {2}".format(stream.name, lastTrId, lastStateTrId) )
+        logger.info( "Processing stream data for {0} : {1} - {2}{3}".format(stream.name, lastTrId, lastStateTrId, " (and onwards, as the info is retrieved)" if isPipelined else "") )
+
+        # The contents of the element versions that we've already committed, on any stream of the depot, don't need to be populated again.
+        depotNumber, streamNumber, remainder = self.ParseStreamRef(ref=dataRef)
+        elementVersionsRef = self.GetElementVersionsRef(depotNumber=depotNumber) if depotNumber is not None else None
+        elementVersions = self.GetElementVersionMap(ref=elementVersionsRef) if elementVersionsRef is not None else None
+        commitVersionList = []
+
+        # Choose between the diff and pop methods for each transaction, see PopulateCostModel.
+        costModel = None
+        if self.config.method != "pop":
+            treeEntryCount = self.CountIndexEntries()
+            if treeEntryCount is not None:
+                costModel = PopulateCostModel(treeEntryCount=treeEntryCount)
+                if firstPopSeconds is not None:
+                    costModel.RecordPop(seconds=firstPopSeconds)
 
         # Process all the hashes in the list
-        for stateHash in reversed(stateHashList):
-            assert stateHash is not None, "Invariant error! Hashes in the stateHashList cannot be none here!"
-            assert len(stateHash) != 0, "Invariant error! Excess new lines returned by `git log`? Probably safe to skip but shouldn't happen."
+        # The changed elements of the next prefetchWindow transactions are populated concurrently into staging directories so that the accurev
+        # network latency overlaps with the git work done for the current transaction.
+        prefetchWindow = self.config.accurev.prefetchWindow if self.config.method != "pop" else 0
+        prefetchExecutor, prefetchMap, stagingRootPath = None, {}, None
+        if prefetchWindow > 0:
+            prefetchExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=prefetchWindow)
+            stagingRootPath = tempfile.mkdtemp(prefix='ac2git_prefetch_', dir=os.path.dirname(os.path.abspath(self.gitRepo.path)))
+        try:
+            while True:
+                fillPendingHashList(prefetchWindow + 1)
+                if len(pendingHashList) == 0:
+                    break
+                stateHash = pendingHashList[0]
+                assert stateHash is not None, "Invariant error! Hashes in the stateHashList cannot be none here!"
+                assert len(stateHash) != 0, "Invariant error! Excess new lines returned by `git log`? Probably safe to skip but shouldn't happen."
 
-            # Get the diff information. (if any)
-            diffXml, diff = self.GetDiffInfo(ref=stateHash)
+                if prefetchExecutor is not None:
+                    for nextHash in pendingHashList[:prefetchWindow + 1]:
+                        if nextHash not in prefetchMap:
+                            prefetchMap[nextHash] = self.StartPrefetchPop(executor=prefetchExecutor, stream=stream, stateHash=nextHash, stagingRootPath=stagingRootPath)
+                pendingHashList.pop(0)
 
-            # Get the hist information.
-            histXml, hist = self.GetHistInfo(ref=stateHash)
+                # Get the diff information. (if any)
+                diffXml, diff = self.GetDiffInfo(ref=stateHash)
 
-            # Get the stream information.
-            streamsXml, streams = self.GetStreamsInfo(ref=stateHash)
+                # Get the hist information.
+                histXml, hist = self.GetHistInfo(ref=stateHash)
 
-            deletedPathList = None
-            usePopMethod = (self.config.method == "pop")
-            if diff is None:
-                logger.warning("Accurev diff is unavailable for this transaction. Fallback to `pop method`...")
-                usePopMethod = True
-            elif not usePopMethod:
-                try:
-                    warning = "Error trying to delete changed elements. Fallback to `pop method`..."
-                    deletedPathList = self.DeleteDiffItemsFromRepo(diff=diff)
-                    # Remove all the empty directories (this includes directories which contain an empty .gitignore file since that's what we is done to preserve them)
-                    warning = "Error trying to delete empty directories. Fallback to `pop method`..."
-                    self.DeleteEmptyDirs()
-                except:
+                # Get the stream information.
+                streamsXml, streams = self.GetStreamsInfo(ref=stateHash)
+
+                deletedPathList = None
+                changedPathList, parentDirList = None, None
+                usePopMethod = (self.config.method == "pop")
+                isPrefetched = False
+                treeEntryCount = None
+                trStartTime = time.monotonic()
+                if diff is None:
+                    logger.warning("Accurev diff is unavailable for this transaction. Fallback to `pop method`...")
                     usePopMethod = True
-                    logger.warning(warning)
-                    # This might be ok only in the case when the files/directories were changed but not in the case when there
-                    # was a deletion that occurred. Fallback to using the pop method just to be safe.
+                elif not usePopMethod and costModel is not None and costModel.IsPopCheaper(elementCount=len(diff.elements)):
+                    diffCost, popCost = costModel.Estimate(elementCount=len(diff.elements))
+                    logger.info( "{0} tr. {1} changes {2} of about {3} elements. Populating the whole stream instead (estimated cost {4:.1f} vs {5:.1f} for the diff).".format(stream.name, hist.transactions[0].id, len(diff.elements), costModel.treeEntryCount, popCost, diffCost) )
+                    usePopMethod = True
+                elif not usePopMethod:
+                    try:
+                        warning = "Error trying to delete changed elements. Fallback to `pop method`..."
+                        deletedPathList = self.DeleteDiffItemsFromRepo(diff=diff)
+                        # Remove all the empty directories (this includes directories which contain an empty .gitignore file since that's what we is done to preserve them)
+                        warning = "Error trying to delete empty directories. Fallback to `pop method`..."
+                        if deletedPathList == [ self.gitRepo.path ]:
+                            self.DeleteEmptyDirs()
+                        else:
+                            # Only the changed elements and their parent directories can be affected by this transaction so the rest of the worktree,
+                            # and the index entries for it, can be carried over from the previous commit as is.
+                            changedPathList = list(OrderedDict.fromkeys(deletedPathList + [ self.DepotPathToRepoPath(name) for name in self.GetDiffElementPathList(diff=diff) ]))
+                            parentDirList = list(OrderedDict.fromkeys([ os.path.dirname(path) for path in changedPathList ]))
+                            self.DeleteEmptyDirs(pathList=parentDirList, recursive=False)
+                    except:
+                        usePopMethod = True
+                        changedPathList, parentDirList = None, None
+                        logger.warning(warning)
+                        # This might be ok only in the case when the files/directories were changed but not in the case when there
+                        # was a deletion that occurred. Fallback to using the pop method just to be safe.
+
+                if usePopMethod:
+                    self.ClearGitRepo()
 
-            if usePopMethod:
-                self.ClearGitRepo()
+                tr = hist.transactions[0]
+                streamAtTr = streams.getStream(stream.streamNumber)
+                if streamAtTr is None:
+                    raise Exception("Failed to find stream {name} ({num}) in {list}".format(name=stream.name, num=stream.streamNumber, list=[(s.name, s.streamNumber) for s in streams]))
+                else:
+                    stream = streamAtTr
 
-            tr = hist.transactions[0]
-            streamAtTr = streams.getStream(stream.streamNumber)
-            if streamAtTr is None:
-                raise Exception("Failed to find stream {name} ({num}) in {list}".format(name=stream.name, num=stream.streamNumber, list=[(s.name, s.streamNumber) for s in streams]))
-            else:
-                stream = streamAtTr
+                # Work out the source and destination streams for the promote (for the purposes of the commit message info).
+                destStreamName, destStreamNumber = hist.toStream()
+                destStream = None
+                if destStreamNumber is not None:
+                    destStream = streams.getStream(destStreamNumber)
+                    if destStream is None:
+                        raise Exception("Failed to find stream {name} ({num}) in {list}".format(name=destStreamName, num=destStreamNumber, list=[(s.name, s.streamNumber) for s in streams]))
 
-            # Work out the source and destination streams for the promote (for the purposes of the commit message info).
-            destStreamName, destStreamNumber = hist.toStream()
-            destStream = None
-            if destStreamNumber is not None:
-                destStream = streams.getStream(destStreamNumber)
-                if destStream is None:
-                    raise Exception("Failed to find stream {name} ({num}) in {list}".format(name=destStreamName, num=destStreamNumber, list=[(s.name, s.streamNumber) for s in streams]))
+                srcStream = None
+                try:
+                    srcStreamName, srcStreamNumber = hist.fromStream()
+                    if srcStreamNumber is not None:
+                        srcStream = streams.getStream(srcStreamNumber)
+                        if srcStream is None:
+                            raise Exception("Failed to find stream {name} ({num}) in {list}".format(name=srcStreamName, num=srcStreamNumber, list=[(s.name, s.streamNumber) for s in streams]))
+                except:
+                    srcStreamName, srcStreamNumber = None, None
+
+                # Populate
+                logger.debug( "{0} pop: {1} {2}{3}".format(stream.name, tr.Type, tr.id, " to {0}".format(destStreamName) if destStreamName is not None else "") )
+                prefetch = prefetchMap.pop(stateHash, None)
+                if prefetch is not None and not usePopMethod and deletedPathList != [ self.gitRepo.path ] and self.ApplyPrefetchedPop(prefetch):
+                    logger.debug( "{0} applied prefetched pop for tr. {1}".format(stream.name, tr.id) )
+                    isPrefetched = True
+                else:
+                    materializedPathList = None
+                    if elementVersions is not None and not usePopMethod and deletedPathList != [ self.gitRepo.path ]:
+                        materializedPathList = self.MaterializeElementVersions(diff=diff, hist=hist, elementVersions=elementVersions)
+                    if changedPathList is not None and not usePopMethod:
+                        popResult = self.TryPopDiff(streamName=stream.name, transaction=tr, diff=diff, hist=hist, parentDirList=parentDirList, excludePathList=materializedPathList)
+                    elif usePopMethod and self.config.accurev.populateWorkers > 1:
+                        # The previous commit gives us the layout of the stream. The git fast-import commits are only readable after a checkpoint.
+                        self.FastImportCheckpoint()
+                        popResult = self.TryPopSharded(streamName=stream.name, transaction=tr, layoutRef=commitHash)
+                    else:
+                        popResult = self.TryPop(streamName=stream.name, transaction=tr, overwrite=usePopMethod)
+                    if not popResult:
+                        logger.error( "accurev pop failed for {trId} on {dataRef}".format(trId=tr.id, dataRef=dataRef) )
+                        return (None, None)
 
-            srcStream = None
-            try:
-                srcStreamName, srcStreamNumber = hist.fromStream()
-                if srcStreamNumber is not None:
-                    srcStream = streams.getStream(srcStreamNumber)
-                    if srcStream is None:
-                        raise Exception("Failed to find stream {name} ({num}) in {list}".format(name=srcStreamName, num=srcStreamNumber, list=[(s.name, s.streamNumber) for s in streams]))
-            except:
-                srcStreamName, srcStreamNumber = None, None
+                # Build the new tree from the previous commit's index by updating only the entries under the changed paths.
+                indexPathList = None
+                if changedPathList is not None and not usePopMethod:
+                    self.PreserveEmptyDirs(pathList=changedPathList)
+                    self.PreserveEmptyDirs(pathList=parentDirList, recursive=False)
+                    indexPathList = changedPathList + [ os.path.join(path, '.gitignore') for path in parentDirList ]
+
+                # Make the commit. Empty commits are allowed so that we match the state ref exactly (transaction for transaction).
+                # Reasoning: Empty commits are cheap and since these are not intended to be seen by the user anyway so we may as well make them to have a simpler mapping.
+                if self.fastImport is not None:
+                    if indexPathList is not None:
+                        # Replace the changed paths in the last commit's tree with what's in the worktree now.
+                        relPathList = self.GetRepoRelPathList(indexPathList)
+                        commitHash = self.FastImportCommit(transaction=tr, ref=dataRef, parents=[ commitHash ], messageOverride="transaction {trId}".format(trId=tr.id), deleteList=relPathList, fileList=self.GetFastImportFileList(relPathList=relPathList), authorIsCommitter=True)
+                    else:
+                        fileList = self.GetFastImportFileList(preserveEmptyDirs=True)
+                        treeEntryCount = len(fileList)
+                        commitHash = self.FastImportCommit(transaction=tr, ref=dataRef, parents=[ commitHash ], messageOverride="transaction {trId}".format(trId=tr.id), deleteAll=True, fileList=fileList, authorIsCommitter=True)
+                else:
+                    commitHash = self.Commit(transaction=tr, allowEmptyCommit=True, messageOverride="transaction {trId}".format(trId=tr.id), ref=dataRef, authorIsCommitter=True, indexPathList=indexPathList)
+                    if costModel is not None and indexPathList is None:
+                        treeEntryCount = self.CountIndexEntries()
+                if commitHash is None:
+                    logger.error( "Commit failed for {trId} on {dataRef}".format(trId=tr.id, dataRef=dataRef) )
+                    return (None, None)
+                else:
+                    logger.info( "stream {streamName}: tr. #{trId} {trType} -> commit {hash} on {ref} (end tr. {endTrId})".format(streamName=stream.name, trId=tr.id, trType=tr.Type, hash=self.ShortHash(commitHash), ref=dataRef, endTrId=lastStateTrId) )
+                    if elementVersions is not None and diff is not None:
+                        commitVersionList.append((commitHash, self.GetDiffElementVersionList(diff=diff, hist=hist)))
+                    if costModel is not None and not isPrefetched:
+                        if usePopMethod:
+                            costModel.RecordPop(seconds=(time.monotonic() - trStartTime), treeEntryCount=treeEntryCount)
+                        else:
+                            costModel.RecordDiff(elementCount=len(diff.elements), seconds=(time.monotonic() - trStartTime))
+        finally:
+            if prefetchExecutor is not None:
+                prefetchExecutor.shutdown(wait=True)
+                shutil.rmtree(stagingRootPath, ignore_errors=True)
 
-            # Populate
-            logger.debug( "{0} pop: {1} {2}{3}".format(stream.name, tr.Type, tr.id, " to {0}".format(destStreamName) if destStreamName is not None else "") )
-            popResult = self.TryPop(streamName=stream.name, transaction=tr, overwrite=usePopMethod)
-            if not popResult:
-                logger.error( "accurev pop failed for {trId} on {dataRef}".format(trId=tr.id, dataRef=dataRef) )
-                return (None, None)
+        if costModel is not None and costModel.popChosenCount > 0:
+            logger.info( "{0} populated the whole stream instead of the changed elements for {1} transactions, saving an estimated {2:.1f} seconds. {3}".format(stream.name, costModel.popChosenCount, costModel.secondsSaved, costModel) )
 
-            # Make the commit. Empty commits are allowed so that we match the state ref exactly (transaction for transaction).
-            # Reasoning: Empty commits are cheap and since these are not intended to be seen by the user anyway so we may as well make them to have a simpler mapping.
-            commitHash = self.Commit(transaction=tr, allowEmptyCommit=True, messageOverride="transaction {trId}".format(trId=tr.id), ref=dataRef, authorIsCommitter=True)
-            if commitHash is None:
-                logger.error( "Commit failed for {trId} on {dataRef}".format(trId=tr.id, dataRef=dataRef) )
-                return (None, None)
-            else:
-                logger.info( "stream {streamName}: tr. #{trId} {trType} -> commit {hash} on {ref} (end tr. {endTrId})".format(streamName=stream.name, trId=tr.id, trType=tr.Type, hash=self.ShortHash(commitHash), ref=dataRef, endTrId=lastStateTrId) )
+        if self.fastImport is not None and not self.SyncHeadWithFastImport(commitHash):
+            return (None, None)
+
+        if len(commitVersionList) > 0:
+            self.RecordElementVersions(ref=elementVersionsRef, elementVersions=elementVersions, commitVersionList=commitVersionList)
 
         return (tr, commitHash)
 
+    # Runs RetrieveStreamInfo() and RetrieveStreamData() concurrently, connected by a queue of at most pipelineDepth info commits, so that the accurev
+    # queries for the info of the next transactions overlap with the populating of the current one. The info is retrieved on a separate thread by a
+    # copy of this object with its own git repo object, so that the two don't share the cat-file processes, and without git fast-import since the data
+    # retrieval reads each info commit as soon as it is made. Returns the (stateTr, stateHash, dataTr, dataHash) tuple.
+    def RetrieveStreamPipelined(self, depot, stream, dataRef, stateRef, startTransaction, endTransaction, deadline=None):
+        stateRefObj = self.gitRepo.catFile.info(stateRef)
+        stateTipHash = stateRefObj[0] if stateRefObj is not None else None # The info commits after this one are taken from the queue.
+
+        producer = copy.copy(self)
+        producer.config = copy.copy(self.config)
+        producer.config.git = copy.copy(self.config.git)
+        producer.config.git.fastImport = False
+        producer.gitRepo = git.repo(self.gitRepo.path)
+        producer.fastImport = None
+        producer.transactionIndexes = {}
+
+        stateHashQueue = queue.Queue(maxsize=self.config.accurev.pipelineDepth)
+        stopEvent = threading.Event()
+        # Hands the info commit over to the data retrieval, waiting for it to catch up if it is pipelineDepth commits behind. Returns False if the
+        # data retrieval has stopped, in which case there's no point retrieving any more info.
+        def putStateHash(stateHash):
+            while not stopEvent.is_set():
+                try:
+                    stateHashQueue.put(stateHash, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def retrieveInfo():
+            try:
+                return producer.RetrieveStreamInfo(depot=depot, stream=stream, stateRef=stateRef, startTransaction=startTransaction, endTransaction=endTransaction, deadline=deadline, onCommit=putStateHash)
+            finally:
+                putStateHash(None)
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=threading.current_thread().name) as executor:
+                infoFuture = executor.submit(retrieveInfo)
+                try:
+                    dataTr, dataHash = self.RetrieveStreamData(stream=stream, dataRef=dataRef, stateRef=stateRef, stateHashQueue=stateHashQueue, stateTipHash=stateTipHash)
+                finally:
+                    stopEvent.set()
+                stateTr, stateHash = infoFuture.result() # Re-raises any exception from the info retrieval.
+        finally:
+            producer.gitRepo.catFile.close()
+
+        self.infoDeadlineReached = producer.infoDeadlineReached
+        return stateTr, stateHash, dataTr, dataHash
+
     # Retrieves all of the stream information from accurev, needed for later processing, and stores it in git using the \a dataRef and \a stateRef.
     # The retrieval and processing of the accurev information is separated in order to optimize processing of subsets of streams in a depot. For example,
     # if we have processed 7 streams in a depot and now wish to add an 8th we would have to start processing from the beginning because the merge points
@@ -1572,34 +3081,137 @@ class AccuRev2Git(object):
                 prevHwm = prevHwmMetadata.get("high-water-mark")
                 startTransaction = CallOnNonNoneArgs(max, int(startTransaction), prevHwm) # make sure we start from the transaction we last processed.
 
-        logger.info( "Retrieving stream {0} info from Accurev for transaction range : {1} - {2}".format(stream.name, startTransaction, endTransaction) )
-        stateTr, stateHash = self.RetrieveStreamInfo(depot=depot, stream=stream, stateRef=stateRef, startTransaction=startTransaction, endTransaction=endTransaction)
-        logger.info( "Retrieving stream {0} data from Accurev for transaction range : {1} - {2}".format(stream.name, startTransaction if prevHwm is None else prevHwm, endTransaction) )
-        dataTr,  dataHash  = self.RetrieveStreamData(stream=stream, dataRef=dataRef, stateRef=stateRef) # Note: In case the last retrieval was interrupted, we will retrieve those transactions first.
-
-        if stateTr is not None and dataTr is not None:
-            newHwm = CallOnNonNoneArgs(max, dataTr.id, prevHwm)
-            if stateTr.id != dataTr.id:
-                logger.error( "Missmatch while retrieving stream {streamName} (id: streamId), the data ref ({dataRef}) is on tr. {dataTr} while the state ref ({stateRef}) is on tr. {stateTr}.".format(streamName=stream.name, streamId=stream.streamNumber, dataTr=dataTr.id, stateTr=stateTr.id, dataRef=dataRef, stateRef=stateRef) )
-            else:
-                newHwm = CallOnNonNoneArgs(max, int(endTransaction), newHwm)
+        # The transaction range is retrieved in batches of checkpointTransactions transactions (or checkpointMinutes minutes of info retrieval) with
+        # the high-water-mark updated after each one so that an interruption only loses the batch in progress.
+        endTrNumber = int(endTransaction)
+        batchStart = int(startTransaction)
+        checkpointTransactions = self.config.accurev.checkpointTransactions
+        checkpointSeconds = self.config.accurev.checkpointMinutes * 60
+        if (checkpointTransactions > 0 or checkpointSeconds > 0) and self.gitRepo.catFile.info(stateRef) is None:
+            # There's no point checkpointing the transactions before the stream was created.
+            mkstreamTrId = self.GetMkstreamTransactionNumber(depot=depot, streamNumber=stream.streamNumber, useCache=self.config.accurev.UseCommandCache())
+            if mkstreamTrId is not None:
+                batchStart = max(batchStart, mkstreamTrId)
+
+        dataTr, dataHash = None, None
+        while True:
+            batchEnd = endTrNumber if checkpointTransactions <= 0 else min(endTrNumber, batchStart + checkpointTransactions)
+            deadline = None if checkpointSeconds <= 0 else time.time() + checkpointSeconds
 
-            # Success! Update the high water mark for the stream.
-            if hwmRef is not None:
-                metadata = { "high-water-mark": newHwm }
-                if self.WriteFileRef(ref=hwmRef, text=json.dumps(metadata)) != True:
-                    logger.error( "Failed to write the high-water-mark to ref {ref}".format(ref=hwmRef) )
+            try:
+                if self.config.accurev.pipelineDepth > 0:
+                    logger.info( "Retrieving stream {0} info and data from Accurev for transaction range : {1} - {2}".format(stream.name, batchStart, batchEnd) )
+                    stateTr, stateHash, dataTr, dataHash = self.RetrieveStreamPipelined(depot=depot, stream=stream, dataRef=dataRef, stateRef=stateRef, startTransaction=batchStart, endTransaction=batchEnd, deadline=deadline)
                 else:
-                    logger.info( "Updated the high-water-mark to ref {ref} as {trId}".format(ref=hwmRef, trId=newHwm) )
-        elif stateTr is not None and dataTr is None:
-            logger.error( "Missmatch while retrieving stream {streamName} (id: {streamId}), the state ref ({stateRef}) is on tr. {stateTr} but the data ref ({dataRef}) wasn't retrieved.".format(streamName=stream.name, streamId=stream.streamNumber, stateTr=stateTr.id, dataRef=dataRef, stateRef=stateRef) )
-        elif stateTr is None:
-            logger.error( "While retrieving stream {streamName} (id: {streamId}), the state ref ({stateRef}) failed.".format(streamName=stream.name, streamId=stream.streamNumber, dataRef=dataRef, stateRef=stateRef) )
+                    logger.info( "Retrieving stream {0} info from Accurev for transaction range : {1} - {2}".format(stream.name, batchStart, batchEnd) )
+                    stateTr, stateHash = self.RetrieveStreamInfo(depot=depot, stream=stream, stateRef=stateRef, startTransaction=batchStart, endTransaction=batchEnd, deadline=deadline)
+                    self.FastImportCheckpoint() # The data retrieval reads the state ref.
+                    logger.info( "Retrieving stream {0} data from Accurev for transaction range : {1} - {2}".format(stream.name, batchStart if prevHwm is None else prevHwm, batchEnd) )
+                    dataTr,  dataHash  = self.RetrieveStreamData(stream=stream, dataRef=dataRef, stateRef=stateRef) # Note: In case the last retrieval was interrupted, we will retrieve those transactions first.
+            finally:
+                # The refs must be up to date before the high-water-mark is moved past them.
+                self.CloseFastImport()
+
+            newHwm = None
+            if stateTr is not None and dataTr is not None:
+                newHwm = CallOnNonNoneArgs(max, dataTr.id, prevHwm)
+                if stateTr.id != dataTr.id:
+                    logger.error( "Missmatch while retrieving stream {streamName} (id: streamId), the data ref ({dataRef}) is on tr. {dataTr} while the state ref ({stateRef}) is on tr. {stateTr}.".format(streamName=stream.name, streamId=stream.streamNumber, dataTr=dataTr.id, stateTr=stateTr.id, dataRef=dataRef, stateRef=stateRef) )
+                elif not self.infoDeadlineReached:
+                    newHwm = CallOnNonNoneArgs(max, batchEnd, newHwm)
+                # else: The info retrieval stopped early, at the deadline, so the data ref's transaction is as far as we've got.
+
+                # Success! Update the high water mark for the stream.
+                if hwmRef is not None:
+                    metadata = { "high-water-mark": newHwm }
+                    if self.WriteFileRef(ref=hwmRef, text=json.dumps(metadata)) != True:
+                        logger.error( "Failed to write the high-water-mark to ref {ref}".format(ref=hwmRef) )
+                    else:
+                        logger.info( "Updated the high-water-mark to ref {ref} as {trId} (end tr. {endTrId})".format(ref=hwmRef, trId=newHwm, endTrId=endTrNumber) )
+            elif stateTr is not None and dataTr is None:
+                logger.error( "Missmatch while retrieving stream {streamName} (id: {streamId}), the state ref ({stateRef}) is on tr. {stateTr} but the data ref ({dataRef}) wasn't retrieved.".format(streamName=stream.name, streamId=stream.streamNumber, stateTr=stateTr.id, dataRef=dataRef, stateRef=stateRef) )
+            elif stateTr is None:
+                logger.error( "While retrieving stream {streamName} (id: {streamId}), the state ref ({stateRef}) failed.".format(streamName=stream.name, streamId=stream.streamNumber, dataRef=dataRef, stateRef=stateRef) )
+
+            if newHwm is None or stateTr.id != dataTr.id or newHwm >= endTrNumber or (prevHwm is not None and newHwm <= prevHwm):
+                break # Done, failed or not making progress.
+            prevHwm, batchStart = newHwm, newHwm
 
         return dataTr, dataHash
 
+    # Retrieves the stream and pushes its hidden refs to the configured remotes.
+    def RetrieveAndPushStream(self, depot, streamInfo, endTransaction):
+        stateRef, dataRef, hwmRef  = self.GetStreamRefs(depot=depot, streamNumber=streamInfo.streamNumber)
+        assert stateRef is not None and dataRef is not None and len(stateRef) != 0 and len(dataRef) != 0, "Invariant error! The state ({sr}) and data ({dr}) refs must not be None!".format(sr=stateRef, dr=dataRef)
+        tr, commitHash = self.RetrieveStream(depot=depot, stream=streamInfo, dataRef=dataRef, stateRef=stateRef, hwmRef=hwmRef, startTransaction=self.config.accurev.startTransaction, endTransaction=endTransaction)
+
+        if self.config.git.remoteMap is not None:
+            refspec = "{dataRef}:{dataRef} {stateRef}:{stateRef}".format(dataRef=dataRef, stateRef=stateRef)
+            for remoteName in self.config.git.remoteMap:
+                pushOutput = None
+                logger.info("Pushing '{refspec}' to '{remote}'...".format(remote=remoteName, refspec=refspec))
+                try:
+                    pushCmd = "git push {remote} {refspec}".format(remote=remoteName, refspec=refspec)
+                    pushOutput = subprocess.check_output(pushCmd.split(), cwd=self.gitRepo.path, stderr=subprocess.STDOUT).decode('utf-8')
+                    logger.info("Push to '{remote}' succeeded:".format(remote=remoteName))
+                    logger.info(pushOutput)
+                except subprocess.CalledProcessError as e:
+                    logger.error("Push to '{remote}' failed!".format(remote=remoteName))
+                    logger.error("'{cmd}', returned {returncode} and failed with:".format(cmd="' '".join(e.cmd), returncode=e.returncode))
+                    logger.error("{output}".format(output=e.output.decode('utf-8')))
+
+        return tr, commitHash
+
+    # Retrieves the streams using workerCount threads. Each worker gets its own git worktree, which shares the object database and refs with our
+    # repository but has its own index, HEAD and working directory, so that the accurev pop commands and the commits of different streams don't
+    # interfere with each other. Each stream is retrieved into its own hidden refs and the updates of shared refs are serialized by refUpdateLock.
+    def RetrieveStreamsConcurrently(self, depot, streamInfoList, endTransaction, workerCount):
+        # The worktrees must not be under the .git/ directory of the repo (see git.GetGitDirPrefix()) so they are put next to it instead.
+        worktreesPath = tempfile.mkdtemp(prefix='ac2git_worktrees_', dir=os.path.dirname(os.path.abspath(self.gitRepo.path)))
+        depotsRef = '{depotsNS}info'.format(depotsNS=self.GetDepotRefsNamespace())
+        streamQueue = queue.Queue()
+        for streamInfo in streamInfoList:
+            streamQueue.put(streamInfo)
+
+        def retrieveWorker(worker):
+            while True:
+                try:
+                    streamInfo = streamQueue.get_nowait()
+                except queue.Empty:
+                    return
+                worker.RetrieveAndPushStream(depot=depot, streamInfo=streamInfo, endTransaction=endTransaction)
+
+        worktreeList, workerList = [], []
+        try:
+            for i in range(0, workerCount):
+                worktreePath = os.path.join(worktreesPath, str(i))
+                if self.gitRepo.raw_cmd([ u'git', u'worktree', u'add', u'--detach', worktreePath, depotsRef ]) is None:
+                    raise Exception("Failed to create git worktree {p}. Err: {err}".format(p=worktreePath, err=self.gitRepo.lastStderr))
+                worktreeList.append(worktreePath)
+
+                worker = copy.copy(self)
+                worker.gitRepo = git.repo(worktreePath)
+                worker.lastStreamsCheckpoint = None
+                worker.fastImport = None
+                worker.transactionIndexes = {}
+                workerList.append(worker)
+
+            logger.info("Retrieving {n} streams using {w} workers.".format(n=len(streamInfoList), w=workerCount))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workerCount, thread_name_prefix=threading.current_thread().name) as executor:
+                futureList = [ executor.submit(retrieveWorker, worker) for worker in workerList ]
+                for future in futureList:
+                    future.result() # Re-raises any exception from the worker.
+        finally:
+            for worker in workerList:
+                worker.gitRepo.catFile.close()
+            for worktreePath in worktreeList:
+                if self.gitRepo.raw_cmd([ u'git', u'worktree', u'remove', u'--force', worktreePath ]) is None:
+                    logger.warning("Failed to remove git worktree {p}. Err: {err}".format(p=worktreePath, err=self.gitRepo.lastStderr))
+            shutil.rmtree(worktreesPath, ignore_errors=True)
+            self.gitRepo.raw_cmd([ u'git', u'worktree', u'prune' ])
+
     def RetrieveStreams(self):
-        if self.config.accurev.commandCacheFilename is not None:
+        if self.config.accurev.commandCacheFilename is not None and not self.isSharedSession:
             accurev.ext.enable_command_cache(self.config.accurev.commandCacheFilename)
         
         streamMap = self.GetStreamMap()
@@ -1611,7 +3223,12 @@ class AccuRev2Git(object):
             return
         endTr = endTrHist.transactions[0]
 
-        # Retrieve stream information from Accurev and store it inside git.
+        # Extend the stream definition timeline once for the whole run so that retrieving each stream doesn't have to.
+        if depot is not None and len(depot) > 0:
+            self.GetStreamTimeline(depot=depot, endTrNumber=endTr.id)
+
+        # Get the stream information for all of the streams first so that their retrieval can be shared between the workers.
+        streamInfoList = []
         for stream in streamMap:
             streamInfo = None
             try:
@@ -1626,26 +3243,28 @@ class AccuRev2Git(object):
             if depot is None or len(depot) == 0:
                 depot = streamInfo.depotName
 
-            stateRef, dataRef, hwmRef  = self.GetStreamRefs(depot=depot, streamNumber=streamInfo.streamNumber)
-            assert stateRef is not None and dataRef is not None and len(stateRef) != 0 and len(dataRef) != 0, "Invariant error! The state ({sr}) and data ({dr}) refs must not be None!".format(sr=stateRef, dr=dataRef)
-            tr, commitHash = self.RetrieveStream(depot=depot, stream=streamInfo, dataRef=dataRef, stateRef=stateRef, hwmRef=hwmRef, startTransaction=self.config.accurev.startTransaction, endTransaction=endTr.id)
+            streamInfoList.append(streamInfo)
 
-            if self.config.git.remoteMap is not None:
-                refspec = "{dataRef}:{dataRef} {stateRef}:{stateRef}".format(dataRef=dataRef, stateRef=stateRef)
-                for remoteName in self.config.git.remoteMap:
-                    pushOutput = None
-                    logger.info("Pushing '{refspec}' to '{remote}'...".format(remote=remoteName, refspec=refspec))
-                    try:
-                        pushCmd = "git push {remote} {refspec}".format(remote=remoteName, refspec=refspec)
-                        pushOutput = subprocess.check_output(pushCmd.split(), stderr=subprocess.STDOUT).decode('utf-8')
-                        logger.info("Push to '{remote}' succeeded:".format(remote=remoteName))
-                        logger.info(pushOutput)
-                    except subprocess.CalledProcessError as e:
-                        logger.error("Push to '{remote}' failed!".format(remote=remoteName))
-                        logger.error("'{cmd}', returned {returncode} and failed with:".format(cmd="' '".join(e.cmd), returncode=e.returncode))
-                        logger.error("{output}".format(output=e.output.decode('utf-8')))
-        
-        if self.config.accurev.commandCacheFilename is not None:
+        # Retrieve the basis streams before their child streams so that a new child stream can reuse its basis stream's data (see GetBasisDataCommit()).
+        streamInfoMap = { streamInfo.streamNumber: streamInfo for streamInfo in streamInfoList }
+        def basisDepth(streamInfo):
+            depth, visited = 0, set()
+            while streamInfo.basisStreamNumber in streamInfoMap and streamInfo.basisStreamNumber not in visited:
+                visited.add(streamInfo.basisStreamNumber)
+                streamInfo = streamInfoMap[streamInfo.basisStreamNumber]
+                depth += 1
+            return depth
+        streamInfoList.sort(key=basisDepth)
+
+        # Retrieve stream information from Accurev and store it inside git.
+        workerCount = min(self.config.accurev.retrieveWorkers, len(streamInfoList))
+        if workerCount > 1:
+            self.RetrieveStreamsConcurrently(depot=depot, streamInfoList=streamInfoList, endTransaction=endTr.id, workerCount=workerCount)
+        else:
+            for streamInfo in streamInfoList:
+                self.RetrieveAndPushStream(depot=depot, streamInfo=streamInfo, endTransaction=endTr.id)
+
+        if self.config.accurev.commandCacheFilename is not None and not self.isSharedSession:
             accurev.ext.disable_command_cache()
 
     # Lists the .git/... directory that contains all the stream refs and returns the file list as its result
@@ -1706,6 +3325,18 @@ class AccuRev2Git(object):
                     logger.debug("Loaded cached stream '{name}' by name.".format(name=streamName))
                     return s # Found it!
 
+        # The streams.xml of the latest transaction in the depot's transactions ref lists all of the streams, by their names at that transaction.
+        transactionsRef = self.GetDepotTransactionsRef(depot=depot.number)
+        if transactionsRef is not None:
+            with self.refUpdateLock:
+                trIdList = list(self.GetDepotTransactionStore(transactionsRef)["transactions"].keys())
+            trInfo = self.GetDepotTransactionInfo(depot=depot.number, trId=max(trIdList)) if len(trIdList) > 0 else None
+            if trInfo is not None:
+                s = trInfo[3].getStream(streamName)
+                if s is not None:
+                    logger.debug("Found stream '{name}' in {ref}.".format(name=streamName, ref=transactionsRef))
+                    return s
+
         logger.debug("Searching for stream '{name}' by name.".format(name=streamName))
 
         refsPrefix = self.GetStreamRefsNamespace(depot.number)
@@ -1883,10 +3514,9 @@ class AccuRev2Git(object):
                 stateHash = stateMap[trId]
                 if stateHash is None:
                     raise Exception("Failed to retrieve state information for tr. {trId}".format(trId))
-                trHistXml, trHist = self.GetHistInfo(ref=stateHash)
+                trHistXml, trHist, streamsXml, streams = self.GetTransactionInfo(depot=stream.depotName, trId=trId, stateHash=stateHash)
                 tr = trHist.transactions[0]
 
-                streamsXml, streams = self.GetStreamsInfo(ref=stateHash)
                 dstStreamName, dstStreamNumber = trHist.toStream()
                 dstStream = streams.getStream(dstStreamNumber)
                 srcStreamName, srcStreamNumber = trHist.fromStream()
@@ -1945,7 +3575,7 @@ class AccuRev2Git(object):
             processingList.sort()
 
         for streamNumber, stream, branchName in processingList:
-            oldCommitHash = self.GetLastCommitHash(branchName=branchName, retry=False)
+            oldCommitHash = self.GetLastCommitHash(branchName=branchName)
 
             self.ProcessStream(stream=stream, branchName=branchName)
 
@@ -1963,7 +3593,7 @@ class AccuRev2Git(object):
                     pushOutput = None
                     try:
                         pushCmd = "git push {remote} {refspec}".format(remote=remoteName, refspec=refspec)
-                        pushOutput = subprocess.check_output(pushCmd.split(), stderr=subprocess.STDOUT).decode('utf-8')
+                        pushOutput = subprocess.check_output(pushCmd.split(), cwd=self.gitRepo.path, stderr=subprocess.STDOUT).decode('utf-8')
                         logger.info("Push to '{remote}' succeeded:".format(remote=remoteName))
                         logger.info(pushOutput)
                     except subprocess.CalledProcessError as e:
@@ -2250,7 +3880,7 @@ class AccuRev2Git(object):
             # Depending on the version of Git we can't trust the return value of the `git tag` command.
             # Hence we use `git log refs/tags/<tag name>` instead of peeling back the tag to ensure that
             # it was correctly created.
-            commitHash = self.GetLastCommitHash(branchName="refs/tags/{0}".format(tagName), retry=True)
+            commitHash = self.GetLastCommitHash(branchName="refs/tags/{0}".format(tagName))
             if commitHash != objHash:
                 # Note: This assumes that we are ONLY taggint commit objects. If this ever changes then
                 # we will need to properly peel back the tag and get the commit hash to which it points
@@ -2575,12 +4205,11 @@ class AccuRev2Git(object):
         # For all affected streams the streams.xml and hist.xml contents should be the same for the same transaction id so get it from any one of them.
         arbitraryStreamNumberStr = next(iter(affectedStreamMap))
         arbitraryStreamData = affectedStreamMap[arbitraryStreamNumberStr]
-        streamsXml, streams = self.GetStreamsInfo(ref=arbitraryStreamData["state_hash"])
+        trHistXml, trHist, streamsXml, streams = self.GetTransactionInfo(depot=self.config.accurev.depot, trId=trId, stateHash=arbitraryStreamData["state_hash"])
         if streams is None:
             raise Exception("Couldn't get streams for transaction {tr}. Aborting!".format(tr=trId))
 
         # Get the transaction information.
-        trHistXml, trHist = self.GetHistInfo(ref=arbitraryStreamData["state_hash"])
         if trHist is None or len(trHist.transactions) == 0 is None:
             raise Exception("Couldn't get history for transaction {tr}. Aborting!".format(tr=trId))
         tr = trHist.transactions[0]
@@ -2887,6 +4516,14 @@ class AccuRev2Git(object):
                 raise Exception("Not yet implemented! Unrecognized stream type {Type}. Stream {name}".format(Type=stream.Type, name=stream.name))
 
     def ReadFileRef(self, ref):
+        obj = self.gitRepo.catFile.contents(ref)
+        if obj is None:
+            return None # The ref doesn't exist.
+        objHash, objType, contents = obj
+        if objType == 'blob':
+            return git.decode_proc_output(contents)
+
+        # Only blobs can be read directly, show anything else like we always have.
         rv = None
         for i in range(0, AccuRev2Git.commandFailureRetryCount):
             rv = self.gitRepo.raw_cmd([u'git', u'show', ref])
@@ -2914,7 +4551,8 @@ class AccuRev2Git(object):
                 updateRefRetr = None
                 if objHash is not None:
                     cmd = [ u'git', u'update-ref', ref, objHash ]
-                    updateRefRetr = self.gitRepo.raw_cmd(cmd)
+                    with self.refUpdateLock:
+                        updateRefRetr = self.gitRepo.raw_cmd(cmd)
                 if objHash is None or updateRefRetr is None:
                     logger.debug("Error! Command {cmd}".format(cmd=' '.join(str(x) for x in cmd)))
                     logger.debug("  Failed with: {err}".format(err=self.gitRepo.lastStderr))
@@ -3226,152 +4864,136 @@ class AccuRev2Git(object):
         if self.config.accurev.commandCacheFilename is not None:
             self.config.accurev.commandCacheFilename = os.path.abspath(self.config.accurev.commandCacheFilename)
         self.cwd = os.getcwd()
-        os.chdir(self.config.git.repoPath)
+        if not self.isSharedSession:
+            os.chdir(self.config.git.repoPath)
         
         # This try/catch/finally block is here to ensure that we change directory back to self.cwd in order
         # to allow other scripts to safely call into this method.
-        if self.InitGitRepo(self.config.git.repoPath):
-            self.gitRepo = git.open(self.config.git.repoPath)
-            status = self.gitRepo.status()
-            if status is None:
-                raise Exception("git state failed. Aborting! err: {err}".format(err=self.gitRepo.lastStderr))
-            elif status.initial_commit:
-                logger.debug( "New git repository. Initial commit on branch {br}".format(br=status.branch) )
-            else:
-                logger.debug( "Opened git repository on branch {br}".format(br=status.branch) )
- 
-            # Configure the remotes
-            if self.config.git.remoteMap is not None and len(self.config.git.remoteMap) > 0:
-                remoteList = self.gitRepo.remote_list()
-                remoteAddList = [x for x in self.config.git.remoteMap.keys()]
-                for remote in remoteList:
-                    if remote.name in self.config.git.remoteMap:
-                        r = self.config.git.remoteMap[remote.name]
-                        pushUrl1 = r.url if r.pushUrl is None else r.pushUrl
-                        pushUrl2 = remote.url if remote.pushUrl is None else remote.pushUrl
-                        if r.url != remote.url or pushUrl1 != pushUrl2:
-                            raise Exception("Configured remote {r}'s urls don't match.\nExpected:\n{r1}\nGot:\n{r2}".format(r=remote.name, r1=r, r2=remote))
-                        remoteAddList.remove(remote.name)
-                    else:
-                        logger.debug( "Unspecified remote {remote} ({url}) found. Ignoring...".format(remote=remote.name, url=remote.url) )
-                for remote in remoteAddList:
-                    r = self.config.git.remoteMap[remote]
-                    if self.gitRepo.remote_add(name=r.name, url=r.url) is None:
-                        raise Exception("Failed to add remote {remote} ({url})!".format(remote=r.name, url=r.url))
-                    logger.info( "Added remote: {remote} ({url}).".format(remote=r.name, url=r.url) )
-                    if r.pushUrl is not None and r.url != r.pushUrl:
-                        if self.gitRepo.remote_set_url(name=r.name, url=r.pushUrl, isPushUrl=True) is None:
-                            raise Exception("Failed to set push url {url} for {remote}!".format(url=r.pushUrl, remote=r.name))
-                        logger.info( "Added push url: {remote} ({url}).".format(remote=r.name, url=r.pushUrl) )
-
-            doLogout = False
-            if self.config.method != 'skip':
-                acInfo = accurev.info()
-                isLoggedIn = False
-                if self.config.accurev.username is None:
-                    # When a username isn't specified we will use any logged in user for the conversion.
-                    isLoggedIn = accurev.ext.is_loggedin(infoObj=acInfo)
+        try:
+            if self.InitGitRepo(self.config.git.repoPath):
+                self.gitRepo = git.open(self.config.git.repoPath)
+                status = self.gitRepo.status()
+                if status is None:
+                    raise Exception("git state failed. Aborting! err: {err}".format(err=self.gitRepo.lastStderr))
+                elif status.initial_commit:
+                    logger.debug( "New git repository. Initial commit on branch {br}".format(br=status.branch) )
                 else:
-                    # When a username is specified that specific user must be logged in.
-                    isLoggedIn = (acInfo.principal == self.config.accurev.username)
-
-                if not isLoggedIn:
-                    # Login the requested user
-                    if accurev.ext.is_loggedin(infoObj=acInfo):
-                        # Different username, logout the other user first.
-                        logoutSuccess = accurev.logout()
-                        logger.info("Accurev logout for '{0}' {1}".format(acInfo.principal, 'succeeded' if logoutSuccess else 'failed'))
-
-                    loginResult = accurev.login(self.config.accurev.username, self.config.accurev.password)
-                    if loginResult:
-                        logger.info("Accurev login for '{0}' succeeded.".format(self.config.accurev.username))
-                    else:
-                        logger.error("AccuRev login for '{0}' failed.\n".format(self.config.accurev.username))
-                        logger.error("AccuRev message:\n{0}".format(loginResult.errorMessage))
+                    logger.debug( "Opened git repository on branch {br}".format(br=status.branch) )
+ 
+                # Configure the remotes
+                if self.config.git.remoteMap is not None and len(self.config.git.remoteMap) > 0:
+                    remoteList = self.gitRepo.remote_list()
+                    remoteAddList = [x for x in self.config.git.remoteMap.keys()]
+                    for remote in remoteList:
+                        if remote.name in self.config.git.remoteMap:
+                            r = self.config.git.remoteMap[remote.name]
+                            pushUrl1 = r.url if r.pushUrl is None else r.pushUrl
+                            pushUrl2 = remote.url if remote.pushUrl is None else remote.pushUrl
+                            if r.url != remote.url or pushUrl1 != pushUrl2:
+                                raise Exception("Configured remote {r}'s urls don't match.\nExpected:\n{r1}\nGot:\n{r2}".format(r=remote.name, r1=r, r2=remote))
+                            remoteAddList.remove(remote.name)
+                        else:
+                            logger.debug( "Unspecified remote {remote} ({url}) found. Ignoring...".format(remote=remote.name, url=remote.url) )
+                    for remote in remoteAddList:
+                        r = self.config.git.remoteMap[remote]
+                        if self.gitRepo.remote_add(name=r.name, url=r.url) is None:
+                            raise Exception("Failed to add remote {remote} ({url})!".format(remote=r.name, url=r.url))
+                        logger.info( "Added remote: {remote} ({url}).".format(remote=r.name, url=r.url) )
+                        if r.pushUrl is not None and r.url != r.pushUrl:
+                            if self.gitRepo.remote_set_url(name=r.name, url=r.pushUrl, isPushUrl=True) is None:
+                                raise Exception("Failed to set push url {url} for {remote}!".format(url=r.pushUrl, remote=r.name))
+                            logger.info( "Added push url: {remote} ({url}).".format(remote=r.name, url=r.pushUrl) )
+
+                doLogout = False
+                if self.config.method != 'skip' and not self.isSharedSession:
+                    isLoggedIn, doLogout = AccuRevLogin(self.config.accurev.username, self.config.accurev.password)
+                    if not isLoggedIn:
                         return 1
-
-                    doLogout = True
-                else:
-                    logger.info("Accurev user '{0}', already logged in.".format(acInfo.principal))
                 
-                # If this script is being run on a replica then ensure that it is up-to-date before processing the streams.
-                accurev.replica.sync()
+                    # If this script is being run on a replica then ensure that it is up-to-date before processing the streams.
+                    accurev.replica.sync()
 
-            self.gitRepo.raw_cmd([u'git', u'config', u'--local', u'gc.auto', u'0'])
+                self.gitRepo.raw_cmd([u'git', u'config', u'--local', u'gc.auto', u'0'])
 
-            if self.config.method in [ "deep-hist", "diff", "pop" ]:
-                logger.info("Retrieveing stream information from Accurev into hidden refs.")
-                self.RetrieveStreams()
-            elif self.config.method in [ "skip" ]:
-                logger.info("Skipping retrieval of stream information from Accurev.")
-            else:
-                raise Exception("Unrecognized method '{method}'".format(method=self.config.method))
-
-            if not isRestart and isSoftRestart:
-                logger.info( "Restarting the processing operation." )
-                if self.gitRepo.raw_cmd([ u'git', u'checkout', u'--orphan', u'__ac2git_temp__' ]) is None:
-                    raise Exception("Failed to checkout empty branch.")
-                if self.gitRepo.raw_cmd([ u'git', u'read-tree', u'--empty' ]) is None:
-                    raise Exception("Failed to clear the index.")
-                if self.gitRepo.raw_cmd([ u'git', u'clean', u'-dfx' ]) is None:
-                    raise Exception("Failed to remove untracked files.")
-                refOutput = self.gitRepo.raw_cmd([ u'git', u'show-ref' ])
-                if refOutput is None:
-                    raise Exception("Failed to retrieve refs.")
-
-                # Delete all the branches and refs that we won't need any more.
-                streamMap = self.GetStreamMap()
-                branchList = [streamMap[x] for x in streamMap]
-                deleteCmd = [ u'git', u'update-ref', u'-d' ]
-                for refEntry in refOutput.strip().split('\n'):
-                    refEntry = refEntry.strip()
-                    ref = refEntry.strip().split()[1]
-                    delete = False
-                    if ref.startswith('refs/heads/'):
-                        # Find out if it is a tracked branch that we should delete.
-                        branchName = ref[len('refs/heads/'):]
-                        if branchName in branchList:
+                if self.config.method in [ "deep-hist", "diff", "pop" ]:
+                    logger.info("Retrieveing stream information from Accurev into hidden refs.")
+                    self.RetrieveStreams()
+                elif self.config.method in [ "skip" ]:
+                    logger.info("Skipping retrieval of stream information from Accurev.")
+                else:
+                    raise Exception("Unrecognized method '{method}'".format(method=self.config.method))
+
+                if not isRestart and isSoftRestart:
+                    logger.info( "Restarting the processing operation." )
+                    if self.gitRepo.raw_cmd([ u'git', u'checkout', u'--orphan', u'__ac2git_temp__' ]) is None:
+                        raise Exception("Failed to checkout empty branch.")
+                    if self.gitRepo.raw_cmd([ u'git', u'read-tree', u'--empty' ]) is None:
+                        raise Exception("Failed to clear the index.")
+                    if self.gitRepo.raw_cmd([ u'git', u'clean', u'-dfx' ]) is None:
+                        raise Exception("Failed to remove untracked files.")
+                    refOutput = self.gitRepo.raw_cmd([ u'git', u'show-ref' ])
+                    if refOutput is None:
+                        raise Exception("Failed to retrieve refs.")
+
+                    # Delete all the branches and refs that we won't need any more.
+                    streamMap = self.GetStreamMap()
+                    branchList = [streamMap[x] for x in streamMap]
+                    deleteCmd = [ u'git', u'update-ref', u'-d' ]
+                    for refEntry in refOutput.strip().split('\n'):
+                        refEntry = refEntry.strip()
+                        ref = refEntry.strip().split()[1]
+                        delete = False
+                        if ref.startswith('refs/heads/'):
+                            # Find out if it is a tracked branch that we should delete.
+                            branchName = ref[len('refs/heads/'):]
+                            if branchName in branchList:
+                                delete = True
+                        elif ref.startswith('refs/ac2git/state/') or ref in [ 'refs/notes/ac2git', 'refs/notes/accurev' ]:
                             delete = True
-                    elif ref.startswith('refs/ac2git/state/') or ref in [ 'refs/notes/ac2git', 'refs/notes/accurev' ]:
-                        delete = True
 
-                    if delete:
-                        if self.gitRepo.raw_cmd( deleteCmd + [ ref ] ) is None:
-                            raise Exception("Failed to delete ref {r}.".format(ref))
-                        logger.debug("Deleting ref {r}".format(r=ref))
-                    else:
-                        #logger.debug("Skipping ref {r}".format(r=ref))
-                        pass
-                # Checkout the master branch or an empty master branch if it doesn't exist.
-                if self.gitRepo.raw_cmd([ u'git', u'checkout', u'--orphan', u'master' ]) is None:
-                    if self.gitRepo.raw_cmd([ u'git', u'checkout', u'master' ]) is None:
-                        raise Exception("Failed to checkout master branch.")
-
-            if self.config.mergeStrategy in [ "normal" ]:
-                logger.info("Processing transactions from hidden refs. Merge strategy '{strategy}'.".format(strategy=self.config.mergeStrategy))
-                self.ProcessTransactions()
-            elif self.config.mergeStrategy in [ "orphanage" ]:
-                logger.info("Processing streams from hidden refs. Merge strategy '{strategy}'.".format(strategy=self.config.mergeStrategy))
-                self.ProcessStreams(orderByStreamNumber=False)
-            elif self.config.mergeStrategy in [ "skip", None ]:
-                logger.info("Skipping processing of Accurev data. No git branches will be generated/updated. Merge strategy '{strategy}'.".format(strategy=self.config.mergeStrategy))
-                pass # Skip the merge step.
-            else:
-                raise Exception("Unrecognized merge strategy '{strategy}'".format(strategy=self.config.mergeStrategy))
-
-            self.gitRepo.raw_cmd([u'git', u'config', u'--local', u'--unset-all', u'gc.auto'])
-              
-            if doLogout:
-                if accurev.logout():
-                    logger.info( "Accurev logout successful." )
+                        if delete:
+                            if self.gitRepo.raw_cmd( deleteCmd + [ ref ] ) is None:
+                                raise Exception("Failed to delete ref {r}.".format(ref))
+                            logger.debug("Deleting ref {r}".format(r=ref))
+                        else:
+                            #logger.debug("Skipping ref {r}".format(r=ref))
+                            pass
+                    # Checkout the master branch or an empty master branch if it doesn't exist.
+                    if self.gitRepo.raw_cmd([ u'git', u'checkout', u'--orphan', u'master' ]) is None:
+                        if self.gitRepo.raw_cmd([ u'git', u'checkout', u'master' ]) is None:
+                            raise Exception("Failed to checkout master branch.")
+
+                if self.config.mergeStrategy in [ "normal" ]:
+                    logger.info("Processing transactions from hidden refs. Merge strategy '{strategy}'.".format(strategy=self.config.mergeStrategy))
+                    self.ProcessTransactions()
+                elif self.config.mergeStrategy in [ "orphanage" ]:
+                    logger.info("Processing streams from hidden refs. Merge strategy '{strategy}'.".format(strategy=self.config.mergeStrategy))
+                    self.ProcessStreams(orderByStreamNumber=False)
+                elif self.config.mergeStrategy in [ "skip", None ]:
+                    logger.info("Skipping processing of Accurev data. No git branches will be generated/updated. Merge strategy '{strategy}'.".format(strategy=self.config.mergeStrategy))
+                    pass # Skip the merge step.
                 else:
-                    logger.error("Accurev logout failed.\n")
-                    return 1
-        else:
-            logger.error( "Could not create git repository." )
+                    raise Exception("Unrecognized merge strategy '{strategy}'".format(strategy=self.config.mergeStrategy))
 
-        # Restore the working directory.
-        os.chdir(self.cwd)
+                self.gitRepo.raw_cmd([u'git', u'config', u'--local', u'--unset-all', u'gc.auto'])
+              
+                if doLogout:
+                    if accurev.logout():
+                        logger.info( "Accurev logout successful." )
+                    else:
+                        logger.error("Accurev logout failed.\n")
+                        return 1
+            else:
+                logger.error( "Could not create git repository." )
+        finally:
+            # The git cat-file processes of the main repository are used throughout and are only stopped here. The retrieval workers stop their own
+            # (see RetrieveStreamsConcurrently()) and RetrieveStream() stops git fast-import.
+            if self.gitRepo is not None:
+                self.gitRepo.catFile.close()
+
+            # Restore the working directory.
+            if not self.isSharedSession:
+                os.chdir(self.cwd)
         
         return 0
             
@@ -3388,6 +5010,20 @@ def DumpExampleConfigFile(outputFilename):
             start-transaction:    The conversion will start at this transaction. If interrupted the next time it starts it will continue from where it stopped.
             end-transaction:      Stop at this transaction. This can be the keword "now" if you want it to convert the repo up to the latest transaction.
             command-cache-filename: The filename which will be given to the accurev.py script to use as a local command result cache for the accurev hist, accurev diff and accurev show streams commands.
+            retrieve-workers:     Optional. The number of streams that are retrieved from AccuRev concurrently (default 1). Each worker uses its own temporary git worktree which is created next to the git repo.
+            prefetch-window:      Optional. The number of transactions, ahead of the one being committed, whose changed elements are populated concurrently into temporary staging directories (default 0, disabled).
+                                  Only used by the 'diff' and 'deep-hist' methods.
+            checkpoint-transactions: Optional. The number of transactions after which the retrieval of a stream's info and data is checkpointed by updating its
+                                  high-water-mark (default 0, the whole transaction range is retrieved before the high-water-mark is updated).
+            checkpoint-minutes:   Optional. The number of minutes after which the retrieval of a stream's info and data is checkpointed (default 0, disabled).
+            pipeline-depth:       Optional. The number of transactions by which the retrieval of a stream's info can get ahead of the retrieval of its data. When set the two
+                                  run concurrently, so that the accurev queries overlap with the populating of the files, instead of one after the other (default 0, disabled).
+            populate-workers:     Optional. The number of concurrent `accurev pop` commands into which a populate of a whole stream is split, one per group of its top level
+                                  directories, when the layout of the stream is known from an earlier commit (default 1, disabled).
+            probe-window:         Optional. The maximum number of `accurev diff` commands that are run concurrently when searching for the next transaction that changed a
+                                  stream (default 1, disabled). Only used by the 'diff' and 'deep-hist' methods.
+            hist-workers:         Optional. The maximum number of `accurev hist` commands that are run concurrently when fetching the history of a whole depot
+                                  in chunks of transactions and when querying the parent streams for the 'deep-hist' method (default 1, disabled).
     -->
     <accurev 
         username="joe_bloggs" 
@@ -3395,7 +5031,15 @@ def DumpExampleConfigFile(outputFilename):
         depot="Trunk" 
         start-transaction="1" 
         end-transaction="now" 
-        command-cache-filename="command_cache.sqlite3" >
+        command-cache-filename="command_cache.sqlite3" 
+        retrieve-workers="1" 
+        prefetch-window="0" 
+        checkpoint-transactions="0" 
+        checkpoint-minutes="0" 
+        pipeline-depth="0" 
+        populate-workers="1" 
+        probe-window="1" 
+        hist-workers="1" >
         <!-- The stream-list is optional. If not given all streams are processed
                 exclude-types:   A comma separated list of stream types that are to be excluded from being automatically added. Doesn't apply to streams that were explicitly specified.
                                  The stream types have to match the stream types returned by Accurev in its command line client's XML output and a special keyword "hidden" for excluding
@@ -3431,6 +5075,9 @@ def DumpExampleConfigFile(outputFilename):
                                                             ended up being the same as the child stream it is highly likely that this child stream is the source of the promote.
             new-basis-is-first-parent: [ "true", "false" ] - If set to true, for a chstream transaction, the new basis transaction will be made the corresponding commit's first parent, while
                                                              the previous transaction made in the stream will be the second parent. If set to false the order of the two parents is reversed.
+            fast-import: [ "true", "false" ] - If set to true, the hidden info and data refs are written by a single long running `git fast-import` process, per stream, instead of
+                                               running several git commands per transaction. The refs are only updated at checkpoints so an interrupted retrieval resumes from
+                                               the last checkpoint. Defaults to false.
     -->
     <git 
         repo-path="/put/the/git/repo/here" 
@@ -3440,11 +5087,27 @@ def DumpExampleConfigFile(outputFilename):
         empty-child-stream-action="merge" 
         source-stream-fast-forward="false"
         source-stream-inferrence="false"
-        new-basis-is-first-parent="true" > 
+        new-basis-is-first-parent="true"
+        fast-import="false" > 
         <!-- Optional: You can add remote elements to specify the remotes to which the converted branches will be pushed. The push-url attribute is optional. -->
         <remote name="origin" url="https://github.com/orao/ac2git.git" push-url="https://github.com/orao/ac2git.git" /> 
         <remote name="backup" url="https://github.com/orao/ac2git.git" />
     </git>
+    <!-- Optional: The depots element converts several depots, concurrently, in a single invocation of the script. Each depot is converted into its own
+         git repository using a copy of this configuration in which the accurev depot, the git repo-path and, when given, the transaction range, stream-list
+         and remotes are replaced by the ones from its depot element. The accurev login, the command cache and the limit on concurrent accurev commands are shared.
+            workers:              Optional. The number of depots that are converted concurrently (default 1).
+            max-accurev-commands: Optional. The maximum number of accurev commands that are run at the same time by all of the conversions (default 0, unlimited).
+    <depots workers="4" max-accurev-commands="8">
+        <depot name="Trunk" repo-path="/put/the/trunk/git/repo/here" />
+        <depot name="Tools" repo-path="/put/the/tools/git/repo/here" start-transaction="1" end-transaction="now">
+            <stream-list>
+                <stream>Tools</stream>
+            </stream-list>
+            <remote name="origin" url="https://github.com/orao/tools.git" />
+        </depot>
+    </depots>
+    -->
     <method>deep-hist</method> <!-- The method specifies what approach is taken to retrieve information from Accurev. Allowed values are 'deep-hist', 'diff', 'pop' and 'skip'.
                                      - deep-hist: Works by using the accurev.ext.deep_hist() function to return a list of transactions that could have affected the stream.
                                                   It then performs a diff between the transactions and only populates the files that have changed like the 'diff' method.
@@ -3559,6 +5222,20 @@ def AutoConfigFile(filename, args, preserveConfig=False):
             start-transaction:    The conversion will start at this transaction. If interrupted the next time it starts it will continue from where it stopped.
             end-transaction:      Stop at this transaction. This can be the keword "now" if you want it to convert the repo up to the latest transaction.
             command-cache-filename: The filename which will be given to the accurev.py script to use as a local command result cache for the accurev hist, accurev diff and accurev show streams commands.
+            retrieve-workers:     Optional. The number of streams that are retrieved from AccuRev concurrently (default 1). Each worker uses its own temporary git worktree which is created next to the git repo.
+            prefetch-window:      Optional. The number of transactions, ahead of the one being committed, whose changed elements are populated concurrently into temporary staging directories (default 0, disabled).
+                                  Only used by the 'diff' and 'deep-hist' methods.
+            checkpoint-transactions: Optional. The number of transactions after which the retrieval of a stream's info and data is checkpointed by updating its
+                                  high-water-mark (default 0, the whole transaction range is retrieved before the high-water-mark is updated).
+            checkpoint-minutes:   Optional. The number of minutes after which the retrieval of a stream's info and data is checkpointed (default 0, disabled).
+            pipeline-depth:       Optional. The number of transactions by which the retrieval of a stream's info can get ahead of the retrieval of its data. When set the two
+                                  run concurrently, so that the accurev queries overlap with the populating of the files, instead of one after the other (default 0, disabled).
+            populate-workers:     Optional. The number of concurrent `accurev pop` commands into which a populate of a whole stream is split, one per group of its top level
+                                  directories, when the layout of the stream is known from an earlier commit (default 1, disabled).
+            probe-window:         Optional. The maximum number of `accurev diff` commands that are run concurrently when searching for the next transaction that changed a
+                                  stream (default 1, disabled). Only used by the 'diff' and 'deep-hist' methods.
+            hist-workers:         Optional. The maximum number of `accurev hist` commands that are run concurrently when fetching the history of a whole depot
+                                  in chunks of transactions and when querying the parent streams for the 'deep-hist' method (default 1, disabled).
     -->
     <accurev 
         username="{accurev_username}" 
@@ -3566,7 +5243,15 @@ def AutoConfigFile(filename, args, preserveConfig=False):
         depot="{accurev_depot}" 
         start-transaction="{start_transaction}" 
         end-transaction="{end_transaction}" 
-        command-cache-filename="command_cache.sqlite3" >
+        command-cache-filename="command_cache.sqlite3" 
+        retrieve-workers="{retrieve_workers}" 
+        prefetch-window="{prefetch_window}" 
+        checkpoint-transactions="{checkpoint_transactions}" 
+        checkpoint-minutes="{checkpoint_minutes}" 
+        pipeline-depth="{pipeline_depth}" 
+        populate-workers="{populate_workers}" 
+        probe-window="{probe_window}" 
+        hist-workers="{hist_workers}" >
         <!-- The stream-list is optional. If not given all streams are processed
                 exclude-types:   A comma separated list of stream types that are to be excluded from being automatically added. Doesn't apply to streams that were explicitly specified.
                                  The stream types have to match the stream types returned by Accurev in its command line client's XML output and a special keyword "hidden" for excluding
@@ -3577,7 +5262,10 @@ def AutoConfigFile(filename, args, preserveConfig=False):
         <stream-list{exclude_types}>""".format(accurev_username=config.accurev.username,
                                                accurev_password=config.accurev.password,
                                                accurev_depot=config.accurev.depot,
-                                               start_transaction=1, end_transaction="now",
+                                               start_transaction=1, end_transaction="now", retrieve_workers=config.accurev.retrieveWorkers, prefetch_window=config.accurev.prefetchWindow,
+                                               checkpoint_transactions=config.accurev.checkpointTransactions, checkpoint_minutes=config.accurev.checkpointMinutes,
+                                               pipeline_depth=config.accurev.pipelineDepth, populate_workers=config.accurev.populateWorkers,
+                                               probe_window=config.accurev.probeWindow, hist_workers=config.accurev.histWorkers,
                                                exclude_types="" if config.excludeStreamTypes is None else " exclude-types=\"{0}\"".format(", ".join(config.excludeStreamTypes))))
 
         if preserveConfig:
@@ -3619,6 +5307,9 @@ def AutoConfigFile(filename, args, preserveConfig=False):
                                                             ended up being the same as the child stream it is highly likely that this child stream is the source of the promote.
             new-basis-is-first-parent: [ "true", "false" ] - If set to true, for a chstream transaction, the new basis transaction will be made the corresponding commit's first parent, while
                                                              the previous transaction made in the stream will be the second parent. If set to false the order of the two parents is reversed.
+            fast-import: [ "true", "false" ] - If set to true, the hidden info and data refs are written by a single long running `git fast-import` process, per stream, instead of
+                                               running several git commands per transaction. The refs are only updated at checkpoints so an interrupted retrieval resumes from
+                                               the last checkpoint. Defaults to false.
     -->
     <git 
         repo-path="{git_repo_path}" 
@@ -3628,14 +5319,16 @@ def AutoConfigFile(filename, args, preserveConfig=False):
         empty-child-stream-action="{empty_child_stream_action}" 
         source-stream-fast-forward="{source_stream_fast_forward}"
         source-stream-inferrence="{source_stream_inferrence}"
-        new-basis-is-first-parent="{new_basis_is_first_parent}" >""".format(git_repo_path=config.git.repoPath,
+        new-basis-is-first-parent="{new_basis_is_first_parent}"
+        fast-import="{fast_import}" >""".format(git_repo_path=config.git.repoPath,
                                                                             message_style=config.git.messageStyle if config.git.messageStyle is not None else 'notes',
                                                                             message_key=config.git.messageKey if config.git.messageKey is not None else 'footer',
                                                                             author_is_committer="true" if config.git.authorIsCommitter else "false",
                                                                             empty_child_stream_action=config.git.emptyChildStreamAction,
                                                                             source_stream_fast_forward="true" if config.git.sourceStreamFastForward else "false",
                                                                             source_stream_inferrence="true" if config.git.sourceStreamInferrence else "false",
-                                                                            new_basis_is_first_parent="true" if config.git.newBasisIsFirstParent else "false"))
+                                                                            new_basis_is_first_parent="true" if config.git.newBasisIsFirstParent else "false",
+                                                                            fast_import="true" if config.git.fastImport else "false"))
         if config.git.remoteMap is not None:
             for remoteName in remoteMap:
                 remote = remoteMap[remoteName]
@@ -3787,6 +5480,26 @@ def SetConfigFromArgs(config, args):
 def ValidateConfig(config):
     # Validate the program args and configuration up to this point.
     isValid = True
+    if config.depots is not None:
+        # The depot and git repository are given for each depot in the depots element.
+        if len(config.depots) == 0:
+            logger.error("No AccuRev depots listed in the depots element.\n")
+            isValid = False
+        repoPathMap = {}
+        for depot in config.depots:
+            if depot.name is None:
+                logger.error("No AccuRev depot name specified for a depot element.\n")
+                isValid = False
+            if depot.repoPath is None:
+                logger.error("No Git repository specified for depot {0}.\n".format(depot.name))
+                isValid = False
+            elif depot.repoPath in repoPathMap:
+                logger.error("Depots {0} and {1} are both converted into the Git repository {2}.\n".format(repoPathMap[depot.repoPath], depot.name, depot.repoPath))
+                isValid = False
+            else:
+                repoPathMap[depot.repoPath] = depot.name
+        return isValid
+
     if config.accurev.depot is None:
         logger.error("No AccuRev depot specified.\n")
         isValid = False
@@ -3796,7 +5509,8 @@ def ValidateConfig(config):
 
     return isValid
 
-def InitializeLogging(filename, level):
+# When logThreadName is set every message is prefixed with the name of the thread that logged it, see ConvertDepots().
+def InitializeLogging(filename, level, logThreadName=False):
     global logger
     if logger is None:
         logger = logging.getLogger('ac2git')
@@ -3805,7 +5519,7 @@ def InitializeLogging(filename, level):
         consoleHandler = logging.StreamHandler()
         consoleHandler.setLevel(level)
 
-        consoleFormatter = logging.Formatter('%(message)s')
+        consoleFormatter = logging.Formatter('%(threadName)s: %(message)s' if logThreadName else '%(message)s')
         consoleHandler.setFormatter(consoleFormatter)
 
         logger.addHandler(consoleHandler)
@@ -3814,7 +5528,7 @@ def InitializeLogging(filename, level):
             fileHandler = logging.FileHandler(filename=filename)
             fileHandler.setLevel(level)
 
-            fileFormatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+            fileFormatter = logging.Formatter('%(asctime)s - %(name)s - %(threadName)s - %(levelname)s - %(message)s' if logThreadName else '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
             fileHandler.setFormatter(fileFormatter)
 
             logger.addHandler(fileHandler)
@@ -3836,11 +5550,16 @@ def PrintConfigSummary(config, filename):
         logger.info('    source stream fast forward: {0}'.format(config.git.sourceStreamFastForward))
         logger.info('    source stream inferrence: {0}'.format(config.git.sourceStreamInferrence))
         logger.info('    new basis is first parent: {0}'.format(config.git.newBasisIsFirstParent))
+        logger.info('    fast import: {0}'.format(config.git.fastImport))
         if config.git.remoteMap is not None:
             for remoteName in config.git.remoteMap:
                 remote = config.git.remoteMap[remoteName]
                 logger.info('    remote: {name} {url}{push_url}'.format(name=remote.name, url=remote.url, push_url = '' if remote.pushUrl is None or remote.url == remote.pushUrl else ' (push:{push_url})'.format(push_url=remote.pushUrl)))
                 
+        if config.depots is not None:
+            logger.info('  depots: {0} workers, {1} concurrent accurev commands'.format(config.depotWorkers, config.maxAccurevCommands if config.maxAccurevCommands > 0 else 'unlimited'))
+            for depot in config.depots:
+                logger.info('    - {0} -> {1}'.format(depot.name, depot.repoPath))
         logger.info('  accurev:')
         logger.info('    depot: {0}'.format(config.accurev.depot))
         if config.accurev.streamMap is not None:
@@ -3853,6 +5572,13 @@ def PrintConfigSummary(config, filename):
         logger.info('    end tran.:   #{0}'.format(config.accurev.endTransaction))
         logger.info('    username: {0}'.format(config.accurev.username))
         logger.info('    command cache: {0}'.format(config.accurev.commandCacheFilename))
+        logger.info('    retrieve workers: {0}'.format(config.accurev.retrieveWorkers))
+        logger.info('    prefetch window: {0}'.format(config.accurev.prefetchWindow))
+        logger.info('    checkpoint every: {0} transactions, {1} minutes'.format(config.accurev.checkpointTransactions, config.accurev.checkpointMinutes))
+        logger.info('    pipeline depth: {0}'.format(config.accurev.pipelineDepth))
+        logger.info('    populate workers: {0}'.format(config.accurev.populateWorkers))
+        logger.info('    probe window: {0}'.format(config.accurev.probeWindow))
+        logger.info('    hist workers: {0}'.format(config.accurev.histWorkers))
         logger.info('    ignored transaction types (hard-coded): {0}'.format(", ".join(ignored_transaction_types)))
         if config.accurev.excludeStreamTypes is not None:
             logger.info('    excluded stream types: {0}'.format(", ".join(config.accurev.excludeStreamTypes)))
@@ -3862,6 +5588,37 @@ def PrintConfigSummary(config, filename):
         logger.info('  log file: {0}'.format(config.logFilename))
         logger.info('  verbose:  {0}'.format( (logger.getEffectiveLevel() == logging.DEBUG) ))
 
+# Ensures that the given accurev user is logged in, or any user if the username is None. Returns a tuple (isLoggedIn, doLogout) where doLogout
+# is True if this function has performed the login and the caller should logout when it is done.
+def AccuRevLogin(username, password):
+    acInfo = accurev.info()
+    isLoggedIn = False
+    if username is None:
+        # When a username isn't specified we will use any logged in user for the conversion.
+        isLoggedIn = accurev.ext.is_loggedin(infoObj=acInfo)
+    else:
+        # When a username is specified that specific user must be logged in.
+        isLoggedIn = (acInfo.principal == username)
+
+    if isLoggedIn:
+        logger.info("Accurev user '{0}', already logged in.".format(acInfo.principal))
+        return True, False
+
+    # Login the requested user
+    if accurev.ext.is_loggedin(infoObj=acInfo):
+        # Different username, logout the other user first.
+        logoutSuccess = accurev.logout()
+        logger.info("Accurev logout for '{0}' {1}".format(acInfo.principal, 'succeeded' if logoutSuccess else 'failed'))
+
+    loginResult = accurev.login(username, password)
+    if not loginResult:
+        logger.error("AccuRev login for '{0}' failed.\n".format(username))
+        logger.error("AccuRev message:\n{0}".format(loginResult.errorMessage))
+        return False, False
+
+    logger.info("Accurev login for '{0}' succeeded.".format(username))
+    return True, True
+
 def PrintStatus(state):
     # Setup Git - TODO: this was copied from Accurev2Git.Start(), remove this duplication at some point...
     try:
@@ -3875,39 +5632,13 @@ def PrintStatus(state):
         return
     # end TODO
 
-    # Setup AccuRev - TODO: this was copied from Accurev2Git.Start(), remove this duplication at some point...
-    acInfo = accurev.info()
-    doLogout = False
-    isLoggedIn = False
-    if state.config.accurev.username is None:
-        # When a username isn't specified we will use any logged in user for the conversion.
-        isLoggedIn = accurev.ext.is_loggedin(infoObj=acInfo)
-    else:
-        # When a username is specified that specific user must be logged in.
-        isLoggedIn = (acInfo.principal == state.config.accurev.username)
-
+    # Setup AccuRev
+    isLoggedIn, doLogout = AccuRevLogin(state.config.accurev.username, state.config.accurev.password)
     if not isLoggedIn:
-        # Login the requested user
-        if accurev.ext.is_loggedin(infoObj=acInfo):
-            # Different username, logout the other user first.
-            logoutSuccess = accurev.logout()
-            logger.info("Accurev logout for '{0}' {1}".format(acInfo.principal, 'succeeded' if logoutSuccess else 'failed'))
-
-        loginResult = accurev.login(state.config.accurev.username, state.config.accurev.password)
-        if loginResult:
-            logger.info("Accurev login for '{0}' succeeded.".format(state.config.accurev.username))
-        else:
-            logger.error("AccuRev login for '{0}' failed.\n".format(state.config.accurev.username))
-            logger.error("AccuRev message:\n{0}".format(loginResult.errorMessage))
-            return 1
-
-        doLogout = True
-    else:
-        logger.info("Accurev user '{0}', already logged in.".format(acInfo.principal))
+        return 1
 
     # If this script is being run on a replica then ensure that it is up-to-date before processing the streams.
     accurev.replica.sync()
-    # end TODO
 
     # Get all of the streams that have been recorded in Git's hidden refs.
     logger.info("Parsing hidden refs for downloaded AccuRev streams.")
@@ -3968,6 +5699,61 @@ def PrintStatus(state):
     if doLogout:
         accurev.logout()
 
+# Converts each of the depots listed in the depots element of the config into its own git repository, running up to config.depotWorkers
+# conversions concurrently. The conversions share one accurev login, one command cache and one limit on the number of accurev commands that
+# can run at the same time (config.maxAccurevCommands). Each conversion runs on a thread named after its depot so that its log output can be told apart.
+def ConvertDepots(config, isRestart=False, isSoftRestart=False):
+    depotConfigList = config.GetDepotConfigList()
+
+    doLogout = False
+    if config.method != 'skip':
+        isLoggedIn, doLogout = AccuRevLogin(config.accurev.username, config.accurev.password)
+        if not isLoggedIn:
+            return 1
+
+        # If this script is being run on a replica then ensure that it is up-to-date before processing the streams.
+        accurev.replica.sync()
+
+    if config.accurev.commandCacheFilename is not None:
+        accurev.ext.enable_command_cache(os.path.abspath(config.accurev.commandCacheFilename))
+    accurev.ext.set_max_concurrent_commands(config.maxAccurevCommands)
+
+    def convertDepot(depotConfig):
+        thread = threading.current_thread()
+        threadName, thread.name = thread.name, depotConfig.accurev.depot
+        try:
+            logger.info("Converting depot {depot} into {path}.".format(depot=depotConfig.accurev.depot, path=depotConfig.git.repoPath))
+            depotState = AccuRev2Git(depotConfig)
+            depotState.isSharedSession = True
+            return depotState.Start(isRestart=isRestart, isSoftRestart=isSoftRestart)
+        except:
+            logger.exception("Converting depot {depot} has failed!".format(depot=depotConfig.accurev.depot))
+            return 1
+        finally:
+            thread.name = threadName
+
+    failedDepotList = []
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, config.depotWorkers)) as executor:
+            futureList = [ (depotConfig.accurev.depot, executor.submit(convertDepot, depotConfig)) for depotConfig in depotConfigList ]
+            for depot, future in futureList:
+                if future.result() != 0:
+                    failedDepotList.append(depot)
+    finally:
+        accurev.ext.set_max_concurrent_commands(None)
+        if config.accurev.commandCacheFilename is not None:
+            accurev.ext.disable_command_cache()
+        if doLogout:
+            if accurev.logout():
+                logger.info( "Accurev logout successful." )
+            else:
+                logger.error("Accurev logout failed.\n")
+
+    if len(failedDepotList) > 0:
+        logger.error("Failed to convert depots: {0}".format(", ".join(failedDepotList)))
+        return 1
+    return 0
+
 def PrintRunningTime(referenceTime):
     outMessage = ''
     # Custom formatting of the timestamp
@@ -4048,8 +5834,12 @@ def AccuRev2GitMain(argv):
                 sys.stderr.write("Config file '{0}' not found.\n".format(args.configFilename))
                 return 1
             elif config.git is not None:
-                if not os.path.isabs(config.git.repoPath):
+                if config.git.repoPath is not None and not os.path.isabs(config.git.repoPath):
                     config.git.repoPath = os.path.abspath(config.git.repoPath)
+            if config.depots is not None:
+                for depot in config.depots:
+                    if depot is not None and depot.repoPath is not None and not os.path.isabs(depot.repoPath):
+                        depot.repoPath = os.path.abspath(depot.repoPath)
 
             # Set the overrides for in the configuration from the arguments
             SetConfigFromArgs(config=config, args=args)
@@ -4060,7 +5850,7 @@ def AccuRev2GitMain(argv):
             # Configure logging, but do it only once.
             if logger is None:
                 loggingLevel = logging.DEBUG if args.debug else logging.INFO
-                if not InitializeLogging(config.logFilename, loggingLevel):
+                if not InitializeLogging(config.logFilename, loggingLevel, logThreadName=(config.depots is not None)):
                     sys.stderr.write("Failed to initialize logging. Exiting.\n")
                     return 1
 
@@ -4070,14 +5860,22 @@ def AccuRev2GitMain(argv):
             PrintConfigSummary(state.config, args.configFilename)
             if args.status:
                 PrintMissingUsers(state.config)
-                PrintStatus(state)
+                if config.depots is not None:
+                    for depotConfig in config.GetDepotConfigList():
+                        logger.info("Depot {depot}:".format(depot=depotConfig.accurev.depot))
+                        PrintStatus(AccuRev2Git(depotConfig))
+                else:
+                    PrintStatus(state)
                 return 0
             if args.checkMissingUsers in [ "warn", "strict" ]:
                 if PrintMissingUsers(state.config) and args.checkMissingUsers == "strict":
                     sys.stderr.write("Found missing users. Exiting.\n")
                     return 1
             logger.info("Restart:" if args.restart else "Soft restart:" if args.softRestart else "Start:")
-            rv = state.Start(isRestart=args.restart, isSoftRestart=args.softRestart)
+            if config.depots is not None:
+                rv = ConvertDepots(config, isRestart=args.restart, isSoftRestart=args.softRestart)
+            else:
+                rv = state.Start(isRestart=args.restart, isSoftRestart=args.softRestart)
             PrintRunningTime(referenceTime=startTime)
             if not args.track:
                 break
@@ -15,6 +15,11 @@ import xml.etree.ElementTree as ElementTree
 import datetime
 import re
 import sqlite3
+import collections
+import itertools
+import heapq
+import concurrent.futures
+import threading
 
 # ################################################################################################ #
 # Script Globals                                                                                   #
@@ -1473,11 +1478,17 @@ class obj:
 # The raw class namespaces raw accurev commands that return text output directly from the terminal #
 # ################################################################################################ #
 class raw(object):
-    # The __lastCommand is used to access the return code that the last command had generated in most
-    # cases.
-    _lastCommand = None
+    # The lastCommand is used to access the return code that the last command had generated in most
+    # cases. It is kept per thread so that the commands run by other threads can't change it.
+    class ThreadState(threading.local):
+        def __init__(self):
+            self.lastCommand = None
+
+    _threadState = ThreadState()
     _accurevCmd = "accurev"
     _commandCacheFilename = None
+    # When set, limits the number of accurev commands which are run at the same time by all of the threads of this process.
+    _commandSemaphore = None
 
     class CommandCache(object):
         createTableQuery = '''
@@ -1505,7 +1516,8 @@ CREATE TABLE IF NOT EXISTS command_cache (
             self.cursor = None
 
         def Open(self):
-            self.connection = sqlite3.connect(self.filepath)
+            # The cache can be shared by several threads, each with its own connection, so wait for their writes instead of failing.
+            self.connection = sqlite3.connect(self.filepath, timeout=60)
             self.cursor = self.connection.cursor()
             self.cursor.execute(raw.CommandCache.createTableQuery)
             self.connection.commit()
@@ -1528,7 +1540,8 @@ CREATE TABLE IF NOT EXISTS command_cache (
             return row
 
         def Add(self, cmd, result, stdout, stderr=None):
-            self.cursor.execute('INSERT INTO command_cache (command, result, stdout, stderr) VALUES (?, ?, ?, ?);', (str(cmd), int(result), stdout, stderr))
+            # Another thread could have run and cached the same command since we've missed the cache, in which case either result is fine.
+            self.cursor.execute('INSERT OR REPLACE INTO command_cache (command, result, stdout, stderr) VALUES (?, ?, ?, ?);', (str(cmd), int(result), stdout, stderr))
             self.connection.commit()
 
         def Remove(self, cmd):
@@ -1550,26 +1563,33 @@ CREATE TABLE IF NOT EXISTS command_cache (
                 if row is not None:
                     # Cache hit!
                     cmd, returncode, output, error = row
-                    raw._lastCommand = None
+                    raw._threadState.lastCommand = None
                     return output
 
-        if outputFilename is not None:
-            outputFile = open(outputFilename, "w")
-            accurevCommand = subprocess.Popen(cmd, stdout=outputFile, stdin=subprocess.PIPE, universal_newlines=False)
-        else:
-            accurevCommand = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE, universal_newlines=False)
-            
-        output = ''
-        error = ''
-        accurevCommand.poll()
-        while accurevCommand.returncode is None:
-            stdoutdata, stderrdata = accurevCommand.communicate()
-            error += stderrdata.decode('utf8', 'strict')
-            if outputFile is None:
-                output += stdoutdata.decode('utf8', 'strict')
+        commandSemaphore = raw._commandSemaphore
+        if commandSemaphore is not None:
+            commandSemaphore.acquire()
+        try:
+            if outputFilename is not None:
+                outputFile = open(outputFilename, "w")
+                accurevCommand = subprocess.Popen(cmd, stdout=outputFile, stdin=subprocess.PIPE, universal_newlines=False)
+            else:
+                accurevCommand = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE, universal_newlines=False)
+                
+            output = ''
+            error = ''
             accurevCommand.poll()
+            while accurevCommand.returncode is None:
+                stdoutdata, stderrdata = accurevCommand.communicate()
+                error += stderrdata.decode('utf8', 'strict')
+                if outputFile is None:
+                    output += stdoutdata.decode('utf8', 'strict')
+                accurevCommand.poll()
+        finally:
+            if commandSemaphore is not None:
+                commandSemaphore.release()
         
-        raw._lastCommand = accurevCommand
+        raw._threadState.lastCommand = accurevCommand
 
         if raw._commandCacheFilename is not None and useCache:
             with raw.CommandCache(raw._commandCacheFilename) as cc:
@@ -1615,7 +1635,7 @@ CREATE TABLE IF NOT EXISTS command_cache (
                     error  += stderrdata
                 accurevCommand.poll()
             
-            raw._lastCommand = accurevCommand
+            raw._threadState.lastCommand = accurevCommand
             
             return obj.Login(errorMessage=error)
         
@@ -1626,7 +1646,7 @@ CREATE TABLE IF NOT EXISTS command_cache (
         accurevCommand = subprocess.Popen([ "accurev", "logout" ], universal_newlines=True)
         accurevCommand.wait()
         
-        raw._lastCommand = accurevCommand
+        raw._threadState.lastCommand = accurevCommand
         
         return (accurevCommand.returncode == 0)
 
@@ -2201,7 +2221,7 @@ def stat(all=False, inBackingStream=False, dispBackingChain=False, defaultGroupO
         , underlapedElementsOnly=underlapedElementsOnly, pendingElementsOnly=pendingElementsOnly, dontOptimizeSearch=dontOptimizeSearch
         , directoryTreePath=directoryTreePath, stream=stream, externalOnly=externalOnly, showExcluded=showExcluded
         , timeSpec=timeSpec, ignorePatternsList=ignorePatternsList, listFile=listFile, elementList=elementList, outputFilename=outputFilename)
-    if raw._lastCommand.returncode == 0:
+    if raw._threadState.lastCommand.returncode == 0:
         return obj.Stat.fromxmlstring(outputXml)
     else:
         return None
@@ -2236,22 +2256,22 @@ def pop(isRecursive=False, isOverride=False, verSpec=None, location=None, dontBu
 # AccuRev checkout command
 def co(comment=None, selectAllModified=False, verSpec=None, isRecursive=False, transactionNumber=None, elementId=None, listFile=None, elementList=None):
     output = raw.oo(comment=comment, selectAllModified=selectAllModified, verSpec=verSpec, isRecursive=isRecursive, transactionNumber=transactionNumber, elementId=elementId, listFile=listFile, elementList=elementList)
-    if raw._lastCommand is not None:
-        return (raw._lastCommand.returncode == 0)
+    if raw._threadState.lastCommand is not None:
+        return (raw._threadState.lastCommand.returncode == 0)
     return None
 
 def cat(elementId=None, element=None, depotName=None, verSpec=None, outputFilename=None, useCache=False):
     if useCache:
         useCache = useCache and outputFilename is None
     output = raw.cat(elementId=elementId, element=element, depotName=depotName, verSpec=verSpec, outputFilename=outputFilename, useCache=useCache)
-    if raw._lastCommand is not None:
+    if raw._threadState.lastCommand is not None:
         return output
     return None
 
 def purge(comment=None, stream=None, issueNumber=None, elementList=None, listFile=None, elementId=None):
     output = raw.purge(comment=comment, stream=stream, issueNumber=issueNumber, elementList=elementList, listFile=listFile, elementId=elementId)
-    if raw._lastCommand is not None:
-        return (raw._lastCommand.returncode == 0)
+    if raw._threadState.lastCommand is not None:
+        return (raw._threadState.lastCommand.returncode == 0)
     return None
 
 # AccuRev ancestor command
@@ -2261,14 +2281,14 @@ def anc(element, commonAncestor=False, versionId=None, basisVersion=False, commo
     
 def chstream(stream, newBackingStream=None, timeSpec=None, newName=None):
     raw.chstream(stream=stream, newBackingStream=newBackingStream, timeSpec=timeSpec, newName=newName)
-    if raw._lastCommand is not None:
-        return (raw._lastCommand.returncode == 0)
+    if raw._threadState.lastCommand is not None:
+        return (raw._threadState.lastCommand.returncode == 0)
     return None
     
 def chws(workspace, newBackingStream=None, newLocation=None, newMachine=None, kind=None, eolType=None, isMyWorkspace=True, newName=None):
     raw.chws(workspace=workspace, newBackingStream=newBackingStream, newLocation=newLocation, newMachine=newMachine, kind=kind, eolType=eolType, isMyWorkspace=isMyWorkspace, newName=newName)
-    if raw._lastCommand is not None:
-        return (raw._lastCommand.returncode == 0)
+    if raw._threadState.lastCommand is not None:
+        return (raw._threadState.lastCommand.returncode == 0)
     return None
         
 def update(refTree=None, doPreview=False, transactionNumber=None, mergeOnUpdate=False, isOverride=False, outputFilename=None):
@@ -2324,8 +2344,8 @@ class replica(object):
     @staticmethod
     def sync():
         raw.replica.sync()
-        if raw._lastCommand is not None:
-            return (raw._lastCommand.returncode == 0)
+        if raw._threadState.lastCommand is not None:
+            return (raw._threadState.lastCommand.returncode == 0)
         return None
         
 # ################################################################################################ #
@@ -2346,6 +2366,15 @@ class ext(object):
     def disable_command_cache():
         raw._commandCacheFilename = None
 
+    # Limits the number of accurev commands that can run concurrently, across all threads, to maxCommands. Passing None or 0 removes the limit.
+    # Should be called before any of the threads that run accurev commands are started.
+    @staticmethod
+    def set_max_concurrent_commands(maxCommands):
+        if maxCommands is None or maxCommands <= 0:
+            raw._commandSemaphore = None
+        else:
+            raw._commandSemaphore = threading.BoundedSemaphore(maxCommands)
+
 
 
     # Get the mkstream transaction for the stream. This can sometimes be a non-trivial operation depending on how old the depot is (version of accurev).
@@ -2427,6 +2456,84 @@ class ext(object):
 
         return mkstreamTr
 
+    # Get the mkstream transactions for all of the streams in the depot at once. Does the same work as get_mkstream_transaction() but
+    # fetches the depot's mkstream and chstream history only once, in chunks of up to maxWorkers concurrent commands (see chunked_hist()), and
+    # matches it to the streams in memory, which is a lot quicker than
+    # calling get_mkstream_transaction() for every stream when there are many streams to resolve.
+    # returns a dictionary mapping stream numbers to obj.Transaction. Streams whose mkstream transaction couldn't be found are omitted.
+    @staticmethod
+    def get_mkstream_transactions(depot, useCache=False, maxWorkers=1):
+        streams = show.streams(depot=depot, includeDeactivatedItems=True, useCache=useCache)
+        try:
+            mkstreamList = list(ext.chunked_hist(depot=depot, timeSpec="highest-1", transactionKind="mkstream", maxWorkers=maxWorkers, useCache=useCache))
+        except Exception:
+            mkstreamList = None
+        if streams is None or mkstreamList is None:
+            return None
+
+        rv = {}
+        ambiguousSet = set()
+        unnamedMkstreams = []
+        for t in mkstreamList:
+            # As of AccuRev 4.7.2 the mkstream transaction includes the stream-ID.
+            streamName, streamNumber = t.affectedStream()
+            if streamNumber is None:
+                unnamedMkstreams.append(t)
+            elif streamNumber in rv:
+                ambiguousSet.add(streamNumber) # There seem to be multiple mkstream transactions for this stream.
+            else:
+                rv[streamNumber] = t
+        for streamNumber in ambiguousSet:
+            del rv[streamNumber]
+
+        # See get_mkstream_transaction() for the assumptions made about the root stream.
+        if 1 not in rv and streams.getStream(1) is not None:
+            firstTr = hist(depot=depot, timeSpec="1", useCache=useCache)
+            if firstTr is not None and len(firstTr.transactions) > 0:
+                rv[1] = firstTr.transactions[0]
+
+        unresolvedList = [ s for s in streams.streams if s.streamNumber not in rv and s.streamNumber not in ambiguousSet ]
+        if len(unresolvedList) == 0 or len(unnamedMkstreams) == 0:
+            return rv
+
+        # The remaining streams are matched by their startTime, which is the time of their last chstream or mkstream transaction. For streams that
+        # have chstream transactions we need the stream definition from just before the first chstream transaction, which we get from the depot history.
+        try:
+            chstreamList = list(ext.chunked_hist(depot=depot, timeSpec="highest-1", transactionKind="chstream", maxWorkers=maxWorkers, useCache=useCache))
+        except Exception:
+            chstreamList = None
+        firstChstreamMap = {}
+        if chstreamList is not None:
+            for t in chstreamList: # Sorted in descending order so the last one we see is the first chstream.
+                streamName, streamNumber = t.affectedStream()
+                if streamNumber is not None:
+                    firstChstreamMap[streamNumber] = t
+
+        streamsCache = {} # Each `accurev show streams -t <tr>` is executed at most once.
+        def getStreamsAt(trId):
+            if trId not in streamsCache:
+                streamsCache[trId] = show.streams(depot=depot, timeSpec=trId, includeDeactivatedItems=True, useCache=useCache)
+            return streamsCache[trId]
+
+        for streamInfo in unresolvedList:
+            if streamInfo.streamNumber in firstChstreamMap:
+                streamsBefore = getStreamsAt(firstChstreamMap[streamInfo.streamNumber].id - 1)
+                streamInfo = None if streamsBefore is None else streamsBefore.getStream(streamInfo.streamNumber)
+                if streamInfo is None:
+                    continue
+
+            mkstreamTrList = [ t for t in unnamedMkstreams if GetTimestamp(t.time) == GetTimestamp(streamInfo.startTime) ]
+            if len(mkstreamTrList) == 1:
+                rv[streamInfo.streamNumber] = mkstreamTrList[0]
+            elif len(mkstreamTrList) > 1:
+                for t in mkstreamTrList:
+                    before, after = getStreamsAt(t.id - 1), getStreamsAt(t.id)
+                    if before is not None and after is not None and before.getStream(streamInfo.streamNumber) is None and after.getStream(streamInfo.streamNumber) is not None:
+                        rv[streamInfo.streamNumber] = t
+                        break
+
+        return rv
+
     # Get the last chstream transaction. If no chstream transactions have been made the mkstream
     # transaction is returned. If no mkstream transaction exists None is returned.
     # returns obj.Transaction
@@ -2559,16 +2666,70 @@ class ext(object):
 
         return timeSpec
 
+    @staticmethod
+    # Retrieves the history for the given time-spec in chunks of chunkSize transactions, running at most maxWorkers `accurev hist` commands at a time,
+    # and yields the obj.Transaction(object) types one by one in the order requested by the time-spec.
+    # The chunk boundaries are aligned to multiples of chunkSize and are never extended past the depot's highest transaction. Hence each chunk is
+    # a numeric, immutable, time-spec which is cached on its own in the command cache and reused by any later query whose range covers it.
+    def chunked_hist(depot, stream=None, timeSpec='highest-1', transactionKind=None, chunkSize=1000, maxWorkers=1, useCache=False):
+        ts = ext.normalize_timespec(depot=depot, timeSpec=timeSpec)
+        isAsc = ts.is_asc()
+        if not isAsc:
+            ts = ts.reversed()
+
+        highest = hist(depot=depot, timeSpec="highest", useCache=False)
+        if highest is None or len(highest.transactions) == 0:
+            raise Exception("Failed to get the highest transaction for depot {0}".format(depot))
+        highestTrId = highest.transactions[0].id
+
+        chunkList = []
+        chunkStart = ((ts.start - 1) // chunkSize) * chunkSize + 1
+        while chunkStart <= min(ts.end, highestTrId):
+            chunkEnd = min(chunkStart + chunkSize - 1, highestTrId)
+            chunkList.append(obj.TimeSpec(start=chunkStart, end=chunkEnd))
+            chunkStart += chunkSize
+        if not isAsc:
+            chunkList.reverse()
+
+        def fetchChunk(chunkTs):
+            xmlOutput = raw.hist(depot=depot, stream=stream, timeSpec=str(chunkTs), transactionKind=transactionKind, expandedMode=True, isXmlOutput=True, useCache=useCache)
+            h = obj.History.fromxmlstring(xmlOutput)
+            if h is None:
+                # When none of the chunk's transactions are of the requested kind accurev only prints a message to stderr, which isn't XML. Any other
+                # failure would have failed the query for the highest transaction above as well.
+                if transactionKind is not None and (xmlOutput is None or len(xmlOutput.strip()) == 0):
+                    return []
+                raise Exception("accurev hist -p {0} -t {1} failed!".format(depot, chunkTs))
+            trList = sorted([ tr for tr in h.transactions if ts.start <= tr.id <= ts.end ], key=lambda tr: tr.id, reverse=(not isAsc))
+            return trList
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            # Keep only maxWorkers chunks in flight so that we don't hold the whole history in memory at once.
+            chunkIter = iter(chunkList)
+            pending = collections.deque(executor.submit(fetchChunk, c) for c in itertools.islice(chunkIter, maxWorkers))
+            while len(pending) > 0:
+                future = pending.popleft()
+                nextChunk = next(chunkIter, None)
+                if nextChunk is not None:
+                    pending.append(executor.submit(fetchChunk, nextChunk))
+                for tr in future.result():
+                    yield tr
+
     @staticmethod
     # Retrieves a list of _all transactions_ which affect the given stream, directly or indirectly (via parent promotes).
     # Returns a list of obj.Transaction(object) types.
-    def deep_hist(depot=None, stream=None, timeSpec='now', ignoreTimelocks=False, useCache=False):
+    # The recursive queries on the parent streams are independent of each other and can be run concurrently, using up to maxWorkers threads for
+    # the whole recursion. The workerSlots semaphore, which limits the number of extra threads, is created by the outermost call and passed down.
+    def deep_hist(depot=None, stream=None, timeSpec='now', ignoreTimelocks=False, useCache=False, maxWorkers=1, workerSlots=None):
         # Validate arguments
         # ==================
         if stream is None:
             # When the stream is not specified then we just want all the depot transactions for the given time-spec.
             return hist(depot=depot, timeSpec=timeSpec, useCache=useCache)
 
+        if workerSlots is None and maxWorkers is not None and maxWorkers > 1:
+            workerSlots = threading.BoundedSemaphore(maxWorkers - 1)
+
         if isinstance(timeSpec, obj.TimeSpec):
             ts = timeSpec
         elif isinstance(timeSpec, str):
@@ -2630,7 +2791,7 @@ class ext(object):
             if streamInfo.basisStreamNumber is None:
                 return []
 
-            rv = ext.deep_hist(depot=depot, stream=streamInfo.basis, timeSpec=ts, ignoreTimelocks=ignoreTimelocks, useCache=useCache)
+            rv = ext.deep_hist(depot=depot, stream=streamInfo.basis, timeSpec=ts, ignoreTimelocks=ignoreTimelocks, useCache=useCache, maxWorkers=maxWorkers, workerSlots=workerSlots)
             if not isAsc:
                 rv.reverse()
 
@@ -2642,6 +2803,8 @@ class ext(object):
         # ===========================
         # The transaction list that combines all of the transactions which affect this stream.
         trList = []
+        # The (parentStream, timeSpec) pairs for which we need to run deep_hist() recursively. They are collected first and run concurrently at the end.
+        parentQueryList = []
 
         # Get the history for the requested stream in the requested transaction range _ts_.
         history = hist(depot=depot, stream=stream, timeSpec=str(ts), useCache=useCache)
@@ -2679,8 +2842,7 @@ class ext(object):
                         if timelockTs is not None:
                             # If there are useful transactions to process we will call deep_hist() on our parent stream and include the list of transactions returned
                             # into our result.
-                            parentTrList = ext.deep_hist(depot=depot, stream=parentStream, timeSpec=timelockTs, ignoreTimelocks=ignoreTimelocks, useCache=useCache)
-                            trList.extend(parentTrList)
+                            parentQueryList.append( (parentStream, timelockTs) )
                     # Here everything before the `chstream` transaction has already been processed with the deep-hist algorithm for all parents in the hierarchy
                     # and so we only need to run deep_hist() on our parent hierarchy for the remaining transactions, which are recorded in the _parentTs_ variable.
                     parentTs = obj.TimeSpec(start=tr.id, end=ts.end)
@@ -2698,10 +2860,36 @@ class ext(object):
             if not ignoreTimelocks:
                 timelockTs = ext.restrict_timespec_to_timelock(depot=streamInfo.depotName, timeSpec=parentTs, timelock=streamInfo.time)
             if timelockTs is not None: # A None value indicates that the entire timespec is after the timelock.
-                parentTrList = ext.deep_hist(depot=depot, stream=parentStream, timeSpec=timelockTs, ignoreTimelocks=ignoreTimelocks, useCache=useCache)
-                trList.extend(parentTrList)
-
-        rv = sorted(trList, key=lambda tr: tr.id)
+                parentQueryList.append( (parentStream, timelockTs) )
+
+        # Each of the lists is sorted in ascending order so we only need to merge them, which is quicker than sorting the concatenated list.
+        # A parent query is run on a new thread only if one of the workerSlots is free and on this thread otherwise (as is the last one), so the
+        # number of threads stays bounded however deep the recursion goes and no thread ever waits for a slot.
+        sortedLists = [ sorted(trList, key=lambda tr: tr.id) ]
+        threadList = []
+        for i, (parentStream, parentTs) in enumerate(parentQueryList):
+            queryArgs = dict(depot=depot, stream=parentStream, timeSpec=parentTs, ignoreTimelocks=ignoreTimelocks, useCache=useCache, maxWorkers=maxWorkers, workerSlots=workerSlots)
+            if i < len(parentQueryList) - 1 and workerSlots is not None and workerSlots.acquire(blocking=False):
+                result = []
+                def runQuery(queryArgs=queryArgs, result=result):
+                    try:
+                        result.append(ext.deep_hist(**queryArgs))
+                    except BaseException as e:
+                        result.append(e)
+                    finally:
+                        workerSlots.release()
+                thread = threading.Thread(target=runQuery, name="{0}-deep_hist".format(threading.current_thread().name))
+                thread.start()
+                threadList.append( (thread, result) )
+            else:
+                sortedLists.append(ext.deep_hist(**queryArgs))
+        for thread, result in threadList:
+            thread.join()
+            if len(result) == 0 or isinstance(result[0], BaseException):
+                raise result[0] if len(result) > 0 else Exception("deep_hist() failed for a parent of {0}".format(stream))
+            sortedLists.append(result[0])
+
+        rv = list(heapq.merge(*sortedLists, key=lambda tr: tr.id))
         # Depending on the ordering of the provided time-spec return the transactions in the expected order (ascending/descending)
         if not isAsc:
             rv.reverse()
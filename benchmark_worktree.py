@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+# Benchmark for the worktree maintenance that ac2git.py does for every transaction (see AccuRev2Git.WalkWorktree()).
+# It builds two identical synthetic worktrees and runs the same sequence of operations on each, one with the current
+# scandir based implementation and one with the os.walk based implementation that it replaced, and reports the times.
+
+import sys
+import os
+import time
+import shutil
+import codecs
+import logging
+import argparse
+import tempfile
+
+import git
+import ac2git
+
+# The os.walk based implementation, kept here for reference.
+def OldClearGitRepo(repoPath):
+    for root, dirs, files in os.walk(repoPath, topdown=False):
+        for name in files:
+            path = os.path.join(root, name)
+            if git.GetGitDirPrefix(path) is None:
+                os.unlink(path)
+        for name in dirs:
+            path = os.path.join(root, name)
+            if git.GetGitDirPrefix(path) is None:
+                shutil.rmtree(path)
+
+def OldIterWorktreeDirs(repoPath):
+    for root, dirs, files in os.walk(repoPath, topdown=True):
+        for name in dirs:
+            yield ac2git.ToUnixPath(os.path.join(root, name))
+
+def OldPreserveEmptyDirs(repoPath):
+    preservedDirs = []
+    for path in OldIterWorktreeDirs(repoPath):
+        if git.GetGitDirPrefix(path) is None and len(os.listdir(path)) == 0:
+            filename = os.path.join(path, '.gitignore')
+            with codecs.open(filename, 'w', 'utf-8'):
+                preservedDirs.append(filename)
+    return preservedDirs
+
+def OldDeleteEmptyDirs(repoPath):
+    deletedDirs = []
+    for path in OldIterWorktreeDirs(repoPath):
+        if git.GetGitDirPrefix(path) is None and os.path.isdir(path):
+            dirlist = os.listdir(path)
+            delete = (len(dirlist) == 0)
+            if len(dirlist) == 1 and '.gitignore' in dirlist:
+                with codecs.open(os.path.join(path, '.gitignore')) as gi:
+                    delete = (len(gi.read().strip()) == 0)
+            if delete:
+                shutil.rmtree(path)
+                deletedDirs.append(path)
+    return deletedDirs
+
+def OldListWorktreeFiles(repoPath):
+    fileList = []
+    for root, dirs, files in os.walk(repoPath, topdown=True):
+        if os.path.abspath(root) == repoPath and '.git' in dirs:
+            dirs.remove('.git')
+        linkedDirs = [ d for d in dirs if os.path.islink(os.path.join(root, d)) ]
+        for name in files + linkedDirs:
+            filePath = os.path.join(root, name)
+            if git.GetGitDirPrefix(filePath) is None:
+                fileList.append(ac2git.ToUnixPath(os.path.relpath(filePath, repoPath)))
+    return fileList
+
+# Builds a worktree with fileCount files spread over directories nested depth levels deep with fanout subdirectories each. Every tenth directory
+# also gets an empty subdirectory, to be preserved, and every tenth after that one with an empty .gitignore, to be deleted.
+def BuildTree(repoPath, fileCount, depth, fanout):
+    os.makedirs(os.path.join(repoPath, '.git', 'objects'))
+    leafDirs = [ repoPath ]
+    for level in range(0, depth):
+        leafDirs = [ os.path.join(d, 'dir{0}'.format(i)) for d in leafDirs for i in range(0, fanout) ]
+    for i, leafDir in enumerate(leafDirs):
+        os.makedirs(leafDir)
+        if i % 10 == 0:
+            os.makedirs(os.path.join(leafDir, 'empty'))
+        elif i % 10 == 1:
+            os.makedirs(os.path.join(leafDir, 'preserved'))
+            open(os.path.join(leafDir, 'preserved', '.gitignore'), 'w').close()
+    for i in range(0, fileCount):
+        with open(os.path.join(leafDirs[i % len(leafDirs)], 'file{0}.txt'.format(i)), 'w') as f:
+            f.write('{0}\n'.format(i))
+
+def Time(results, name, fn):
+    start = time.perf_counter()
+    rv = fn()
+    results.append((name, time.perf_counter() - start))
+    return rv
+
+def Main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks the worktree maintenance done by ac2git.py on a synthetic worktree.')
+    parser.add_argument('-n', '--files', dest='fileCount', type=int, default=100000, help='The number of files in the synthetic worktree.')
+    parser.add_argument('-d', '--depth', dest='depth', type=int, default=3, help='The depth of the synthetic worktree directories.')
+    parser.add_argument('-f', '--fanout', dest='fanout', type=int, default=10, help='The number of subdirectories in each synthetic worktree directory.')
+    parser.add_argument('-p', '--path', dest='path', default=None, help='The directory in which to build the synthetic worktrees. Defaults to a temporary directory.')
+    args = parser.parse_args(argv[1:])
+
+    # The AccuRev2Git methods log their progress, which would only add noise to the timings.
+    ac2git.InitializeLogging(filename=None, level=logging.WARNING)
+
+    rootPath = tempfile.mkdtemp(prefix='ac2git_benchmark_', dir=args.path)
+    try:
+        oldRepoPath, newRepoPath = os.path.join(rootPath, 'old'), os.path.join(rootPath, 'new')
+        print("Building two worktrees with {n} files in {p}...".format(n=args.fileCount, p=rootPath))
+        BuildTree(oldRepoPath, args.fileCount, args.depth, args.fanout)
+        BuildTree(newRepoPath, args.fileCount, args.depth, args.fanout)
+
+        oldResults = []
+        oldPreserved = Time(oldResults, 'PreserveEmptyDirs', lambda: OldPreserveEmptyDirs(oldRepoPath))
+        oldFiles = Time(oldResults, 'ListWorktreeFiles', lambda: OldListWorktreeFiles(oldRepoPath))
+        oldDeleted = Time(oldResults, 'DeleteEmptyDirs', lambda: OldDeleteEmptyDirs(oldRepoPath))
+        Time(oldResults, 'ClearGitRepo', lambda: OldClearGitRepo(oldRepoPath))
+
+        state = ac2git.AccuRev2Git(config=None)
+        state.gitRepo = git.repo(newRepoPath)
+        newResults = []
+        newPreserved = Time(newResults, 'PreserveEmptyDirs', lambda: state.PreserveEmptyDirs())
+        newFiles = Time(newResults, 'ListWorktreeFiles', lambda: state.ListWorktreeFiles())
+        newDeleted = Time(newResults, 'DeleteEmptyDirs', lambda: state.DeleteEmptyDirs())
+        Time(newResults, 'ClearGitRepo', lambda: state.ClearGitRepo())
+
+        relPaths = lambda repoPath, pathList: sorted([ os.path.relpath(p, repoPath) for p in pathList ])
+        if relPaths(oldRepoPath, oldPreserved) != relPaths(newRepoPath, newPreserved) or sorted(oldFiles) != sorted(newFiles) or relPaths(oldRepoPath, oldDeleted) != relPaths(newRepoPath, newDeleted):
+            print("The two implementations gave different results!")
+            return 1
+
+        print("{0:<20} {1:>10} {2:>10} {3:>8}".format('', 'os.walk', 'scandir', 'speedup'))
+        for (name, oldTime), (newName, newTime) in zip(oldResults, newResults):
+            print("{0:<20} {1:>9.3f}s {2:>9.3f}s {3:>7.1f}x".format(name, oldTime, newTime, oldTime / newTime if newTime > 0 else float('inf')))
+        print("{0} empty directories preserved, {1} files listed, {2} empty directories deleted.".format(len(newPreserved), len(newFiles), len(newDeleted)))
+    finally:
+        shutil.rmtree(rootPath, ignore_errors=True)
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(Main(sys.argv))
@@ -16,6 +16,10 @@ import xml.etree.ElementTree as ElementTree
 import datetime
 import re
 import types
+import calendar
+import threading
+import io
+import tempfile
 from math import floor
 
 gitCmd = u'git'
@@ -402,6 +406,30 @@ def getDatetimeString(date, timezone=None):
     
     return dateStr
 
+# Returns the date in the `<unix timestamp> <+-hhmm>` format used by `git fast-import --date-format=raw`. The date is the local time in the given
+# timezone, as used with getDatetimeString(), unless it is timezone aware.
+def getRawDatetimeString(date, timezone=None):
+    if date is None:
+        date = datetime.datetime.utcnow()
+        timezone = 0
+    if date.utcoffset() is not None:
+        tzoffset = date.utcoffset()
+        timestamp = int(calendar.timegm(date.utctimetuple()))
+    else:
+        if timezone is None:
+            timezone = 0
+        timezone = int(timezone)
+        tzoffset = datetime.timedelta(hours=int(abs(timezone) / 100), minutes=abs(timezone) % 100)
+        if timezone < 0:
+            tzoffset = -tzoffset
+        timestamp = int(calendar.timegm(date.timetuple()) - tzoffset.total_seconds())
+    tzminutes = int(abs(tzoffset.total_seconds()) / 60)
+    return u'{0} {1}{2:02}{3:02}'.format(timestamp, '-' if tzoffset.total_seconds() < 0 else '+', int(tzminutes / 60), tzminutes % 60)
+
+# Quotes a path for use in a `git fast-import` filemodify or filedelete command.
+def quote_fast_import_path(path):
+    return path.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
 def set_author_or_committer_environment(who="author", name=None, email=None, date=None, tz=None, env={}):
     if who is None or who.lower() not in [ "author", "committer" ]:
         raise Exception("set_author_or_committer_environment: the 'who' argument can be set to 'author' or 'commiter' but not '{0}'".format(who))
@@ -426,6 +454,7 @@ class repo(object):
             path = path.decode("utf-8")
         self.path = path
         self.notes = repo.notes(self)
+        self.catFile = repo.cat_file(self)
         # Debug
         self.lastStderr = None
         self.lastStdout = None
@@ -433,11 +462,15 @@ class repo(object):
         # Private
         self._lastCommand = None
     
-    def _docmd(self, cmd, env=None):
-        process = subprocess.Popen(args=cmd, cwd=self.path, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=False)
+    def _docmd(self, cmd, env=None, input=None):
+        process = subprocess.Popen(args=cmd, cwd=self.path, env=env, stdin=(subprocess.PIPE if input is not None else None), stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=False)
 
         output = ''
         error  = ''
+        if input is not None:
+            stdoutdata, stderrdata = process.communicate(input=input.encode('utf-8'))
+            output += decode_proc_output( stdoutdata )
+            error  += decode_proc_output( stderrdata )
         process.poll()
         while process.returncode is None:
             stdoutdata, stderrdata = process.communicate()
@@ -466,6 +499,21 @@ class repo(object):
     def raw_cmd(self, cmd):
         return self._docmd(cmd)
 
+    # Runs the command and yields its output line by line, as it is produced, without the line endings. The lastReturnCode and lastStderr are set
+    # once the output has been exhausted. The stderr goes to a temporary file, since it is only read at the end, so that git can't block on a full
+    # stderr pipe while we are waiting for its stdout.
+    def iter_cmd(self, cmd):
+        with tempfile.TemporaryFile() as stderrFile:
+            process = subprocess.Popen(args=cmd, cwd=self.path, stdout=subprocess.PIPE, stderr=stderrFile, universal_newlines=False)
+            try:
+                for line in process.stdout:
+                    yield decode_proc_output(line).rstrip('\r\n')
+            finally:
+                process.stdout.close()
+                self.lastReturnCode = process.wait()
+                stderrFile.seek(0)
+                self.lastStderr = decode_proc_output(stderrFile.read())
+
     def empty_tree(self, write=False):
         cmd = [ gitCmd, u'hash-object', '-t', 'tree' ]
         if write:
@@ -493,7 +541,7 @@ class repo(object):
     def branch(self):
         raise Exception("Not yet implemented!")
     
-    def rm(self, fileList = [], recursive=False, force=False, cached=False):
+    def rm(self, fileList = [], recursive=False, force=False, cached=False, ignoreUnmatch=False, quiet=False):
         if len(fileList) > 0:
             cmd = [ gitCmd, u'rm' ]
 
@@ -503,6 +551,10 @@ class repo(object):
                 cmd.append(u'-f')
             if cached:
                 cmd.append(u'--cached')
+            if ignoreUnmatch:
+                cmd.append(u'--ignore-unmatch')
+            if quiet:
+                cmd.append(u'-q')
 
             cmd.append(u'--')
             cmd.extend(fileList)
@@ -539,6 +591,63 @@ class repo(object):
         
         return (output is not None)
     
+    # Writes the text as a blob into the object database (when write is set) and returns its hash. No filters are applied to the text.
+    def hash_object(self, text, write=False, git_opts=[]):
+        cmd = [ gitCmd ]
+        
+        if git_opts is not None and len(git_opts) > 0:
+            cmd.extend(git_opts)
+
+        cmd.extend([ u'hash-object', u'--no-filters', u'--stdin' ])
+
+        if write:
+            cmd.append(u'-w')
+
+        output = self._docmd(cmd, input=text)
+        if output is not None:
+            output = output.strip()
+
+        return output
+
+    # Writes a tree object from the entry list and returns its hash. Each entry is a (mode, type, hash, name) tuple, e.g. ('100644', 'blob', '<hash>', 'file.txt').
+    def mktree(self, entryList, git_opts=[]):
+        cmd = [ gitCmd ]
+        
+        if git_opts is not None and len(git_opts) > 0:
+            cmd.extend(git_opts)
+
+        cmd.extend([ u'mktree', u'-z' ])
+
+        output = self._docmd(cmd, input=''.join([ u'{mode} {type} {hash}\t{name}\0'.format(mode=mode, type=objType, hash=objHash, name=name) for mode, objType, objHash, name in entryList ]))
+        if output is not None:
+            output = output.strip()
+
+        return output
+
+    # Updates the index entries for the given paths, which are passed to git over stdin so that the list isn't limited by the command line length.
+    def update_index(self, fileList=[], add=False, remove=False, forceRemove=False, replace=False, git_opts=[]):
+        cmd = [ gitCmd ]
+        
+        if git_opts is not None and len(git_opts) > 0:
+            cmd.extend(git_opts)
+
+        cmd.append(u'update-index')
+
+        if add:
+            cmd.append(u'--add')
+        if remove:
+            cmd.append(u'--remove')
+        if forceRemove:
+            cmd.append(u'--force-remove')
+        if replace:
+            cmd.append(u'--replace')
+
+        cmd.extend([ u'-z', u'--stdin' ])
+
+        output = self._docmd(cmd, input=''.join([ u'{0}\0'.format(f) for f in fileList ]))
+
+        return (output is not None)
+
     def write_tree(self, missingOk=False, prefix=None, git_opts=[]):
         cmd = [ gitCmd ]
         
@@ -863,6 +972,227 @@ class repo(object):
             cmd = [ u'show', obj ]
             
             return self._docmd(cmd=cmd, ref=ref)
+
+    # A long running `git fast-import` process which writes commits straight into the object database. The refs written by the commits are only
+    # updated in the repository at a checkpoint() or when the process is closed. Everything written since the last checkpoint is lost if the
+    # process is killed, which leaves the refs at their last checkpointed commits.
+    class fast_import(object):
+        # The size of the chunks in which the contents of a file_data are copied to git fast-import.
+        fileChunkSize = 1024 * 1024
+
+        # The contents of the file at path, for the fileList of commit(), which are streamed to git fast-import as they are read instead of being
+        # held in memory.
+        class file_data(object):
+            def __init__(self, path):
+                self.path = path
+
+            def __repr__(self):
+                return "fast_import.file_data(path=" + repr(self.path) + ")"
+
+        def __init__(self, repo):
+            self.repo = repo
+            self.process = None
+            self.lastMark = 0
+            self.checkpointCount = 0
+            self.hashMarks = {} # The commits written by this process can't be referred to by hash until they are checkpointed so we use their marks instead.
+
+        def start(self):
+            if self.process is None:
+                cmd = [ gitCmd, u'-c', u'core.autocrlf=false', u'fast-import', u'--quiet', u'--done', u'--date-format=raw' ]
+                self.process = subprocess.Popen(args=cmd, cwd=self.repo.path, stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=False)
+            return self.process
+
+        def _write(self, data):
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            self.start().stdin.write(data)
+
+        def _readline(self):
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+            if len(line) == 0:
+                raise Exception("git fast-import exited unexpectedly with code {0}".format(self.process.poll()))
+            return decode_proc_output(line).strip()
+
+        def _data(self, data):
+            if isinstance(data, repo.fast_import.file_data):
+                return self._file_data(data.path)
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            self._write(u'data {0}\n'.format(len(data)))
+            self._write(data)
+            self._write(u'\n')
+
+        def _file_data(self, path):
+            with io.open(path, 'rb') as f: # The module's open() function shadows the builtin one.
+                size = os.fstat(f.fileno()).st_size
+                self._write(u'data {0}\n'.format(size))
+                remaining = size
+                while remaining > 0:
+                    chunk = f.read(min(remaining, self.fileChunkSize))
+                    if len(chunk) == 0:
+                        raise Exception("The file {0} was truncated while it was written to git fast-import.".format(path))
+                    self._write(chunk)
+                    remaining -= len(chunk)
+            self._write(u'\n')
+
+        # Writes a commit to the ref and returns its mark. The parents are commit hashes or marks, where the first parent is the commit whose tree is
+        # modified by the deleteAll, deleteList and fileList arguments. The fileList is a list of (mode, data, path) tuples, where the data is either
+        # the contents (bytes or str) or a file_data.
+        def commit(self, ref, message, parents=[], fileList=[], deleteList=[], deleteAll=False, author_name=None, author_email=None, author_date=None, author_tz=None, committer_name=None, committer_email=None, committer_date=None, committer_tz=None):
+            self.lastMark += 1
+            mark = u':{0}'.format(self.lastMark)
+
+            self._write(u'commit {ref}\nmark {mark}\n'.format(ref=ref, mark=mark))
+            if author_name is not None:
+                self._write(u'author {name} <{email}> {date}\n'.format(name=author_name, email=author_email if author_email is not None else '', date=getRawDatetimeString(author_date, author_tz)))
+            self._write(u'committer {name} <{email}> {date}\n'.format(name=committer_name if committer_name is not None else author_name, email=(committer_email if committer_email is not None else author_email) or '', date=getRawDatetimeString(committer_date if committer_date is not None else author_date, committer_tz if committer_date is not None else author_tz)))
+            self._data(message)
+
+            if parents is not None and len(parents) > 0:
+                parents = [ self.hashMarks.get(parent, parent) for parent in parents ]
+                self._write(u'from {0}\n'.format(parents[0]))
+                for parent in parents[1:]:
+                    self._write(u'merge {0}\n'.format(parent))
+
+            if deleteAll:
+                self._write(u'deleteall\n')
+            for path in deleteList:
+                self._write(u'D "{0}"\n'.format(quote_fast_import_path(path)))
+            for mode, data, path in fileList:
+                self._write(u'M {mode} inline "{path}"\n'.format(mode=mode, path=quote_fast_import_path(path)))
+                self._data(data)
+            self._write(u'\n')
+
+            return mark
+
+        # Returns the commit hash for the given mark.
+        def get_mark(self, mark):
+            self._write(u'get-mark {0}\n'.format(mark))
+            commitHash = self._readline()
+            self.hashMarks[commitHash] = mark
+            return commitHash
+
+        # Updates the refs, and writes out the pack, for everything that was written so far. Waits for the checkpoint to complete.
+        def checkpoint(self):
+            if self.process is not None:
+                self.checkpointCount += 1
+                self._write(u'checkpoint\n\nprogress checkpoint {0}\n\n'.format(self.checkpointCount))
+                while self._readline() != u'progress checkpoint {0}'.format(self.checkpointCount):
+                    pass
+
+        def close(self):
+            rv = True
+            if self.process is not None:
+                try:
+                    self._write(u'done\n')
+                    self.process.stdin.close()
+                except (IOError, OSError):
+                    pass
+                rv = (self.process.wait() == 0)
+                self.process.stdout.close()
+                self.process = None
+            return rv
+
+    # Persistent `git cat-file --batch` and `git cat-file --batch-check` processes which read objects and resolve revisions (e.g. <ref>:<path>)
+    # without spawning a git process per read. The requests are pipelined and a process which has died is restarted on the next request.
+    class cat_file(object):
+        # The number of requests written to a process before its responses are read. It keeps the request list small enough that it can't fill the
+        # stdin pipe, which could otherwise deadlock with git blocking on a full stdout pipe.
+        pipelineSize = 64
+
+        def __init__(self, repo):
+            self.repo = repo
+            self.processes = {}
+            self.lock = threading.Lock()
+
+        def _start(self, batchOption):
+            process = self.processes.get(batchOption)
+            if process is None or process.poll() is not None:
+                cmd = [ gitCmd, u'cat-file', batchOption ]
+                process = subprocess.Popen(args=cmd, cwd=self.repo.path, stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=False)
+                self.processes[batchOption] = process
+            return process
+
+        def _stop(self, batchOption):
+            process = self.processes.pop(batchOption, None)
+            if process is not None:
+                try:
+                    process.stdin.close()
+                except (IOError, OSError):
+                    pass
+                process.wait()
+                process.stdout.close()
+
+        def _read(self, process, size):
+            data = process.stdout.read(size)
+            if data is None or len(data) != size:
+                raise IOError("git cat-file exited unexpectedly")
+            return data
+
+        # Returns a (hash, type, size, contents) tuple for each object name in the list, or None for the objects that don't exist. The contents
+        # are only read, as bytes, when readContents is set.
+        def _request(self, objNameList, readContents):
+            batchOption = u'--batch' if readContents else u'--batch-check'
+            rv = []
+            with self.lock:
+                for i in range(0, len(objNameList), self.pipelineSize):
+                    chunk = objNameList[i:i + self.pipelineSize]
+                    for attempt in range(0, 2):
+                        chunkRv = []
+                        try:
+                            process = self._start(batchOption)
+                            process.stdin.write(b''.join([ u'{0}\n'.format(objName).encode('utf-8') for objName in chunk ]))
+                            process.stdin.flush()
+                            for objName in chunk:
+                                header = process.stdout.readline()
+                                if len(header) == 0:
+                                    raise IOError("git cat-file exited unexpectedly")
+                                fields = header.decode('utf-8').split()
+                                if len(fields) != 3: # e.g. '<name> missing' or '<name> ambiguous'
+                                    chunkRv.append(None)
+                                    continue
+                                objHash, objType, objSize = fields[0], fields[1], int(fields[2])
+                                contents = None
+                                if readContents:
+                                    contents = self._read(process, objSize + 1)[:-1] # The contents are followed by a new line.
+                                chunkRv.append( (objHash, objType, objSize, contents) )
+                            break
+                        except (IOError, OSError, ValueError):
+                            # The responses of this process can't be trusted anymore so restart it and retry the chunk once.
+                            self._stop(batchOption)
+                            if attempt != 0:
+                                raise
+                    rv.extend(chunkRv)
+            return rv
+
+        # Returns a list of (hash, type, contents) tuples, or None for missing objects, for the object names in the list.
+        def contents_list(self, objNameList):
+            return [ None if r is None else (r[0], r[1], r[3]) for r in self._request(objNameList, readContents=True) ]
+
+        # Returns a (hash, type, contents) tuple for the object or None if it doesn't exist. The contents are bytes, see text().
+        def contents(self, objName):
+            return self.contents_list([ objName ])[0]
+
+        # Returns the contents of the object decoded like the output of the other git commands or None if it doesn't exist.
+        def text(self, objName, objType=None):
+            rv = self.contents(objName)
+            if rv is None or (objType is not None and rv[1] != objType):
+                return None
+            return decode_proc_output(rv[2])
+
+        # Returns a list of (hash, type, size) tuples, or None for missing objects, for the object names in the list.
+        def info_list(self, objNameList):
+            return [ None if r is None else (r[0], r[1], r[2]) for r in self._request(objNameList, readContents=False) ]
+
+        # Returns a (hash, type, size) tuple for the object or None if it doesn't exist.
+        def info(self, objName):
+            return self.info_list([ objName ])[0]
+
+        def close(self):
+            with self.lock:
+                for batchOption in list(self.processes.keys()):
+                    self._stop(batchOption)
         
     def diff(self, refs=[], files=[], stat=False):
         cmd = [u'git', u'diff' ]